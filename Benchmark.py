@@ -0,0 +1,573 @@
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+
+import numpy as np
+import sys
+import time
+
+from Bitboard import Bitboard
+from Evaluator import ThreatEvaluator, batch_evaluate
+from Player import AIPlayer, RandomPlayer
+from Solver import Solver
+from Threats import ThreatSearch, analyze, columns
+
+# Fixed legal positions as 0 based column sequences. None of them has a win
+# in one for either side, so every search below runs to its full depth.
+POSITIONS = {
+    'opening': ['', '31', '5421', '536562'],
+    'middlegame': ['625330551623', '22612332416311', '3512101621534234',
+                   '125165635012325524'],
+    'endgame': ['3432415526014544451051661623', '163550036560521631012205430235',
+                '62561135644665604100120400541341'],
+}
+
+# Early positions for the symmetry benchmark, the first four are their own
+# mirror image
+SYMMETRY_POSITIONS = ['', '3', '33', '3333', '2', '31', '5421']
+
+SEARCH_DEPTHS = {'opening': 8, 'middlegame': 8, 'endgame': 12}
+EXPECTIMAX_DEPTHS = {'opening': 5, 'middlegame': 5, 'endgame': 6}
+
+# Leaf counts of perft (games that are won stop early) checked against the
+# original numpy / string implementation of move generation and win checks
+PERFT_EXPECTED = [
+    ('', 1, 7),
+    ('', 2, 49),
+    ('', 3, 343),
+    ('', 4, 2401),
+    ('', 5, 16807),
+    ('', 6, 117649),
+    ('', 7, 823536),
+    ('22612332416311', 4, 2308),
+    ('3432415526014544451051661623', 5, 3978),
+]
+
+
+def perft(position, depth):
+    """Counts the leaves of the game tree below position, stopping at wins"""
+    if depth == 0:
+        return 1
+    count = 0
+    player = position.next_player()
+    for col in position.valid_moves():
+        position.play(col, player)
+        if position.is_win(player):
+            count += 1
+        else:
+            count += perft(position, depth - 1)
+        position.undo()
+    return count
+
+
+def bench_perft(quick=False):
+    results = {'ok': True}
+    nodes = 0
+    started = time.time()
+    for moves, depth, expected in PERFT_EXPECTED:
+        if quick and depth > 5:
+            continue
+        count = perft(Bitboard.from_moves(moves), depth)
+        nodes += count
+        if count != expected:
+            results['ok'] = False
+            results.setdefault('mismatches', []).append(
+                {'moves': moves, 'depth': depth, 'expected': expected, 'got': count})
+    elapsed = time.time() - started
+    results['leaves_per_sec'] = nodes / elapsed if elapsed else 0.0
+    return results
+
+
+def _search_stats(method, depths, quick):
+    results = {}
+    for name, positions in POSITIONS.items():
+        depth = depths[name] - (2 if quick else 0)
+        nodes = 0
+        elapsed = 0.0
+        hits = probes = 0
+        for moves in positions:
+            position = Bitboard.from_moves(moves)
+            player = AIPlayer(position.next_player(), 1e9)
+            player.max_depth = depth
+            # the endgame positions would be solved instead of searched
+            player.solver = None
+            random.seed(0)
+            started = time.time()
+            getattr(player, method)(position.to_array())
+            elapsed += time.time() - started
+            nodes += player.nodes
+            stats = player.table.stats()
+            hits += stats['hits']
+            probes += stats['hits'] + stats['misses']
+        results[name] = {'depth': depth,
+                         'time_to_depth': elapsed,
+                         'nodes': nodes,
+                         'nodes_per_sec': nodes / elapsed if elapsed else 0.0,
+                         'tt_hit_rate': hits / probes if probes else 0.0}
+    return results
+
+
+def bench_minimax(quick=False):
+    return _search_stats('get_alpha_beta_move', SEARCH_DEPTHS, quick)
+
+
+def bench_expectimax(quick=False):
+    return _search_stats('get_expectimax_move', EXPECTIMAX_DEPTHS, quick)
+
+
+def bench_expectimax_pruning(quick=False):
+    """
+    Plays expectimax against RandomPlayer and searches every ai move both
+    with and without the Star1 chance node pruning and cache, checking
+    that the same move comes out and counting the nodes saved
+    """
+    games = 2 if quick else 6
+    depth = 4 if quick else 5
+    results = {'ok': True, 'depth': depth, 'moves': 0}
+    nodes = {False: 0, True: 0}
+    elapsed = {False: 0.0, True: 0.0}
+    for seed in range(games):
+        np.random.seed(seed)
+        opponent = RandomPlayer(2)
+        position = Bitboard()
+        winner = None
+        while position.valid_moves() and winner is None:
+            player = position.next_player()
+            board = position.to_array()
+            if player == 1:
+                chosen = {}
+                for pruning in (False, True):
+                    searcher = AIPlayer(1, 1e9, book_path=None, solver_path=None)
+                    searcher.max_depth = depth
+                    searcher.star_pruning = pruning
+                    started = time.time()
+                    chosen[pruning] = searcher.get_expectimax_move(board)
+                    elapsed[pruning] += time.time() - started
+                    nodes[pruning] += searcher.nodes
+                if chosen[False] != chosen[True]:
+                    results['ok'] = False
+                results['moves'] += 1
+                col = chosen[False]
+            else:
+                col = int(opponent.get_move(board))
+            position.play(col, player)
+            if position.is_win(player):
+                winner = player
+    results.update({'unpruned_nodes': nodes[False],
+                    'nodes': nodes[True],
+                    'nodes_saved': 1 - nodes[True] / nodes[False] if nodes[False] else 0.0,
+                    'unpruned_time': elapsed[False],
+                    'time_to_depth': elapsed[True]})
+    return results
+
+
+def bench_symmetry(quick=False):
+    """
+    Searches the early positions to a fixed depth with and without mirror
+    symmetry (canonical table keys and collapsed root moves), checking that
+    the same move comes out and counting the nodes saved
+    """
+    depth = 6 if quick else 8
+    results = {'ok': True, 'depth': depth, 'positions': {}}
+    totals = {False: 0, True: 0}
+    elapsed = {False: 0.0, True: 0.0}
+    for moves in SYMMETRY_POSITIONS:
+        position = Bitboard.from_moves(moves)
+        chosen = {}
+        nodes = {}
+        for symmetry in (False, True):
+            searcher = AIPlayer(position.next_player(), 1e9, book_path=None, solver_path=None)
+            searcher.max_depth = depth
+            searcher.symmetry = symmetry
+            random.seed(0)
+            started = time.time()
+            chosen[symmetry] = searcher.get_alpha_beta_move(position)
+            elapsed[symmetry] += time.time() - started
+            nodes[symmetry] = searcher.nodes
+            totals[symmetry] += searcher.nodes
+        if chosen[False] != chosen[True]:
+            results['ok'] = False
+        results['positions'][moves or 'empty'] = {
+            'symmetric': position.is_symmetric(),
+            'plain_nodes': nodes[False],
+            'nodes': nodes[True],
+            'nodes_saved': 1 - nodes[True] / nodes[False] if nodes[False] else 0.0}
+    results.update({'plain_nodes': totals[False],
+                    'nodes': totals[True],
+                    'nodes_saved': 1 - totals[True] / totals[False] if totals[False] else 0.0,
+                    'plain_time': elapsed[False],
+                    'time_to_depth': elapsed[True]})
+    return results
+
+
+def bench_solver(quick=False):
+    """Times the exact solver on the endgame positions without the solved cache"""
+    positions = POSITIONS['endgame'] + ([] if quick else POSITIONS['middlegame'][:1])
+    nodes = 0
+    elapsed = 0.0
+    for moves in positions:
+        counter = [0]
+
+        def tick():
+            counter[0] += 1
+
+        started = time.time()
+        Solver(None).solve_position(Bitboard.from_moves(moves), tick)
+        elapsed += time.time() - started
+        nodes += counter[0]
+    return {'time_to_solve': elapsed,
+            'nodes': nodes,
+            'nodes_per_sec': nodes / elapsed if elapsed else 0.0}
+
+
+def _threat_positions(count, seed=0):
+    """
+    Returns count positions from seeded random games in which neither side
+    misses a win in one or plays a move that loses at once, none of them
+    decided on the next move
+    """
+    rng = random.Random(seed)
+    positions = []
+    while len(positions) < count:
+        position = Bitboard()
+        plies = rng.randint(8, 30)
+        while position.moves < plies:
+            threats = analyze(position)
+            if threats.wins or threats.lost():
+                break
+            position.play(rng.choice(columns(threats.safe)), position.next_player())
+        threats = analyze(position)
+        if position.moves == plies and not threats.wins and not threats.lost():
+            positions.append(position)
+    return positions
+
+
+def bench_threat_search(quick=False):
+    """
+    Times the forced win search by threats on midgame and endgame positions.
+    Wins found with 24 or more discs on the board are checked with the solver.
+    """
+    positions = _threat_positions(100 if quick else 400)
+    search = ThreatSearch()
+    found = 0
+    nodes = 0
+    checked = True
+    started = time.time()
+    lines = []
+    for position in positions:
+        lines.append(search.find_win(position))
+        nodes += search.nodes
+    elapsed = time.time() - started
+    for position, line in zip(positions, lines):
+        if line is None:
+            continue
+        found += 1
+        if position.moves >= 24:
+            position.play(line[0], position.next_player())
+            score, move = Solver(None).solve_position(position, lambda: None)
+            checked = checked and score < 0
+            position.undo()
+    return {'positions': len(positions),
+            'forced_wins': found,
+            'nodes': nodes,
+            'searches_per_sec': len(positions) / elapsed,
+            'ok': checked}
+
+def _numpy_next_moves(board):
+    """The lowest empty cell of every open column found by numpy indexing"""
+    places = []
+    for col in range(board.shape[1]):
+        for row in range(board.shape[0] - 1, -1, -1):
+            if board[row, col] == 0:
+                places.append((row, col))
+                break
+    return places
+
+
+def _numpy_next_player(board):
+    """Whose turn it is found by counting the discs of a numpy board"""
+    discs = 0
+    for row in board:
+        for cell in row:
+            if cell:
+                discs += 1
+    return 1 if discs % 2 == 0 else 2
+
+
+def bench_move_generation(quick=False):
+    """
+    Times listing the moves, finding whose turn it is, copying and playing
+    a move on numpy boards by element indexing against Bitboard
+    """
+    positions = _all_positions()
+    boards = [position.to_array() for position in positions]
+    rounds = 20 if quick else 200
+
+    calls = 0
+    started = time.time()
+    for i in range(rounds):
+        for board in boards:
+            player = _numpy_next_player(board)
+            for row, col in _numpy_next_moves(board):
+                child = board.copy()
+                child[row, col] = player
+                calls += 1
+    array_elapsed = time.time() - started
+
+    started = time.time()
+    for i in range(rounds):
+        for position in positions:
+            player = position.next_player()
+            for col in position.valid_moves():
+                child = position.copy()
+                child.play(col, player)
+    copy_elapsed = time.time() - started
+
+    # what the searches do: one position played and undone in place
+    started = time.time()
+    for i in range(rounds):
+        for position in positions:
+            player = position.next_player()
+            for col in position.valid_moves():
+                position.play(col, player)
+                position.undo()
+    bit_elapsed = time.time() - started
+
+    return {'array_children_per_sec': calls / array_elapsed,
+            'bitboard_copy_children_per_sec': calls / copy_elapsed,
+            'bitboard_play_undo_per_sec': calls / bit_elapsed}
+
+
+def _all_positions():
+    return [Bitboard.from_moves(moves) for positions in POSITIONS.values() for moves in positions]
+
+
+def bench_game_completed(quick=False):
+    """Times AIPlayer.game_completed on numpy boards and the raw bitboard check"""
+    player = AIPlayer.__new__(AIPlayer)
+    positions = _all_positions()
+    boards = [position.to_array() for position in positions]
+    rounds = 20 if quick else 200
+
+    started = time.time()
+    for i in range(rounds):
+        for board in boards:
+            player.game_completed(1, board)
+            player.game_completed(2, board)
+    array_elapsed = time.time() - started
+
+    started = time.time()
+    for i in range(rounds * 20):
+        for position in positions:
+            position.is_win(1)
+            position.is_win(2)
+    bit_elapsed = time.time() - started
+
+    calls = 2 * rounds * len(boards)
+    return {'array_calls_per_sec': calls / array_elapsed,
+            'bitboard_calls_per_sec': 20 * calls / bit_elapsed}
+
+
+def bench_evaluation_function(quick=False):
+    """Times evaluation_function on numpy boards, incremental play/undo and batches"""
+    player = AIPlayer.__new__(AIPlayer)
+    positions = _all_positions()
+    boards = [position.to_array() for position in positions]
+    rounds = 5 if quick else 50
+
+    started = time.time()
+    for i in range(rounds):
+        for board in boards:
+            player.evaluation_function(board)
+    array_elapsed = time.time() - started
+
+    # one incremental update is a play followed by an undo, then a lookup
+    updates = 0
+    started = time.time()
+    for i in range(rounds * 10):
+        for position in positions:
+            position.attach(ThreatEvaluator(position.masks))
+            mover = position.next_player()
+            for col in position.valid_moves():
+                position.play(col, mover)
+                position.evaluator.evaluate(1)
+                position.undo()
+                updates += 1
+    incremental_elapsed = time.time() - started
+
+    # every position after two more plies, scored 49 at a time as expectimax does
+    batches = []
+    for position in positions:
+        masks = []
+        for first in position.valid_moves():
+            position.play(first, position.next_player())
+            for second in position.valid_moves():
+                position.play(second, position.next_player())
+                masks.append((position.masks[1], position.masks[2]))
+                position.undo()
+            position.undo()
+        batches.append(masks)
+    scored = 0
+    started = time.time()
+    for i in range(rounds * 10):
+        for masks in batches:
+            batch_evaluate(masks, 1)
+            scored += len(masks)
+    batch_elapsed = time.time() - started
+
+    return {'array_calls_per_sec': rounds * len(boards) / array_elapsed,
+            'incremental_updates_per_sec': updates / incremental_elapsed,
+            'batch_leaves_per_sec': scored / batch_elapsed}
+
+
+# Python run in a fresh interpreter by bench_startup, one for each stage of
+# starting a game. Each prints the seconds the stage took and whether numpy
+# and tkinter were loaded, which nothing on the startup path should need.
+_STARTUP_REPORT = ("print(json.dumps([time.perf_counter() - started, "
+                   "'numpy' in sys.modules, 'tkinter' in sys.modules]))")
+STARTUP_SCRIPTS = {
+    'import_player': 'import Player',
+    'import_connect_four': 'import ConnectFour',
+    'create_player': 'import Player\nPlayer.AIPlayer(1)',
+    'search_service': '\n'.join([
+        'from Bitboard import Bitboard',
+        'from Player import AIPlayer',
+        'from SearchService import SearchService',
+        'service = SearchService(2)',
+        'for num in (1, 2):',
+        '    service.register(num, AIPlayer(num))',
+        # player 1 wins in one, so the search returns as soon as it starts
+        'service.search(1, Bitboard.from_moves([0, 1, 0, 1, 0, 1]), "get_alpha_beta_move", 5)',
+        'service.close()']),
+}
+
+
+def _time_startup(script):
+    """Runs script in a new interpreter and returns what it reports"""
+    code = '\n'.join(['import json, sys, time', 'started = time.perf_counter()', script,
+                      _STARTUP_REPORT])
+    output = subprocess.check_output([sys.executable, '-c', code],
+                                     cwd=os.path.dirname(os.path.abspath(__file__)))
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def bench_startup(quick=False):
+    """
+    Times each stage of starting a game in fresh interpreters, the fastest of
+    a few runs. The first run also makes sure the modules are compiled and
+    the speed profile exists, so it is not counted.
+    """
+    runs = 3 if quick else 10
+    results = {}
+    for name, script in STARTUP_SCRIPTS.items():
+        _time_startup(script)
+        timings = [_time_startup(script) for i in range(runs)]
+        results[name] = {'time_to_start': min(elapsed for elapsed, numpy, tkinter in timings),
+                         'ok': not any(numpy or tkinter for elapsed, numpy, tkinter in timings)}
+    return results
+
+
+BENCHMARKS = {
+    'perft': bench_perft,
+    'minimax': bench_minimax,
+    'expectimax': bench_expectimax,
+    'expectimax_pruning': bench_expectimax_pruning,
+    'symmetry': bench_symmetry,
+    'solver': bench_solver,
+    'threat_search': bench_threat_search,
+    'game_completed': bench_game_completed,
+    'move_generation': bench_move_generation,
+    'evaluation_function': bench_evaluation_function,
+    'startup': bench_startup,
+}
+
+
+def run(names, quick=False):
+    """Runs the named benchmarks and returns the JSON report as a dict"""
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                         stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    report = {'meta': {'commit': commit,
+                       'python': platform.python_version(),
+                       'machine': platform.machine(),
+                       'quick': quick,
+                       'time': time.strftime('%Y-%m-%dT%H:%M:%S')},
+              'results': {}}
+    for name in names:
+        report['results'][name] = BENCHMARKS[name](quick)
+    return report
+
+
+def _flatten(results, prefix=''):
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(_flatten(value, prefix + key + '.'))
+        else:
+            flat[prefix + key] = value
+    return flat
+
+
+def compare(old, new, threshold=0.1):
+    """
+    Compares two reports made by run()
+
+    Metrics ending in _per_sec should not drop, time_to_depth, time_to_solve,
+    time_to_start and nodes should not grow, by more than threshold (a
+    fraction). Any 'ok' flag that turns False is always a regression.
+
+    RETURNS:
+    A list of strings describing each regression, empty if there are none
+    """
+    old_flat = _flatten(old['results'])
+    new_flat = _flatten(new['results'])
+    regressions = []
+    for key, value in new_flat.items():
+        if key.endswith('.ok') and value is False:
+            regressions.append('{} failed'.format(key))
+        if key not in old_flat or not isinstance(value, (int, float)) or not old_flat[key]:
+            continue
+        change = (value - old_flat[key]) / old_flat[key]
+        if key.endswith('_per_sec') and change < -threshold:
+            regressions.append('{} dropped {:.1%} ({:.0f} -> {:.0f})'.format(
+                key, -change, old_flat[key], value))
+        elif (key.endswith(('time_to_depth', 'time_to_solve', 'time_to_start', '.nodes'))
+              and change > threshold):
+            regressions.append('{} grew {:.1%} ({:.4g} -> {:.4g})'.format(
+                key, change, old_flat[key], value))
+    return regressions
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description='Search and move generation benchmarks')
+    parser.add_argument('benchmarks', nargs='*',
+                        help='Benchmarks to run from {}, all of them by default'.format(
+                            ', '.join(BENCHMARKS)))
+    parser.add_argument('--quick', action='store_true',
+                        help='Shallower searches and fewer rounds')
+    parser.add_argument('--json', help='Write the report to this file')
+    parser.add_argument('--compare', metavar='JSON',
+                        help='Report written by an earlier run to check for regressions')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='Allowed relative slowdown before --compare fails')
+    args = parser.parse_args()
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error('unknown benchmark {}'.format(name))
+
+    report = run(args.benchmarks or list(BENCHMARKS), args.quick)
+    print(json.dumps(report, indent=2))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(json.load(f), report, args.threshold)
+        for regression in regressions:
+            print('REGRESSION: ' + regression)
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,205 @@
+from Rules import STANDARD
+
+# The standard 6x7 connect 4 geometry, see Rules for the bit layout and for
+# other board sizes
+WIDTH = STANDARD.width
+HEIGHT = STANDARD.height
+
+
+class Bitboard:
+    """A Connect 4 position stored as one bit mask per player.
+
+        masks[1] and masks[2] hold the discs of player 1 and player 2,
+        heights[col] is the bit index of the next free cell in col,
+        history is the list of columns played so moves can be undone in O(1),
+        key is the Zobrist hash of the discs on the board and mirror_key the
+        Zobrist hash of its mirror image, both kept up to date by play and
+        undo so canonical_hash() costs nothing.
+        An attached evaluator is told about every disc that is played or
+        taken back so it can keep its scores up to date.
+        rules gives the board size and connect length, the standard 6x7
+        connect 4 unless another Rules is passed in.
+
+        This is the board type shared by the players and the game loop:
+        playing, undoing and listing moves touch only the two masks and the
+        column heights, never a 6x7 array.
+    """
+    __slots__ = ('masks', 'heights', 'moves', 'history', 'key', 'mirror_key', 'evaluator',
+                 'rules')
+
+    def __init__(self, rules=STANDARD):
+        self.rules = rules
+        self.masks = [0, 0, 0]
+        self.heights = list(rules.bottom)
+        self.moves = 0
+        self.history = []
+        self.key = 0
+        self.mirror_key = 0
+        self.evaluator = None
+
+    @classmethod
+    def from_array(cls, board, rules=STANDARD):
+        """
+        Builds a Bitboard from the numpy board used by the game
+
+        INPUTS:
+        board - a rules.height x rules.width numpy array with row 0 at the
+                top of the board, 0 for empty spaces and 1 or 2 for the
+                discs of each player
+
+        RETURNS:
+        A Bitboard holding the same discs
+        """
+        position = cls(rules)
+        height = rules.height
+        for col in range(rules.width):
+            filled = 0
+            for row in range(height - 1, -1, -1):
+                player = board[row, col]
+                if player:
+                    bit = rules.bottom[col] + height - 1 - row
+                    position.masks[player] |= 1 << bit
+                    position.key ^= rules.zobrist[player][bit]
+                    position.mirror_key ^= rules.zobrist[player][rules.mirror_bits[bit]]
+                    position.moves += 1
+                    if filled == height - 1 - row:
+                        filled += 1
+            position.heights[col] = rules.bottom[col] + filled
+        return position
+
+    @classmethod
+    def from_board(cls, board, rules=STANDARD):
+        """Returns a copy of board if it is a Bitboard, else builds one from the numpy board"""
+        if isinstance(board, Bitboard):
+            return board.copy()
+        return cls.from_array(board, rules)
+
+    @classmethod
+    def from_moves(cls, moves, rules=STANDARD):
+        """Builds the position reached by playing the 0 based columns in moves in order"""
+        position = cls(rules)
+        for col in moves:
+            position.play(int(col), position.next_player())
+        return position
+
+    def to_array(self):
+        """Returns the position as a height x width uint8 numpy board"""
+        import numpy as np
+
+        rules = self.rules
+        board = np.zeros([rules.height, rules.width]).astype(np.uint8)
+        for player in (1, 2):
+            mask = self.masks[player]
+            for col in range(rules.width):
+                for row in range(rules.height):
+                    if mask >> (rules.bottom[col] + row) & 1:
+                        board[rules.height - 1 - row, col] = player
+        return board
+
+    def copy(self):
+        """Returns an independent copy of the position without the evaluator"""
+        position = self.__class__.__new__(self.__class__)
+        position.masks = list(self.masks)
+        position.heights = list(self.heights)
+        position.moves = self.moves
+        position.history = list(self.history)
+        position.key = self.key
+        position.mirror_key = self.mirror_key
+        position.evaluator = None
+        position.rules = self.rules
+        return position
+
+    def attach(self, evaluator):
+        """Attaches an incremental evaluator built from the current masks"""
+        self.evaluator = evaluator
+
+    def next_player(self):
+        """Returns the number of the player whose turn it is"""
+        return 1 if self.moves % 2 == 0 else 2
+
+    def can_play(self, col):
+        return self.heights[col] < self.rules.top[col]
+
+    def valid_moves(self):
+        heights = self.heights
+        top = self.rules.top
+        return [col for col in range(len(top)) if heights[col] < top[col]]
+
+    def play(self, col, player):
+        """Drops a disc for player into col and returns the numpy row it landed in"""
+        bit = self.heights[col]
+        evaluator = self.evaluator
+        if evaluator is not None:
+            evaluator.retract(bit, self.masks)
+        self.masks[player] |= 1 << bit
+        if evaluator is not None:
+            evaluator.apply(bit, self.masks)
+        self.heights[col] = bit + 1
+        rules = self.rules
+        zobrist = rules.zobrist[player]
+        self.key ^= zobrist[bit]
+        self.mirror_key ^= zobrist[rules.mirror_bits[bit]]
+        self.moves += 1
+        self.history.append(col)
+        return rules.height - 1 - (bit - rules.bottom[col])
+
+    def undo(self):
+        """Takes back the last move played"""
+        col = self.history.pop()
+        bit = self.heights[col] - 1
+        clear = ~(1 << bit)
+        player = 1 if self.masks[1] >> bit & 1 else 2
+        evaluator = self.evaluator
+        if evaluator is not None:
+            evaluator.retract(bit, self.masks)
+        self.masks[1] &= clear
+        self.masks[2] &= clear
+        if evaluator is not None:
+            evaluator.apply(bit, self.masks)
+        self.heights[col] = bit
+        rules = self.rules
+        zobrist = rules.zobrist[player]
+        self.key ^= zobrist[bit]
+        self.mirror_key ^= zobrist[rules.mirror_bits[bit]]
+        self.moves -= 1
+
+    def unique_key(self):
+        return self.rules.unique_key(self.masks[1], self.masks[2])
+
+    def canonical_key(self):
+        """
+        Returns (key, mirrored): the smaller unique key of the position and
+        its mirror image, and whether that key belongs to the mirror image
+        """
+        rules = self.rules
+        key = rules.unique_key(self.masks[1], self.masks[2])
+        mirror = rules.unique_key(rules.mirror_mask(self.masks[1]), rules.mirror_mask(self.masks[2]))
+        return (mirror, True) if mirror < key else (key, False)
+
+    def canonical_hash(self):
+        """
+        Returns (key, mirrored): the smaller of the Zobrist keys of the
+        position and its mirror image, and whether it is the mirror's
+        """
+        if self.mirror_key < self.key:
+            return self.mirror_key, True
+        return self.key, False
+
+    def is_symmetric(self):
+        """Returns True if the position is its own mirror image"""
+        rules = self.rules
+        return (rules.mirror_mask(self.masks[1]) == self.masks[1] and
+                rules.mirror_mask(self.masks[2]) == self.masks[2])
+
+    @property
+    def connected(self):
+        """The rules' test for four (rules.connect) in a row on a single mask"""
+        return self.rules.connected
+
+    def is_win(self, player):
+        """Returns True if player has four (rules.connect) in a row"""
+        return self.rules.connected(self.masks[player])
+
+    def wins_after(self, col, player):
+        """Returns True if playing col would give player four (rules.connect) in a row"""
+        return self.rules.connected(self.masks[player] | 1 << self.heights[col])
@@ -1,107 +1,212 @@
 # system libs
 import argparse
-import multiprocessing as mp
-import tkinter as tk
-
-# 3rd party libs
-import numpy as np
 
 # Local libs
+from Bitboard import Bitboard
+from Evaluator import DEFAULT_WEIGHTS, Weights
+from GameRecord import GameWriter, DRAW
+from ParallelSearch import RootSplitPlayer, LazySMPPlayer
 from Player import AIPlayer, RandomPlayer, HumanPlayer
+from Rules import Rules, STANDARD
+from SearchService import SearchService
+from Telemetry import Telemetry
 
-#https://stackoverflow.com/a/37737985
-def turn_worker(board, send_end, p_func):
-    send_end.send(p_func(board))
+# Seconds between two rounds of Tk event processing in the event loop
+POLL_INTERVAL = 1 / 60
 
 
 class Game:
     """Sets up and manages a game of Connect 4 including turns and graphics.
 
-        Each turn is executed in a mp.Process to keep the main ui thread available
+        The game is driven by an asyncio event loop that also pumps the Tk
+        events, so the window stays responsive while a move is thought about.
+        AI turns are searched in a SearchService worker process that lives for
+        the whole game, so players keep their search state between turns;
+        waiting for the worker (and for a human's console input) happens in a
+        thread executor, and every completed search depth is shown in the
+        status label as it arrives.
+        With auto play on the game moves on by itself, otherwise one move is
+        made per press of Next Move. Cancel stops the search in progress and
+        the move is not played.
+        With a record path every move is appended to that game record file
+        as it is played, see GameRecord.
+        tkinter and asyncio are imported here rather than with the module,
+        so headless code that imports it does not load them.
     """
-    def __init__(self, player1, player2, time):
+    def __init__(self, player1, player2, time, rules=STANDARD, auto=False, record=None):
+        import asyncio
+        import tkinter as tk
+        from concurrent.futures import ThreadPoolExecutor
+
         self.players = [player1, player2]
         self.colors = ['yellow', 'red']
         self.current_turn = 0
-        self.board = np.zeros([6,7]).astype(np.uint8)
+        self.position = Bitboard(rules)
         self.gui_board = []
         self.game_over = False
         self.ai_turn_limit = time
+        self.moving = False
+        self.pending = None
+        self.cancelled = False
+        self.running = True
+
+        ai_players = [p for p in self.players if p.type == 'ai']
+        self.search_service = SearchService(workers=len(ai_players))
+        for player in ai_players:
+            self.search_service.register(player.player_number, player)
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.recorder = None
+        if record:
+            limits = [time if p.type == 'ai' else 0 for p in self.players]
+            self.recorder = GameWriter(record, [p.type for p in self.players], limits, rules)
 
         # very SIMPLE gui built here
         #https://stackoverflow.com/a/38159672
-        root = tk.Tk()
+        self.root = root = tk.Tk()
         root.title('Connect 4')
+        root.protocol('WM_DELETE_WINDOW', self.close)
         self.player_string = tk.Label(root, text=player1.player_string)
         self.player_string.pack()
-        self.c = tk.Canvas(root, width=700, height=600)
+        self.c = tk.Canvas(root, width=100 * rules.width, height=100 * rules.height)
         self.c.pack()
 
-        for row in range(0, 700, 100):
+        for row in range(0, 100 * rules.width, 100):
             column = []
-            for col in range(0, 700, 100):
+            for col in range(0, 100 * rules.height, 100):
                 column.append(self.c.create_oval(row, col, row+100, col+100, fill=''))
             self.gui_board.append(column)
 
-        tk.Button(root, text='Next Move', command=self.make_move).pack()
-
-        root.mainloop()
-
-    def make_move(self):
+        self.auto = tk.BooleanVar(root, value=auto)
+        controls = tk.Frame(root)
+        controls.pack()
+        tk.Button(controls, text='Next Move', command=self.next_move).pack(side=tk.LEFT)
+        tk.Button(controls, text='Cancel', command=self.cancel_move).pack(side=tk.LEFT)
+        tk.Checkbutton(controls, text='Auto play', variable=self.auto).pack(side=tk.LEFT)
+
+        try:
+            asyncio.run(self.run())
+        finally:
+            self.search_service.close()
+            self.executor.shutdown(wait=False)
+            if self.recorder is not None:
+                self.recorder.close()
+
+    async def run(self):
+        """Processes Tk events and starts moves until the window is closed"""
+        import asyncio
+
+        self.loop = asyncio.get_running_loop()
+        while self.running:
+            self.root.update()
+            if self.auto.get():
+                self.next_move()
+            await asyncio.sleep(POLL_INTERVAL)
+
+    def close(self):
+        """Stops the event loop and any search in progress, then closes the window"""
+        self.running = False
+        if self.pending is not None:
+            self.pending.stop()
+        self.root.destroy()
+
+    def next_move(self):
+        """Starts the next move unless the game is over or a move is in progress"""
+        if not self.game_over and not self.moving:
+            self.moving = True
+            self.cancelled = False
+            self.loop.create_task(self.make_move())
+
+    def cancel_move(self):
+        """Stops the move in progress without playing it and turns auto play off"""
+        self.auto.set(False)
+        if self.pending is not None:
+            self.cancelled = True
+            self.pending.stop()
+
+    def show_progress(self, player, depth, move, nodes):
+        """Shows the latest completed search depth of player in the status label"""
+        if self.running and not self.cancelled:
+            text = '{} thinking... depth {} best column {} ({} nodes)'
+            self.player_string.configure(text=text.format(player.player_string, depth,
+                                                          int(move), nodes))
+
+    async def make_move(self):
         """Moves the game forward a single move."""
-        if not self.game_over:
+        try:
             current_player = self.players[self.current_turn]
 
             if current_player.type == 'ai':
 
                 if self.players[int(not self.current_turn)].type == 'random':
-                    p_func = current_player.get_expectimax_move
+                    method = 'get_expectimax_move'
                 else:
-                    p_func = current_player.get_alpha_beta_move
+                    method = 'get_alpha_beta_move'
+
+                # called in the executor thread, the label is updated from the loop
+                def progress(depth, move, nodes):
+                    self.loop.call_soon_threadsafe(self.show_progress, current_player,
+                                                   depth, move, nodes)
 
                 try:
-                    recv_end, send_end = mp.Pipe(False)
-                    p = mp.Process(target=turn_worker, args=(self.board, send_end, p_func))
-                    p.start()
-                    if p.join(self.ai_turn_limit) is None and p.is_alive():
-                        p.terminate()
-                        raise Exception('Player Exceeded time limit')
+                    self.pending = self.search_service.submit(current_player.player_number,
+                                                              self.position, method,
+                                                              self.ai_turn_limit)
+                    result = await self.loop.run_in_executor(self.executor,
+                                                             self.pending.result, progress)
                 except Exception as e:
                     uh_oh = 'Uh oh.... something is wrong with Player {}'
                     print(uh_oh.format(current_player.player_number))
                     print(e)
-                    raise Exception('Game Over')
-
-                move = recv_end.recv()
+                    self.game_over = True
+                    self.player_string.configure(text='Game Over')
+                    return
+                finally:
+                    self.pending = None
+
+                if self.cancelled or not self.running:
+                    self.player_string.configure(
+                        text=current_player.player_string + ' (move cancelled)')
+                    return
+                move = result.move
+                if result.timed_out:
+                    # the worker was restarted, play on with a legal move
+                    print('Player {} exceeded the time limit'.format(current_player.player_number))
+                    move = self.position.valid_moves()[0]
+            elif current_player.type == 'human':
+                move = await self.loop.run_in_executor(self.executor, current_player.get_move,
+                                                       self.position.copy())
             else:
-                move = current_player.get_move(self.board)
+                move = current_player.get_move(self.position)
 
+            if not self.running:
+                return
             if move is not None:
                 self.update_board(int(move), current_player.player_number)
+                if self.recorder is not None:
+                    self.recorder.move(int(move))
 
             if self.game_completed(current_player.player_number):
                 self.game_over = True
                 self.player_string.configure(text=self.players[self.current_turn].player_string + ' wins!')
+                if self.recorder is not None:
+                    self.recorder.finish(current_player.player_number)
+            elif not self.position.valid_moves():
+                self.game_over = True
+                self.player_string.configure(text='Draw!')
+                if self.recorder is not None:
+                    self.recorder.finish(DRAW)
             else:
                 self.current_turn = int(not self.current_turn)
                 self.player_string.configure(text=self.players[self.current_turn].player_string)
+        finally:
+            self.moving = False
 
     def update_board(self, move, player_num):
         """Updates the board UI to reflect player_num's move at column move"""
-        if 0 in self.board[:,move]:
-            update_row = -1
-            for row in range(1, self.board.shape[0]):
-                update_row = -1
-                if self.board[row, move] > 0 and self.board[row-1, move] == 0:
-                    update_row = row-1
-                elif row==self.board.shape[0]-1 and self.board[row, move] == 0:
-                    update_row = row
-
-                if update_row >= 0:
-                    self.board[update_row, move] = player_num
-                    self.c.itemconfig(self.gui_board[move][update_row],
-                                      fill=self.colors[self.current_turn])
-                    break
+        if self.position.can_play(move):
+            update_row = self.position.play(move, player_num)
+            self.c.itemconfig(self.gui_board[move][update_row],
+                              fill=self.colors[self.current_turn])
         else:
             err = 'Invalid move by player {}. Column {}'.format(player_num, move)
             raise Exception(err)
@@ -109,60 +214,49 @@ class Game:
 
     def game_completed(self, player_num):
         """Returns True if player_num is in a winning position on the gameboard"""
-        player_win_str = '{0}{0}{0}{0}'.format(player_num)
-        board = self.board
-        to_str = lambda a: ''.join(a.astype(str))
-
-        def check_horizontal(b):
-            for row in b:
-                if player_win_str in to_str(row):
-                    return True
-            return False
+        return self.position.is_win(player_num)
 
-        def check_verticle(b):
-            return check_horizontal(b.T)
 
-        def check_diagonal(b):
-            for op in [None, np.fliplr]:
-                op_board = op(b) if op else b
 
-                root_diag = np.diagonal(op_board, offset=0).astype(np.int)
-                if player_win_str in to_str(root_diag):
-                    return True
-
-                for i in range(1, b.shape[1]-3):
-                    for offset in [i, -i]:
-                        diag = np.diagonal(op_board, offset=offset)
-                        diag = to_str(diag.astype(np.int))
-                        if player_win_str in diag:
-                            return True
-
-            return False
-
-        return (check_horizontal(board) or
-                check_verticle(board) or
-                check_diagonal(board))
-
-
-
-def main(player1, player2, time):
+def main(player1, player2, time, workers=1, parallel='smp', telemetry=None,
+         profile=None, rules=STANDARD, auto=False, record=None, weights=DEFAULT_WEIGHTS):
     """
     Creates player objects based on the string paramters that are passed
     to it and calls play_game()
 
     INPUTS:
-    player1 - a string ['ai', 'random', 'human']
-    player2 - a string ['ai', 'random', 'human']
+    player1  - a string ['ai', 'random', 'human']
+    player2  - a string ['ai', 'random', 'human']
+    workers  - number of processes each ai player searches with
+    parallel - a string ['root', 'smp'], how the ai splits its search over
+               the workers
+    telemetry - optional JSONL file every ai move's search stats go to
+    profile   - optional file the sampled stacks of the ai searches go to,
+                in the folded format flamegraph.pl reads
+    rules     - the board size and connect length to play
+    auto      - start with auto play on, so moves are made without pressing
+                Next Move
+    record    - optional game record file the game is appended to
+    weights   - the evaluation Weights of the ai players, see Tuning
     """
     def make_player(name, num):
         if name=='ai':
-            return AIPlayer(num, time)
+            if workers > 1 and parallel == 'root':
+                player = RootSplitPlayer(num, time, workers, rules=rules, weights=weights)
+            elif workers > 1:
+                player = LazySMPPlayer(num, time, workers, rules=rules, weights=weights)
+            else:
+                player = AIPlayer(num, time, rules=rules, weights=weights)
+            if telemetry or profile:
+                player.telemetry = Telemetry(telemetry, profile and
+                                             '{}.player{}'.format(profile, num))
+            return player
         elif name=='random':
-            return RandomPlayer(num)
+            return RandomPlayer(num, rules)
         elif name=='human':
-            return HumanPlayer(num)
+            return HumanPlayer(num, rules)
 
-    Game(make_player(player1, 1), make_player(player2, 2), time)
+    Game(make_player(player1, 1), make_player(player2, 2), time, rules, auto, record)
 
 
 # entrance point parses arguments from cli
@@ -175,6 +269,39 @@ if __name__=='__main__':
                         type=int,
                         default=10,
                         help='Time to wait for a move in seconds (int)')
+    parser.add_argument('--workers',
+                        type=int,
+                        default=1,
+                        help='Processes each ai player searches with (int)')
+    parser.add_argument('--parallel',
+                        choices=['root', 'smp'],
+                        default='smp',
+                        help='Root splitting or Lazy SMP when --workers > 1')
+    parser.add_argument('--telemetry',
+                        metavar='JSONL',
+                        help='Append the search stats of every ai move to this file')
+    parser.add_argument('--profile',
+                        metavar='PATH',
+                        help='Write sampled ai search stacks (flamegraph folded '
+                             'format) to PATH.player1 and PATH.player2')
+    parser.add_argument('--width', type=int, default=7,
+                        help='Columns of the board (int)')
+    parser.add_argument('--height', type=int, default=6,
+                        help='Rows of the board (int)')
+    parser.add_argument('--connect', type=int, default=4,
+                        help='Discs in a row needed to win (int)')
+    parser.add_argument('--auto',
+                        action='store_true',
+                        help='Play moves without waiting for Next Move')
+    parser.add_argument('--record',
+                        metavar='PATH',
+                        help='Append the game to this game record file')
+    parser.add_argument('--weights',
+                        metavar='JSON',
+                        help='Evaluation weights of the ai players, as written by Tuning.py')
     args = parser.parse_args()
 
-    main(args.player1, args.player2, args.time)
\ No newline at end of file
+    main(args.player1, args.player2, args.time, args.workers, args.parallel,
+         args.telemetry, args.profile,
+         Rules.get(args.width, args.height, args.connect), args.auto, args.record,
+         Weights.load(args.weights) if args.weights else DEFAULT_WEIGHTS)
\ No newline at end of file
@@ -0,0 +1,256 @@
+from collections import namedtuple
+
+from Rules import STANDARD
+
+
+class Weights(namedtuple('Weights', ['three', 'win', 'center', 'parity'])):
+    """The weights of the evaluation terms, all integers since search scores are.
+
+        three  - per check_three pattern, player 1's minus player 2's
+        win    - the score of a won position, for the winner
+        center - per disc in the middle column (two middle columns on an even
+                 width), player 1's minus player 2's
+        parity - per empty cell that would complete a line for player 1 on
+                 an odd row (1st, 3rd... from the bottom), minus the same for
+                 player 2 on an even row: the threats that decide who is
+                 forced to give way once the board fills up
+        Scores stay relative to player 1, evaluate(2) negates them.
+    """
+    __slots__ = ()
+
+    def is_plain(self):
+        """Returns True when the evaluation is check_three alone, as ThreatEvaluator scores it"""
+        return self.three == 1 and self.center == 0 and self.parity == 0
+
+    def bound(self, rules=STANDARD):
+        """Returns a bound on the absolute value of every score, wins included"""
+        if self.is_plain():
+            return max(self.win, rules.eval_bound)
+        center = rules.center_mask.bit_count()
+        return max(abs(self.win), abs(self.three) * len(rules.windows) +
+                   abs(self.center) * center + abs(self.parity) * rules.cells)
+
+    def save(self, path):
+        import json
+
+        with open(path, 'w') as f:
+            json.dump({'weights': self._asdict()}, f, indent=2)
+
+    @classmethod
+    def load(cls, path):
+        """Reads weights saved by save() or written by Tuning"""
+        import json
+
+        with open(path) as f:
+            data = json.load(f)
+        return cls(**{field: int(value) for field, value in data['weights'].items()})
+
+
+# The evaluation the search has always used: open threes only, wins score 50
+DEFAULT_WEIGHTS = Weights(three=1, win=50, center=0, parity=0)
+
+
+def make_evaluator(masks, rules=STANDARD, weights=DEFAULT_WEIGHTS):
+    """Returns the incremental evaluator for weights, the plain ThreatEvaluator when it is enough"""
+    if weights.is_plain():
+        return ThreatEvaluator(masks, rules)
+    return WeightedEvaluator(masks, rules, weights)
+
+
+def masks_from_boards(boards, rules=STANDARD):
+    """Converts an N x height x width array of numpy boards to an N x 2 array of player masks"""
+    import numpy as np
+    boards = np.asarray(boards)
+    return np.stack([((boards == num) * rules.cell_bits).sum(axis=(1, 2)) for num in (1, 2)], axis=1)
+
+
+def batch_check_three(masks, rules=STANDARD):
+    """
+    Counts check_three for both players on a batch of positions at once
+
+    INPUTS:
+    masks - an N x 2 integer array of the Bitboard masks of player 1 and
+            player 2, see masks_from_boards for numpy boards
+    rules - the board the masks belong to, it must be rules.batchable
+
+    RETURNS:
+    An N x 2 array, the same counts as AIPlayer.check_three for player 1 and
+    player 2 in each position
+    """
+    import numpy as np
+    masks = np.asarray(masks, dtype=np.int64).reshape(-1, 2)
+    # N x 2 x windows: each player's discs in every window
+    inside = masks[:, :, None] & rules.window_masks
+    clear = inside[:, ::-1] == 0
+    # N x 2 x windows x connect: the window holds exactly the k-th pattern
+    found = (inside[:, :, :, None] == rules.window_threats) & clear[:, :, :, None]
+    # a pattern counts once per line however many windows of the line hold it
+    per_line = np.logical_or.reduceat(found, rules.line_starts, axis=2)
+    return per_line.sum(axis=(2, 3))
+
+
+def batch_winning_cells(current, filled, rules=STANDARD):
+    """Returns rules.winning_cells(current, filled) for int64 arrays of masks"""
+    import numpy as np
+    connect = rules.connect
+    cells = np.zeros_like(current)
+    for shift in rules.shifts:
+        for gap in range(connect):
+            line = np.full_like(current, -1)
+            for place in range(connect):
+                if place != gap:
+                    offset = (place - gap) * shift
+                    line &= current >> offset if offset > 0 else current << -offset
+            cells |= line
+    return cells & (rules.board_mask ^ filled)
+
+
+def batch_evaluate(masks, player_num, rules=STANDARD, weights=None):
+    """
+    Returns check_three(player_num) - check_three(opponent) for every
+    position in masks, or with weights the same score as the
+    WeightedEvaluator of those weights
+    """
+    counts = batch_check_three(masks, rules)
+    if weights is None or weights.is_plain():
+        return counts[:, player_num - 1] - counts[:, 2 - player_num]
+    import numpy as np
+    masks = np.asarray(masks, dtype=np.int64).reshape(-1, 2)
+    mine, theirs = masks[:, 0], masks[:, 1]
+    values = weights.three * (counts[:, 0] - counts[:, 1])
+    if weights.center:
+        values += weights.center * (np.bitwise_count(mine & rules.center_mask).astype(np.int64) -
+                                    np.bitwise_count(theirs & rules.center_mask))
+    if weights.parity:
+        filled = mine | theirs
+        odd = batch_winning_cells(mine, filled, rules) & rules.odd_rows
+        even = batch_winning_cells(theirs, filled, rules) & rules.even_rows
+        values += weights.parity * (np.bitwise_count(odd).astype(np.int64) - np.bitwise_count(even))
+    return values if player_num == 1 else -values
+
+
+class ThreatEvaluator:
+    """Incrementally maintained version of AIPlayer.check_three.
+
+        check_three counts, for every line of the board, how many of the four
+        three-in-a-window patterns appear in it. The evaluator keeps, for each
+        player, how many windows of each line currently match each pattern
+        and the number of (line, pattern) pairs with a non-zero count.
+        Playing or undoing a disc only revisits the windows through that
+        cell, so reading the score at a leaf is a lookup.
+        On other boards the patterns are the connect windows with one cell
+        missing, counted the same way.
+    """
+    def __init__(self, masks, rules=STANDARD):
+        slots = len(rules.lines) * rules.connect
+        self.windows_at = rules.windows_at
+        self.counts = [None, [0] * slots, [0] * slots]
+        self.scores = [0, 0, 0]
+        for mask, threes in rules.windows:
+            self._add(mask, threes, masks, 1)
+
+    def _add(self, mask, threes, masks, step):
+        mine = masks[1] & mask
+        theirs = masks[2] & mask
+        if mine and not theirs:
+            player, slot = 1, threes.get(mine)
+        elif theirs and not mine:
+            player, slot = 2, threes.get(theirs)
+        else:
+            return
+        if slot is not None:
+            counts = self.counts[player]
+            counts[slot] += step
+            if counts[slot] == (1 if step > 0 else 0):
+                self.scores[player] += step
+
+    def retract(self, bit, masks):
+        """Removes the windows through bit before the cell changes"""
+        for mask, threes in self.windows_at[bit]:
+            self._add(mask, threes, masks, -1)
+
+    def apply(self, bit, masks):
+        """Adds back the windows through bit after the cell changed"""
+        for mask, threes in self.windows_at[bit]:
+            self._add(mask, threes, masks, 1)
+
+    def check_three(self, player_num):
+        """Returns the same count as AIPlayer.check_three for player_num"""
+        return self.scores[player_num]
+
+    def evaluate(self, player_num):
+        """Returns check_three(player_num) - check_three(opponent)"""
+        return self.scores[player_num] - self.scores[3 - player_num]
+
+
+class WeightedEvaluator(ThreatEvaluator):
+    """ThreatEvaluator scoring with Weights instead of check_three alone.
+
+        The threes are kept up to date the same way; the center and parity
+        terms are read off the masks (the same list the Bitboard updates)
+        when a leaf is evaluated, and only when their weight is not 0.
+    """
+    def __init__(self, masks, rules=STANDARD, weights=DEFAULT_WEIGHTS):
+        super().__init__(masks, rules)
+        self.masks = masks
+        self.weights = weights
+        self.center_mask = rules.center_mask
+        self.odd_rows = rules.odd_rows
+        self.even_rows = rules.even_rows
+        self.winning_cells = rules.winning_cells
+
+    def evaluate(self, player_num):
+        """Returns the weighted score for player_num"""
+        masks = self.masks
+        weights = self.weights
+        value = weights.three * (self.scores[1] - self.scores[2])
+        if weights.center:
+            value += weights.center * ((masks[1] & self.center_mask).bit_count() -
+                                       (masks[2] & self.center_mask).bit_count())
+        if weights.parity:
+            filled = masks[1] | masks[2]
+            odd = self.winning_cells(masks[1], filled) & self.odd_rows
+            even = self.winning_cells(masks[2], filled) & self.even_rows
+            value += weights.parity * (odd.bit_count() - even.bit_count())
+        return value if player_num == 1 else -value
+
+
+# Compares the incremental and batch evaluators against AIPlayer.check_three
+# on random boards, both arbitrary fills and legal games played with make/unmake,
+# and the weighted ones against each other
+if __name__ == '__main__':
+    import random
+
+    import numpy as np
+
+    from Bitboard import Bitboard
+    from Player import AIPlayer
+
+    player = AIPlayer.__new__(AIPlayer)
+    rng = random.Random(0)
+
+    for trial in range(500):
+        board = np.array([[rng.randint(0, 2) for col in range(STANDARD.width)]
+                          for row in range(STANDARD.height)]).astype(np.uint8)
+        evaluator = ThreatEvaluator(Bitboard.from_array(board).masks)
+        batch = batch_check_three(masks_from_boards([board]))[0]
+        for num in (1, 2):
+            assert evaluator.check_three(num) == player.check_three(num, board), board
+            assert batch[num - 1] == player.check_three(num, board), board
+
+    for game in range(100):
+        position = Bitboard()
+        weights = Weights(rng.randint(1, 4), 50, rng.randint(-4, 4), rng.randint(-4, 4))
+        position.attach(WeightedEvaluator(position.masks, STANDARD, weights))
+        while position.valid_moves() and not (position.is_win(1) or position.is_win(2)):
+            position.play(rng.choice(position.valid_moves()), position.next_player())
+            if rng.random() < 0.2:
+                position.undo()
+            board = position.to_array()
+            for num in (1, 2):
+                assert position.evaluator.check_three(num) == player.check_three(num, board), board
+                assert position.evaluator.evaluate(num) == batch_evaluate(
+                    [position.masks[1:]], num, STANDARD, weights)[0], board
+
+    print('ThreatEvaluator and batch_check_three match check_three, '
+          'WeightedEvaluator matches batch_evaluate')
@@ -0,0 +1,323 @@
+import argparse
+import heapq
+import json
+import os
+import struct
+import time
+from collections import namedtuple
+
+from Bitboard import Bitboard
+from Evaluator import ThreatEvaluator, batch_evaluate
+from Rules import Rules
+
+# File layout, all little endian:
+#   header  magic, version
+#   records one after another, each a record header (board size, player
+#           types, time limit of each player, result, number of moves)
+#           followed by one byte per move, the 0 based column played
+MAGIC = b'C4GR'
+VERSION = 1
+HEADER = struct.Struct('<4sHxx')
+RECORD = struct.Struct('<BBBBBBHff')
+
+PLAYER_TYPES = ['ai', 'random', 'human']
+# result codes besides the number of the winner
+DRAW = 0
+UNFINISHED = 3
+
+GameRecord = namedtuple('GameRecord', ['players', 'time_limits', 'rules', 'result', 'moves'])
+
+# Positions scored per batch_evaluate call when analyzing with the evaluation
+BATCH_POSITIONS = 4096
+
+
+class GameWriter:
+    """Streams one game to a game record file as it is played.
+
+        The record header is written when the game starts and every move is
+        appended as it is played, with the move count in the header patched
+        each time, so the file holds a readable record (with result
+        UNFINISHED) however the game ends. finish() writes the result.
+        The move is written before the count, so a writer that dies between
+        the two leaves one move more than the count says, which
+        read_games() takes back into the record.
+        Only one writer may append to a file at a time.
+    """
+    def __init__(self, path, players, time_limits, rules):
+        self.players = [PLAYER_TYPES.index(name) for name in players]
+        self.time_limits = time_limits
+        self.rules = rules
+        self.moves = 0
+        self.file = open_for_append(path)
+        self.start = self.file.tell()
+        self.write_header(UNFINISHED)
+
+    def write_header(self, result):
+        self.file.seek(self.start)
+        self.file.write(RECORD.pack(self.rules.width, self.rules.height, self.rules.connect,
+                                    self.players[0], self.players[1], result, self.moves,
+                                    self.time_limits[0], self.time_limits[1]))
+        self.file.seek(0, os.SEEK_END)
+
+    def move(self, col):
+        """Appends the column just played"""
+        self.file.write(bytes((col,)))
+        self.moves += 1
+        self.write_header(UNFINISHED)
+        self.file.flush()
+
+    def finish(self, result):
+        """Writes the result (1 or 2 for the winner, DRAW) and closes the file"""
+        self.write_header(result)
+        self.close()
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+
+
+def open_for_append(path):
+    """Opens path for writing at the end, creating it with the file header if needed"""
+    try:
+        with open(path, 'xb') as f:
+            f.write(HEADER.pack(MAGIC, VERSION))
+    except FileExistsError:
+        pass
+    f = open(path, 'r+b')
+    f.seek(0, os.SEEK_END)
+    return f
+
+
+def write_game(path, record):
+    """Appends a whole GameRecord to path"""
+    with open_for_append(path) as f:
+        rules = record.rules
+        f.write(RECORD.pack(rules.width, rules.height, rules.connect,
+                            PLAYER_TYPES.index(record.players[0]),
+                            PLAYER_TYPES.index(record.players[1]),
+                            record.result, len(record.moves),
+                            record.time_limits[0], record.time_limits[1]))
+        f.write(bytes(record.moves))
+
+
+def valid_record_header(data):
+    """Returns True if data unpacks to a record header that a writer could have written"""
+    (width, height, connect, player1, player2, result, count,
+     limit1, limit2) = RECORD.unpack(data)
+    return (2 <= connect <= max(width, height) and 0 < width <= 15 and height > 0 and
+            player1 < len(PLAYER_TYPES) and player2 < len(PLAYER_TYPES) and
+            result <= UNFINISHED and count <= width * height)
+
+
+def read_games(*paths):
+    """
+    Reads game records one at a time, so files of any size can be streamed
+
+    INPUTS:
+    paths - one or more game record files, read in order
+
+    RETURNS:
+    A generator of GameRecord. A record cut short at the end of a file
+    keeps the moves that were written. So does an UNFINISHED record that
+    is followed by one move byte its count does not include (its writer
+    died before patching the count); the records after it are read from
+    the byte after it.
+    """
+    for path in paths:
+        with open(path, 'rb') as f:
+            magic, version = HEADER.unpack(f.read(HEADER.size))
+            if magic != MAGIC or version != VERSION:
+                raise ValueError('{} is not a version {} game record file'.format(path, VERSION))
+            while True:
+                data = f.read(RECORD.size)
+                if len(data) < RECORD.size:
+                    break
+                (width, height, connect, player1, player2, result, count,
+                 limit1, limit2) = RECORD.unpack(data)
+                moves = list(f.read(count))
+                if result == UNFINISHED and len(moves) == count:
+                    # the stray move is either the last byte of the file or
+                    # followed by the next record, which then only lines up
+                    # one byte later
+                    ahead = f.read(1 + RECORD.size)
+                    if ahead[:1] and ahead[0] < width and (
+                            len(ahead) == 1 or
+                            len(ahead) == 1 + RECORD.size and
+                            not valid_record_header(ahead[:-1]) and
+                            valid_record_header(ahead[1:])):
+                        moves.append(ahead[0])
+                        f.seek(1 - len(ahead), os.SEEK_CUR)
+                    else:
+                        f.seek(-len(ahead), os.SEEK_CUR)
+                yield GameRecord((PLAYER_TYPES[player1], PLAYER_TYPES[player2]),
+                                 (limit1, limit2), Rules.get(width, height, connect),
+                                 result, moves)
+
+
+def replay(record):
+    """
+    Replays a game
+
+    RETURNS:
+    A generator of (position, move) for every move of the game, position
+    being the Bitboard before the move. The same Bitboard is updated in
+    place between moves, copy it to keep it.
+    """
+    position = Bitboard(record.rules)
+    for move in record.moves:
+        yield position, move
+        position.play(move, position.next_player())
+
+
+def _evaluation_losses(positions):
+    """
+    Scores every move of every position with the evaluation function in one
+    batch_evaluate call (boards too big for it use ThreatEvaluator). A move
+    that wins scores 50 as in the search.
+
+    INPUTS:
+    positions - a list of (entry, masks, heights, rules, mover, moves), all
+                with the same rules
+
+    RETURNS:
+    A list of (entry, best move, loss) in the same order
+    """
+    children = []
+    for entry, masks, heights, rules, mover, moves in positions:
+        for col in moves:
+            child = list(masks)
+            child[mover] |= 1 << heights[col]
+            children.append((child[1], child[2]))
+    rules = positions[0][3]
+    if rules.batchable:
+        values = batch_evaluate(children, 1, rules).tolist() if children else []
+    else:
+        values = [ThreatEvaluator([0, mask1, mask2], rules).evaluate(1)
+                  for mask1, mask2 in children]
+
+    losses = []
+    index = 0
+    for entry, masks, heights, rules, mover, moves in positions:
+        scores = {}
+        for col in moves:
+            child = masks[mover] | 1 << heights[col]
+            if rules.connected(child):
+                scores[col] = 50
+            else:
+                scores[col] = values[index] if mover == 1 else -values[index]
+            index += 1
+        best = max(moves, key=lambda col: scores[col])
+        losses.append((entry, best, scores[best] - scores[entry['move']]))
+    return losses
+
+
+def _search_losses(searcher, position, move, depth):
+    """Returns (best move, loss) of move in position by an alpha-beta search to depth"""
+    mover = position.next_player()
+    searcher.root_moves = position.moves
+    searcher.ordering.new_search()
+    position.attach(ThreatEvaluator(position.masks, position.rules))
+    order = searcher.ordering.order(position, 0, mover)
+    scores = searcher.search_root(position, order, depth, mover)
+    sign = 1 if mover == 1 else -1
+    best = max(scores, key=lambda col: sign * scores[col])
+    played = scores[move]
+    if played != scores[best]:
+        # worse moves only got a bound from search_root
+        position.play(move, mover)
+        played = searcher.minimax(position, depth, -1000, 1000, 3 - mover)
+        position.undo()
+    position.attach(None)
+    return best, sign * (scores[best] - played)
+
+
+def analyze(records, depth=None, top=20, players=('ai',)):
+    """
+    Finds the moves that lost the most value in a stream of games
+
+    INPUTS:
+    records - GameRecords, e.g. from read_games()
+    depth   - None to score moves with the evaluation function (batched over
+              many positions at once), or the depth of an alpha-beta search
+              to score them with
+    top     - how many of the worst moves to report
+    players - the player types whose moves are analyzed
+
+    RETURNS:
+    A dict with the number of games and moves analyzed, the average loss
+    per move and the top worst moves, each a dict with the game index, ply,
+    player, move played, best move and the value lost
+    """
+    from Player import AIPlayer
+
+    worst = []
+    count = 0
+    total = 0.0
+    searchers = {}
+    pending = []
+
+    def add(losses):
+        nonlocal count, total
+        for entry, best, loss in losses:
+            count += 1
+            total += loss
+            entry.update({'best': best, 'loss': loss})
+            item = (loss, -entry['game'], -entry['ply'], entry)
+            if len(worst) < top:
+                heapq.heappush(worst, item)
+            elif item[:3] > worst[0][:3]:
+                heapq.heapreplace(worst, item)
+
+    games = 0
+    for game, record in enumerate(records):
+        games += 1
+        for position, move in replay(record):
+            mover = position.next_player()
+            if record.players[mover - 1] not in players:
+                continue
+            entry = {'game': game, 'ply': position.moves, 'player': mover, 'move': move}
+            moves = position.valid_moves()
+            if depth is None:
+                if pending and pending[0][3] is not record.rules:
+                    add(_evaluation_losses(pending))
+                    pending = []
+                pending.append((entry, list(position.masks), list(position.heights),
+                                record.rules, mover, moves))
+                if len(pending) >= BATCH_POSITIONS:
+                    add(_evaluation_losses(pending))
+                    pending = []
+            else:
+                searcher = searchers.get(record.rules)
+                if searcher is None:
+                    searcher = AIPlayer(1, 1e9, table_bytes=1 << 22, book_path=None,
+                                        solver_path=None, rules=record.rules)
+                    searcher.start_search()
+                    searchers[record.rules] = searcher
+                best, loss = _search_losses(searcher, position, move, depth)
+                add([(entry, best, loss)])
+    if pending:
+        add(_evaluation_losses(pending))
+
+    return {'games': games,
+            'moves': count,
+            'average_loss': total / count if count else 0.0,
+            'worst': [item[3] for item in sorted(worst, reverse=True)]}
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description='Replays game records and reports the '
+                                                 'moves that lost the most value')
+    parser.add_argument('records', nargs='+', help='Game record files')
+    parser.add_argument('--depth', type=int, default=None,
+                        help='Search every position to this depth instead of only '
+                             'scoring its moves with the evaluation function')
+    parser.add_argument('--top', type=int, default=20,
+                        help='How many of the worst moves to report')
+    parser.add_argument('--players', nargs='+', choices=PLAYER_TYPES, default=['ai'],
+                        help='Player types whose moves are analyzed')
+    args = parser.parse_args()
+
+    started = time.time()
+    report = analyze(read_games(*args.records), args.depth, args.top, tuple(args.players))
+    report['elapsed'] = time.time() - started
+    print(json.dumps(report, indent=2))
@@ -0,0 +1,189 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import time
+
+from MoveServer import CLOSE, TEXT, encode_frame, read_frame, read_http_message
+from Tuning import random_opening
+
+
+# Raw requests a server has to refuse with a 400, each on its own connection
+MALFORMED_HTTP = [b'GARBAGE\r\n\r\n',
+                  b'POST /move HTTP/1.1\r\nContent-Length: abc\r\n\r\n',
+                  b'POST /move HTTP/1.1\r\nContent-Length: -4\r\n\r\n']
+# Bodies of POST /move a server has to refuse with a 400
+MALFORMED_BODIES = [b'{', b'\xff', b'[]', b'{"moves": 3}', b'{"moves": [null]}',
+                    b'{"moves": [[3]]}', b'{"moves": [9]}', b'{"board": [[0], [1, 2]]}',
+                    b'{"board": "x"}', b'{"height": 0}', b'{"width": 1000, "height": 1000}',
+                    b'{"time": "soon"}', b'{"method": "guess"}']
+
+
+def make_requests(count, distinct, seed=0, budget=0.5, method='alpha_beta', max_plies=12):
+    """
+    Returns count move requests drawn from distinct random positions, so a
+    smaller distinct exercises the server's cache and request sharing
+    """
+    rng = random.Random(seed)
+    positions = [random_opening(rng, rng.randint(0, max_plies)) for i in range(distinct)]
+    return [{'id': i, 'moves': rng.choice(positions), 'time': budget, 'method': method}
+            for i in range(count)]
+
+
+def percentile(values, share):
+    """Returns the nearest rank percentile of sorted values, share between 0 and 1"""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(0, int(round(share * len(values))) - 1))]
+
+
+async def http_client(host, port, requests, results):
+    """Sends requests one after another over a keep-alive connection"""
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        while requests:
+            request = requests.pop()
+            body = json.dumps(request).encode()
+            started = time.perf_counter()
+            writer.write('POST /move HTTP/1.1\r\nHost: {}\r\nContent-Type: application/json\r\n'
+                         'Content-Length: {}\r\n\r\n'.format(host, len(body)).encode() + body)
+            (version, status, reason), headers, body = await read_http_message(reader)
+            results.append((time.perf_counter() - started, int(status), json.loads(body)))
+    finally:
+        writer.close()
+
+
+async def websocket_client(host, port, requests, results, pipeline=1):
+    """Sends requests over a WebSocket, keeping up to pipeline of them unanswered"""
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write('GET /ws HTTP/1.1\r\nHost: {}\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n'
+                 'Sec-WebSocket-Key: {}\r\nSec-WebSocket-Version: 13\r\n\r\n'.format(
+                     host, 'bG9hZHRlc3QgY2xpZW50IQ==').encode())
+    (version, status, reason), headers, body = await read_http_message(reader)
+    if status != '101':
+        raise ConnectionError('WebSocket upgrade refused with {}'.format(status))
+    sent = {}
+
+    def send():
+        request = requests.pop()
+        sent[request['id']] = time.perf_counter()
+        writer.write(encode_frame(TEXT, json.dumps(request).encode(), os.urandom(4)))
+
+    try:
+        while requests and len(sent) < pipeline:
+            send()
+        while sent:
+            opcode, payload = await read_frame(reader)
+            if opcode == CLOSE:
+                break
+            if opcode != TEXT:
+                continue
+            answer = json.loads(payload)
+            started = sent.pop(answer['id'])
+            results.append((time.perf_counter() - started, answer.get('status', 200), answer))
+            if requests:
+                send()
+        writer.write(encode_frame(CLOSE, b'', os.urandom(4)))
+    finally:
+        writer.close()
+
+
+async def check(host, port):
+    """
+    Sends every malformed request above to the server
+
+    RETURNS:
+    A list of (request bytes, status) for each one not answered with a 400,
+    the status None when the connection closed without an answer
+    """
+    messages = list(MALFORMED_HTTP)
+    for body in MALFORMED_BODIES:
+        messages.append('POST /move HTTP/1.1\r\nHost: {}\r\nContent-Length: {}\r\n'
+                        'Connection: close\r\n\r\n'.format(host, len(body)).encode() + body)
+    failures = []
+    for message in messages:
+        reader, writer = await asyncio.open_connection(host, port)
+        try:
+            writer.write(message)
+            answer = await read_http_message(reader)
+            status = None if answer is None else int(answer[0][1])
+        except (ConnectionError, asyncio.IncompleteReadError):
+            status = None
+        finally:
+            writer.close()
+        if status != 400:
+            failures.append((message, status))
+    return failures
+
+
+async def run(host, port, requests, clients=8, protocol='http', pipeline=1):
+    """
+    Sends requests from clients concurrent connections, each sending its
+    next request as soon as an answer comes back
+
+    RETURNS:
+    A dict with the number of answers of each kind, the throughput and the
+    latency percentiles in seconds
+    """
+    requests = list(reversed(requests))
+    results = []
+    started = time.perf_counter()
+    if protocol == 'http':
+        tasks = [http_client(host, port, requests, results) for i in range(clients)]
+    else:
+        tasks = [websocket_client(host, port, requests, results, pipeline)
+                 for i in range(clients)]
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+
+    latencies = sorted(latency for latency, status, answer in results if status == 200)
+    return {'requests': len(results),
+            'ok': len(latencies),
+            'rejected': sum(1 for latency, status, answer in results if status == 503),
+            'errors': sum(1 for latency, status, answer in results if status not in (200, 503)),
+            'cache_hits': sum(1 for latency, status, answer in results if answer.get('cached')),
+            'shared': sum(1 for latency, status, answer in results if answer.get('shared')),
+            'elapsed': elapsed,
+            'throughput': len(latencies) / elapsed if elapsed else 0.0,
+            'mean': sum(latencies) / len(latencies) if latencies else 0.0,
+            'p50': percentile(latencies, 0.5),
+            'p90': percentile(latencies, 0.9),
+            'p99': percentile(latencies, 0.99),
+            'max': latencies[-1] if latencies else 0.0}
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description='Load tests a MoveServer and reports '
+                                                 'latency percentiles and throughput')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--clients', type=int, default=8,
+                        help='Concurrent connections')
+    parser.add_argument('--protocol', choices=['http', 'ws'], default='http')
+    parser.add_argument('--pipeline', type=int, default=1,
+                        help='Unanswered requests each WebSocket client keeps in flight')
+    parser.add_argument('--distinct', type=int, default=50,
+                        help='Different positions the requests are drawn from')
+    parser.add_argument('--time', type=float, default=0.5,
+                        help='Time budget of every request, in seconds')
+    parser.add_argument('--method', choices=['alpha_beta', 'expectimax'], default='alpha_beta')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--check', action='store_true',
+                        help='Only check that malformed requests are refused with a 400')
+    args = parser.parse_args()
+
+    if args.check:
+        failures = asyncio.run(check(args.host, args.port))
+        for message, status in failures:
+            print('{!r} was answered with {}'.format(message, status))
+        print('{} of {} malformed requests refused with a 400'.format(
+            len(MALFORMED_HTTP) + len(MALFORMED_BODIES) - len(failures),
+            len(MALFORMED_HTTP) + len(MALFORMED_BODIES)))
+        raise SystemExit(1 if failures else 0)
+
+    requests = make_requests(args.requests, args.distinct, args.seed, args.time, args.method)
+    report = asyncio.run(run(args.host, args.port, requests, args.clients, args.protocol,
+                             args.pipeline))
+    print(json.dumps(report, indent=2))
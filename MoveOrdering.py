@@ -0,0 +1,70 @@
+from Rules import STANDARD
+
+# Columns from the center outwards: 3, 2, 4, 1, 5, 0, 6 on a standard board
+CENTER_ORDER = STANDARD.center_order
+
+
+class MoveOrderer:
+    """Chooses the order alpha-beta tries the moves of a node in.
+
+        Each part can be switched off on its own:
+        center   - try columns from the center out instead of left to right
+        tt_move  - try the best move stored in the transposition table first
+        killers  - try the two latest moves that caused a cutoff at this ply
+        history  - sort the rest by how often they caused cutoffs, weighted
+                   by the depth of the cutoff
+
+        Ordering only decides which moves are searched first, so the value
+        alpha-beta returns for the root moves (and the move chosen) is the
+        same whichever parts are switched on.
+        The tables are sized for the board of rules.
+    """
+    def __init__(self, center=True, tt_move=True, killers=True, history=True,
+                 static_order=None, rules=STANDARD):
+        self.center = center
+        self.tt_move = tt_move
+        self.killers = killers
+        self.history = history
+        if static_order is None:
+            static_order = rules.center_order if center else list(range(rules.width))
+        self.static_order = static_order
+        self.top = rules.top
+        self.killer_moves = [[None, None] for ply in range(rules.cells + 1)]
+        self.history_scores = [None, [0] * rules.width, [0] * rules.width]
+
+    def new_search(self):
+        """Clears the killer moves and ages the history scores"""
+        for killer in self.killer_moves:
+            killer[0] = killer[1] = None
+        for player in (1, 2):
+            scores = self.history_scores[player]
+            for col in range(len(scores)):
+                scores[col] //= 2
+
+    def order(self, board, ply, player, tt_move=None):
+        """Returns the playable columns of board in the order to search them"""
+        heights = board.heights
+        top = self.top
+        moves = [col for col in self.static_order if heights[col] < top[col]]
+        if self.history:
+            scores = self.history_scores[player]
+            moves.sort(key=lambda col: -scores[col])
+        if self.killers:
+            for killer in reversed(self.killer_moves[ply]):
+                if killer is not None and killer in moves:
+                    moves.remove(killer)
+                    moves.insert(0, killer)
+        if self.tt_move and tt_move is not None and tt_move in moves:
+            moves.remove(tt_move)
+            moves.insert(0, tt_move)
+        return moves
+
+    def cutoff(self, col, ply, player, depth):
+        """Records that col caused a beta cutoff at ply with depth left"""
+        if self.killers:
+            killer = self.killer_moves[ply]
+            if killer[0] != col:
+                killer[1] = killer[0]
+                killer[0] = col
+        if self.history:
+            self.history_scores[player][col] += depth * depth
@@ -0,0 +1,468 @@
+import argparse
+import asyncio
+import base64
+import hashlib
+import json
+import struct
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from Bitboard import Bitboard
+from Evaluator import DEFAULT_WEIGHTS, Weights
+from Player import AIPlayer
+from Rules import Rules
+from SearchService import SearchService
+
+# Search methods a request can ask for and the AIPlayer method that runs each
+METHODS = {'alpha_beta': 'get_alpha_beta_move',
+           'expectimax': 'get_expectimax_move'}
+# Board sizes (width, height, connect) a request may ask for. Every size
+# gets its own Rules tables and its own player in a worker, kept for the
+# life of the server, so clients choose from a fixed set.
+SIZES = {(7, 6, 4), (6, 5, 4), (8, 7, 4), (9, 7, 4), (10, 7, 4), (8, 8, 4)}
+# Largest request body or WebSocket message accepted, in bytes
+MAX_MESSAGE = 1 << 16
+# Added to the client's key to accept a WebSocket handshake (RFC 6455)
+WEBSOCKET_GUID = b'258EAFA5-E914-47DA-95CA-C5AB0DC11D8C'
+# WebSocket frame opcodes
+TEXT, CLOSE, PING, PONG = 0x1, 0x8, 0x9, 0xA
+REASONS = {101: 'Switching Protocols', 200: 'OK', 400: 'Bad Request', 404: 'Not Found',
+           413: 'Payload Too Large', 503: 'Service Unavailable'}
+
+
+class RequestError(Exception):
+    """A request that can not be served, with the HTTP status to answer it with"""
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+async def read_http_message(reader):
+    """
+    Reads one HTTP/1.1 request or response
+
+    RETURNS:
+    (start line split on spaces, dict of lower cased header names to
+    values, body bytes), or None when the connection closed first
+    """
+    line = await reader.readline()
+    if not line:
+        return None
+    start = line.decode('latin-1').rstrip('\r\n').split(' ', 2)
+    if len(start) != 3:
+        raise RequestError('Malformed start line')
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    length = headers.get('content-length', '0')
+    if not (length.isascii() and length.isdigit()):
+        raise RequestError('Content-Length must be a number of bytes')
+    length = int(length)
+    if length > MAX_MESSAGE:
+        raise RequestError('Body of {} bytes is too large'.format(length), 413)
+    body = await reader.readexactly(length) if length else b''
+    return start, headers, body
+
+
+def http_response(status, payload=None, headers=()):
+    """Returns the bytes of an HTTP/1.1 response with payload as a JSON body"""
+    body = b'' if payload is None else json.dumps(payload).encode()
+    lines = ['HTTP/1.1 {} {}'.format(status, REASONS.get(status, '')),
+             'Content-Length: {}'.format(len(body))]
+    if payload is not None:
+        lines.append('Content-Type: application/json')
+    lines.extend('{}: {}'.format(name, value) for name, value in headers)
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body
+
+
+def websocket_accept(key):
+    """Returns the Sec-WebSocket-Accept value answering a Sec-WebSocket-Key"""
+    return base64.b64encode(hashlib.sha1(key.encode() + WEBSOCKET_GUID).digest()).decode()
+
+
+def encode_frame(opcode, payload, mask=None):
+    """
+    Returns one final WebSocket frame. Clients must mask what they send:
+    mask is then the 4 byte masking key, servers leave it None.
+    """
+    length = len(payload)
+    if length < 126:
+        header = struct.pack('!BB', 0x80 | opcode, length | (0x80 if mask else 0))
+    elif length < 1 << 16:
+        header = struct.pack('!BBH', 0x80 | opcode, 126 | (0x80 if mask else 0), length)
+    else:
+        header = struct.pack('!BBQ', 0x80 | opcode, 127 | (0x80 if mask else 0), length)
+    if mask:
+        payload = bytes(byte ^ mask[i % 4] for i, byte in enumerate(payload))
+        header += mask
+    return header + payload
+
+
+async def read_frame(reader):
+    """
+    Reads one WebSocket message, joining fragmented frames
+
+    RETURNS:
+    (opcode, payload bytes), or (CLOSE, b'') when the connection closed
+    """
+    opcode = None
+    message = b''
+    while True:
+        try:
+            first, second = await reader.readexactly(2)
+        except asyncio.IncompleteReadError:
+            return CLOSE, b''
+        length = second & 0x7F
+        if length == 126:
+            length = struct.unpack('!H', await reader.readexactly(2))[0]
+        elif length == 127:
+            length = struct.unpack('!Q', await reader.readexactly(8))[0]
+        if len(message) + length > MAX_MESSAGE:
+            raise RequestError('Message too large', 413)
+        mask = await reader.readexactly(4) if second & 0x80 else None
+        payload = await reader.readexactly(length)
+        if mask:
+            payload = bytes(byte ^ mask[i % 4] for i, byte in enumerate(payload))
+        frame_opcode = first & 0x0F
+        if frame_opcode >= CLOSE:
+            # control frames may arrive between the fragments of a message
+            return frame_opcode, payload
+        if opcode is None:
+            opcode = frame_opcode
+        message += payload
+        if first & 0x80:
+            return opcode, message
+
+
+class MoveServer:
+    """Serves AI moves to many clients over HTTP and WebSocket.
+
+        A request is a JSON object with the position as 'moves' (the 0 based
+        columns played so far, a list or a string of digits) or 'board' (a
+        numpy style board, row 0 at the top), the 'time' budget in seconds,
+        the 'method' ('alpha_beta' or 'expectimax' against a random player)
+        and optionally 'width', 'height' and 'connect' (one of SIZES). The
+        answer holds the move, its score for the side to move, the solver's
+        result if it solved the position, the search depth and nodes.
+
+        POST /move answers one request. GET /ws upgrades to a WebSocket
+        where every text message is a request and every answer echoes the
+        request's 'id'. GET /stats returns the counters.
+
+        Searches run in SearchService worker processes whose players keep
+        their transposition tables from request to request. Recent results
+        are kept in an LRU cache keyed by the position (and its mirror
+        image), the method and the rules; a result found with at least the
+        time asked for answers the request at once. A request for a
+        position already being searched waits for that search when it ends
+        within the request's budget. Requests wait in a bounded queue for a
+        free worker and are refused with 503 while it is full.
+    """
+    def __init__(self, workers=1, cache_size=4096, queue_size=64, max_time=10.0,
+                 table_bytes=16 * 1024 * 1024, weights=DEFAULT_WEIGHTS):
+        self.service = SearchService(workers)
+        self.executor = ThreadPoolExecutor(max_workers=len(self.service.workers))
+        self.cache_size = cache_size
+        self.max_time = max_time
+        self.table_bytes = table_bytes
+        self.weights = weights
+        # (rules, method, canonical key) -> (move of the canonical
+        # orientation, answer, time budget)
+        self.cache = OrderedDict()
+        # the same keys -> (future of the search, time it will be done by)
+        self.in_flight = {}
+        self.queue = asyncio.Queue(queue_size)
+        self.registered = set()
+        self.stats = {'requests': 0, 'cache_hits': 0, 'shared': 0, 'searches': 0,
+                      'rejected': 0, 'errors': 0, 'timeouts': 0}
+
+    def parse(self, request):
+        """Returns (position, method, time budget) of a request, raises RequestError if it is invalid"""
+        if not isinstance(request, dict):
+            raise RequestError('A request must be a JSON object')
+        try:
+            size = (int(request.get('width', 7)), int(request.get('height', 6)),
+                    int(request.get('connect', 4)))
+            budget = min(float(request.get('time', 1.0)), self.max_time)
+        except (TypeError, ValueError) as e:
+            raise RequestError(str(e))
+        if size not in SIZES:
+            raise RequestError('width, height and connect must be one of {}'.format(
+                ', '.join('{}x{} connect {}'.format(*size) for size in sorted(SIZES))))
+        rules = Rules.get(*size)
+        if not budget > 0:
+            raise RequestError('time must be positive')
+        method = request.get('method', 'alpha_beta')
+        if method not in METHODS:
+            raise RequestError('method must be one of {}'.format(', '.join(METHODS)))
+
+        if 'board' in request:
+            import numpy as np
+
+            try:
+                board = np.array(request['board'])
+                valid = (board.shape == (rules.height, rules.width) and
+                         bool(np.isin(board, (0, 1, 2)).all()))
+            except (TypeError, ValueError):
+                valid = False
+            if not valid:
+                raise RequestError('board must be {} rows of {} cells of 0, 1 or 2'.format(
+                    rules.height, rules.width))
+            position = Bitboard.from_array(board.astype(np.uint8), rules)
+            discs = [int((board == num).sum()) for num in (1, 2)]
+            if position.moves != sum(discs) or discs[0] - discs[1] not in (0, 1):
+                raise RequestError('board is not a position of a game')
+        else:
+            position = Bitboard(rules)
+            moves = request.get('moves', [])
+            if not isinstance(moves, (list, str)):
+                raise RequestError('moves must be a list of column numbers')
+            for col in moves:
+                if position.is_win(3 - position.next_player()):
+                    raise RequestError('moves go on after the game was won')
+                try:
+                    col = int(col)
+                except (TypeError, ValueError):
+                    raise RequestError('moves must be column numbers')
+                if not (0 <= col < rules.width and position.can_play(col)):
+                    raise RequestError('column {} can not be played'.format(col))
+                position.play(col, position.next_player())
+        if position.is_win(1) or position.is_win(2) or not position.valid_moves():
+            raise RequestError('the game is over')
+        return position, method, budget
+
+    def answer(self, request):
+        """Returns a future of the answer to a request, a dict ready to send as JSON"""
+        started = time.time()
+        self.stats['requests'] += 1
+        position, method, budget = self.parse(request)
+        canonical, mirrored = position.canonical_key()
+        key = (position.rules, method, canonical)
+        last = position.rules.width - 1
+
+        def finish(move, answer, **flags):
+            answer = dict(answer, move=last - move if mirrored else move,
+                          elapsed=time.time() - started, **flags)
+            if 'id' in request:
+                answer['id'] = request['id']
+            return answer
+
+        cached = self.cache.get(key)
+        if cached is not None and cached[2] >= budget:
+            self.cache.move_to_end(key)
+            self.stats['cache_hits'] += 1
+            done = asyncio.get_running_loop().create_future()
+            done.set_result(finish(cached[0], cached[1], cached=True, shared=False))
+            return done
+
+        flight = self.in_flight.get(key)
+        if flight is not None and flight[1] <= started + budget:
+            self.stats['shared'] += 1
+            search = flight[0]
+            shared = True
+        else:
+            search = asyncio.get_running_loop().create_future()
+            try:
+                self.queue.put_nowait((position, method, budget, search))
+            except asyncio.QueueFull:
+                self.stats['rejected'] += 1
+                raise RequestError('all workers are busy, try again later', 503)
+            self.in_flight[key] = (search, started + budget)
+            search.add_done_callback(lambda future: self.searched(key, budget, future))
+            shared = False
+
+        async def wait():
+            move, answer = await asyncio.shield(search)
+            return finish(move, answer, cached=False, shared=shared)
+        return asyncio.ensure_future(wait())
+
+    def searched(self, key, budget, future):
+        """Moves a finished search from the in flight table to the cache"""
+        if self.in_flight.get(key, (None,))[0] is future:
+            del self.in_flight[key]
+        if future.cancelled() or future.exception() is not None:
+            return
+        self.cache[key] = future.result() + (budget,)
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    async def dispatch(self, index):
+        """Feeds queued searches to worker index, one at a time"""
+        loop = asyncio.get_running_loop()
+        while True:
+            position, method, budget, search = await self.queue.get()
+            try:
+                result = await loop.run_in_executor(self.executor, self.search, index,
+                                                    position, method, budget)
+            except Exception as e:
+                self.stats['errors'] += 1
+                search.set_exception(RequestError('search failed: {}'.format(e), 503))
+                continue
+            if result.timed_out:
+                # the worker was restarted, any legal move beats no answer
+                self.stats['timeouts'] += 1
+                move = position.valid_moves()[0]
+            else:
+                move = int(result.move)
+            canonical, mirrored = position.canonical_key()
+            if mirrored:
+                move = position.rules.width - 1 - move
+            search.set_result((move, {'score': result.score, 'solved': result.solved,
+                                      'depth': result.depth, 'nodes': result.nodes}))
+
+    def search(self, index, position, method, budget):
+        """Runs in the executor: searches position in worker index and returns the SearchResult"""
+        self.stats['searches'] += 1
+        player_number = position.next_player()
+        key = (index, position.rules, player_number)
+        if key not in self.registered:
+            player = AIPlayer(player_number, budget, table_bytes=self.table_bytes,
+                              rules=position.rules, weights=self.weights)
+            self.service.register(key, player, index)
+            self.registered.add(key)
+        return self.service.submit(key, position, METHODS[method], budget).result()
+
+    def status(self):
+        return dict(self.stats, queued=self.queue.qsize(), in_flight=len(self.in_flight),
+                    cached=len(self.cache), workers=len(self.service.workers))
+
+    async def handle_connection(self, reader, writer):
+        """Serves HTTP requests on a connection until it closes or upgrades to a WebSocket"""
+        try:
+            while True:
+                try:
+                    message = await read_http_message(reader)
+                except RequestError as e:
+                    writer.write(http_response(e.status, {'error': str(e)},
+                                               [('Connection', 'close')]))
+                    break
+                if message is None:
+                    break
+                (method, path, version), headers, body = message
+                if path == '/ws' and headers.get('upgrade', '').lower() == 'websocket':
+                    writer.write(http_response(101, headers=[
+                        ('Upgrade', 'websocket'), ('Connection', 'Upgrade'),
+                        ('Sec-WebSocket-Accept',
+                         websocket_accept(headers.get('sec-websocket-key', '')))]))
+                    await self.handle_websocket(reader, writer)
+                    break
+                status, payload, extra = await self.handle_http(method, path, body)
+                closing = headers.get('connection', '').lower() == 'close'
+                if closing:
+                    extra.append(('Connection', 'close'))
+                writer.write(http_response(status, payload, extra))
+                await writer.drain()
+                if closing:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def handle_http(self, method, path, body):
+        """Returns (status, payload, headers) for an HTTP request"""
+        if path == '/stats' and method == 'GET':
+            return 200, self.status(), []
+        if path != '/move' or method != 'POST':
+            return 404, {'error': 'POST /move, GET /stats or GET /ws'}, []
+        try:
+            request = json.loads(body or b'{}')
+        except ValueError:
+            return 400, {'error': 'the body is not JSON'}, []
+        try:
+            return 200, await self.answer(request), []
+        except RequestError as e:
+            return e.status, {'error': str(e)}, [('Retry-After', '1')] if e.status == 503 else []
+
+    async def handle_websocket(self, reader, writer):
+        """Answers every text message as a request, possibly out of order"""
+        tasks = set()
+
+        async def reply(request):
+            try:
+                answer = await self.answer(request)
+            except RequestError as e:
+                answer = {'error': str(e), 'status': e.status}
+                if isinstance(request, dict) and 'id' in request:
+                    answer['id'] = request['id']
+            if not writer.is_closing():
+                writer.write(encode_frame(TEXT, json.dumps(answer).encode()))
+
+        try:
+            while True:
+                try:
+                    opcode, payload = await read_frame(reader)
+                except RequestError:
+                    writer.write(encode_frame(CLOSE, struct.pack('!H', 1009)))
+                    break
+                if opcode == CLOSE:
+                    writer.write(encode_frame(CLOSE, payload[:2]))
+                    break
+                if opcode == PING:
+                    writer.write(encode_frame(PONG, payload))
+                elif opcode == TEXT:
+                    try:
+                        request = json.loads(payload)
+                    except ValueError:
+                        writer.write(encode_frame(TEXT, json.dumps(
+                            {'error': 'the message is not JSON', 'status': 400}).encode()))
+                        continue
+                    task = asyncio.ensure_future(reply(request))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+                await writer.drain()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def serve(self, host='127.0.0.1', port=8765):
+        """Serves until cancelled"""
+        dispatchers = [asyncio.ensure_future(self.dispatch(index))
+                       for index in range(len(self.service.workers))]
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            for dispatcher in dispatchers:
+                dispatcher.cancel()
+
+    def close(self):
+        self.service.close()
+        self.executor.shutdown(wait=False)
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description='Serves AI moves over HTTP and WebSocket')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Search processes')
+    parser.add_argument('--cache-size', type=int, default=4096,
+                        help='Search results kept in the LRU cache')
+    parser.add_argument('--queue-size', type=int, default=64,
+                        help='Searches that may wait for a worker before requests are refused')
+    parser.add_argument('--max-time', type=float, default=10.0,
+                        help='Largest time budget a request may ask for, in seconds')
+    parser.add_argument('--table-bytes', type=int, default=16 * 1024 * 1024,
+                        help='Transposition table size of every worker player')
+    parser.add_argument('--weights', metavar='JSON',
+                        help='Evaluation weights, as written by Tuning.py')
+    args = parser.parse_args()
+
+    server = MoveServer(args.workers, args.cache_size, args.queue_size, args.max_time,
+                        args.table_bytes,
+                        Weights.load(args.weights) if args.weights else DEFAULT_WEIGHTS)
+    print('Serving on http://{}:{}'.format(args.host, args.port))
+    try:
+        asyncio.run(server.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
@@ -0,0 +1,170 @@
+import argparse
+import mmap
+import os
+import struct
+import time
+
+from Bitboard import Bitboard, WIDTH
+from Evaluator import ThreatEvaluator
+from MoveOrdering import CENTER_ORDER
+from Rules import STANDARD
+
+DEFAULT_BOOK = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'opening_book.bin')
+
+# File layout, all little endian:
+#   header  magic, version, plies covered, search depth, record count
+#   records sorted by key: canonical unique key, score, best move, padding
+MAGIC = b'C4BK'
+VERSION = 1
+HEADER = struct.Struct('<4sHHHxxI')
+RECORD = struct.Struct('<QhBx')
+
+
+class OpeningBook:
+    """Read-only opening book memory-mapped from a file made by build().
+
+        Positions are stored once per mirror pair under the smaller of the
+        two unique keys, so lookups mirror the stored move back when the
+        position on the board is the mirrored one. Nothing is parsed when
+        the book is opened; a lookup is a binary search over the mapped
+        records.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.plies, self.depth, self.count = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('{} is not a version {} opening book'.format(path, VERSION))
+
+    @classmethod
+    def open(cls, path=DEFAULT_BOOK):
+        """Returns the book at path, or None if there is no book there"""
+        if path and os.path.exists(path):
+            return cls(path)
+        return None
+
+    def __getstate__(self):
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'])
+
+    def _key_at(self, index):
+        return struct.unpack_from('<Q', self.map, HEADER.size + index * RECORD.size)[0]
+
+    def lookup(self, position):
+        """
+        Looks up a Bitboard position
+
+        RETURNS:
+        (move, score) with the 0 based column to play and its search score
+        from player 1's point of view, or None if the position is not in book
+        (the book only holds standard 6x7 connect 4 positions)
+        """
+        if position.moves > self.plies or position.rules is not STANDARD:
+            return None
+        key, mirrored = position.canonical_key()
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key_at(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == self.count or self._key_at(lo) != key:
+            return None
+        key, score, move = RECORD.unpack_from(self.map, HEADER.size + lo * RECORD.size)
+        return (WIDTH - 1 - move if mirrored else move), score
+
+    def close(self):
+        self.map.close()
+
+
+def book_positions(plies):
+    """Returns the move lists reaching every canonical position up to plies, won games excluded"""
+    seen = set()
+    found = []
+
+    def walk(position, moves):
+        key, mirrored = position.canonical_key()
+        if key in seen:
+            return
+        seen.add(key)
+        found.append(list(moves))
+        if position.moves == plies:
+            return
+        player = position.next_player()
+        for col in position.valid_moves():
+            position.play(col, player)
+            if not position.is_win(player):
+                moves.append(col)
+                walk(position, moves)
+                moves.pop()
+            position.undo()
+
+    walk(Bitboard(), [])
+    return found
+
+
+def _solve_position(args):
+    """Searches one book position to a fixed depth, returns (key, score, move)"""
+    # imported here because Player imports this module for AIPlayer.book
+    from Player import AIPlayer
+
+    moves, depth = args
+    position = Bitboard.from_moves(moves)
+    key, mirrored = position.canonical_key()
+    if mirrored:
+        position = Bitboard.from_moves([WIDTH - 1 - col for col in moves])
+    player = position.next_player()
+    for col in CENTER_ORDER:
+        if position.can_play(col) and position.wins_after(col, player):
+            return key, 50 if player == 1 else -50, col
+
+    searcher = AIPlayer(player, 1e9, table_bytes=1 << 22, book_path=None)
+    searcher.start_search()
+    searcher.root_moves = position.moves
+    position.attach(ThreatEvaluator(position.masks))
+    order = searcher.ordering.order(position, 0, player)
+    scores = searcher.search_root(position, order, depth, player)
+    best = max(scores.values()) if player == 1 else min(scores.values())
+    # ties go to the most central column so the book is deterministic
+    move = [col for col in CENTER_ORDER if scores.get(col) == best][0]
+    return key, best, move
+
+
+def build(path, plies, depth, workers=None):
+    """
+    Precomputes the opening book offline and writes it to path
+
+    INPUTS:
+    plies   - every position with at most this many discs is included
+    depth   - alpha-beta depth each position is searched to
+    workers - processes to search with, one per cpu by default
+    """
+    import multiprocessing as mp
+
+    tasks = [(moves, depth) for moves in book_positions(plies)]
+    with mp.Pool(workers) as pool:
+        records = sorted(pool.imap_unordered(_solve_position, tasks, chunksize=4))
+    with open(path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, plies, depth, len(records)))
+        for key, score, move in records:
+            f.write(RECORD.pack(key, score, move))
+    return len(records)
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description='Builds the opening book offline')
+    parser.add_argument('--plies', type=int, default=4,
+                        help='Include every position with up to this many discs')
+    parser.add_argument('--depth', type=int, default=9,
+                        help='Search depth for each book position')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--out', default=DEFAULT_BOOK)
+    args = parser.parse_args()
+
+    started = time.time()
+    count = build(args.out, args.plies, args.depth, args.workers)
+    print('Wrote {} positions to {} in {:.1f}s'.format(count, args.out, time.time() - started))
@@ -0,0 +1,309 @@
+import argparse
+import json
+import multiprocessing as mp
+import random
+import time
+
+from Bitboard import Bitboard
+from Evaluator import DEFAULT_WEIGHTS, make_evaluator
+from MoveOrdering import MoveOrderer
+from Player import AIPlayer, SearchTimeout, SCORE_LIMIT
+from Rules import STANDARD
+from Telemetry import instrumented
+from Threats import columns
+from TranspositionTable import TranspositionTable
+
+# Positions used by the scaling benchmark, as 0 based column sequences
+BENCHMARK_POSITIONS = {
+    'opening': '3',
+    'early': '3324',
+    'middle': '332415',
+    'late': '3324150226',
+}
+
+# Seconds RootSplitPlayer waits on its pool before it checks stop_event again
+STOP_POLL = 0.05
+
+# searcher kept by each process of the root splitting pool
+_root_player = None
+
+
+def _init_root_worker(table_bytes, rules, weights, stop_event):
+    global _root_player
+    _root_player = AIPlayer(1, table_bytes=table_bytes, rules=rules, weights=weights)
+    _root_player.stop_event = stop_event
+
+
+def _search_root_move(args):
+    """Searches one root move in a pool process, returns (col, value, nodes)"""
+    board, col, depth, deadline = args
+    searcher = _root_player
+    position = Bitboard.from_board(board, searcher.rules)
+    position.attach(make_evaluator(position.masks, position.rules, searcher.weights))
+    player = position.next_player()
+    searcher.nodes = 0
+    searcher.deadline = deadline
+    searcher.root_moves = position.moves
+    position.play(col, player)
+    try:
+        value = searcher.minimax(position, depth, -SCORE_LIMIT, SCORE_LIMIT, 3 - player)
+    except SearchTimeout:
+        value = None
+    return col, value, searcher.nodes
+
+
+def _smp_helper(index, buffers, table_bytes, conn, stop_event, rules, weights):
+    """
+    Helper process for Lazy SMP. Runs the same iterative deepening search as
+    the main process on every position it is sent, writing into the shared
+    transposition table, until the main search sets stop_event.
+    """
+    # a different static order for each helper makes them reach different
+    # parts of the tree first, so their table entries help each other
+    order = list(rules.center_order)
+    for i in range(index % (rules.width - 1)):
+        order[i + 1], order[i] = order[i], order[i + 1]
+    searcher = AIPlayer(1, table=TranspositionTable(table_bytes, buffers),
+                        ordering=MoveOrderer(static_order=order, rules=rules), rules=rules,
+                        weights=weights)
+    searcher.stop_event = stop_event
+    while True:
+        try:
+            request = conn.recv()
+        except EOFError:
+            break
+        if request is None:
+            break
+        board, max_time = request
+        searcher.max_time = max_time
+        searcher.get_alpha_beta_move(board)
+        conn.send((searcher.depth_reached, searcher.nodes))
+
+
+class RootSplitPlayer(AIPlayer):
+    """AIPlayer that searches the root moves of each iteration in parallel.
+
+        The steps before the search (win in one, opening book, threats and
+        endgame solver) are AIPlayer's. Every root move is then sent to a
+        process pool with a full window, so the scores (and the move chosen)
+        are the same as the single process search. The pool is started on
+        the first move that is searched, so the player can be sent to a
+        SearchService worker before that.
+    """
+    def __init__(self, player_number, max_time = 5, workers = 2,
+                 table_bytes = 16 * 1024 * 1024, rules = STANDARD, weights = DEFAULT_WEIGHTS):
+        super().__init__(player_number, max_time, table_bytes=1 << 16, rules=rules,
+                         weights=weights)
+        self.workers = workers
+        self.worker_table_bytes = table_bytes
+        self.pool = None
+        # shared with the pool processes, set to stop their searches when
+        # stop_event is set. It is made with the pool.
+        self.pool_stop = None
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['pool'] = None
+        state['pool_stop'] = None
+        return state
+
+    def stopped(self):
+        """Returns True if whoever runs the player has set stop_event"""
+        return self.stop_event is not None and self.stop_event.is_set()
+
+    @instrumented
+    def get_alpha_beta_move(self, board):
+        position = Bitboard.from_board(board, self.rules)
+        player = position.next_player()
+        sign = 1 if player == 1 else -1
+        self.score = None
+        self.solved = None
+        self.start_search()
+        move, threats = self.move_before_search(position)
+        if move is not None:
+            return move
+        if self.pool is None:
+            self.pool_stop = mp.Event()
+            self.pool = mp.Pool(self.workers, _init_root_worker,
+                                (self.worker_table_bytes, self.rules, self.weights,
+                                 self.pool_stop))
+        self.pool_stop.clear()
+        safe = columns(threats.safe, self.rules)
+        order = self.unique_root_moves(position,
+                                       [col for col in self.rules.center_order if col in safe])
+        bestCols = order[:1]
+        empty = self.rules.cells - position.moves
+        for depth in range(1, max(1, min(self.max_depth, empty - 1)) + 1):
+            started = time.time()
+            tasks = [(board, col, depth, self.deadline) for col in order]
+            pending = self.pool.map_async(_search_root_move, tasks, chunksize=1)
+            # waited on in slices so a stop is seen while the pool searches
+            while not pending.ready() and not self.stopped() \
+                    and time.time() < self.deadline + 1:
+                pending.wait(STOP_POLL)
+            if not pending.ready():
+                if self.stopped():
+                    # the workers give up within a few nodes, so the pool is
+                    # free again for the next move
+                    self.pool_stop.set()
+                    pending.wait(1)
+                break
+            results = pending.get()
+            self.nodes += sum(nodes for col, value, nodes in results)
+            if any(value is None for col, value, nodes in results):
+                break
+            self.depth_reached = depth
+            self.iteration_nodes.append(sum(nodes for col, value, nodes in results))
+
+            scores = {col: value for col, value, nodes in results}
+            self.add_mirrored_moves(position, safe, scores)
+            best = max(scores.values()) if player == 1 else min(scores.values())
+            bestCols = [col for col in safe if scores[col] == best]
+            self.score = sign * best
+            order = sorted(order, key=lambda col: scores[col], reverse=(player == 1))
+            if self.progress is not None:
+                self.progress(depth, bestCols[0], self.nodes)
+
+            if time.time() + (time.time() - started) > self.deadline:
+                break
+
+        return bestCols[random.randint(0, len(bestCols) - 1)]
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
+
+
+class LazySMPPlayer(AIPlayer):
+    """AIPlayer that runs Lazy SMP: helper processes search the same position
+        alongside the main search and share its transposition table through
+        shared memory. The move comes from the main search, which finds more
+        of its work already in the table; the helpers are stopped as soon as
+        it finishes.
+    """
+    def __init__(self, player_number, max_time = 5, workers = 2,
+                 table_bytes = 16 * 1024 * 1024, rules = STANDARD, weights = DEFAULT_WEIGHTS):
+        # the shared table replaces this one when the helpers start
+        super().__init__(player_number, max_time,
+                         table_bytes=table_bytes if workers < 2 else 1 << 16, rules=rules,
+                         weights=weights)
+        self.workers = workers
+        self.shared_table_bytes = table_bytes
+        self.helpers = []
+        self.helper_nodes = 0
+        # set to stop the helpers once the main search is done. It is not
+        # stop_event, which is left for whoever runs the player (a
+        # SearchService worker) to stop the main search with.
+        self.helper_stop = None
+
+    def __getstate__(self):
+        if self.helpers:
+            raise TypeError('LazySMPPlayer can not be pickled once its helpers are running')
+        return dict(self.__dict__)
+
+    def start_helpers(self):
+        buffers = TranspositionTable.shared_buffers(self.shared_table_bytes)
+        self.table = TranspositionTable(self.shared_table_bytes, buffers)
+        self.helper_stop = mp.Event()
+        for index in range(1, self.workers):
+            conn, child_conn = mp.Pipe()
+            process = mp.Process(target=_smp_helper, daemon=True,
+                                 args=(index, buffers, self.shared_table_bytes,
+                                       child_conn, self.helper_stop, self.rules,
+                                       self.weights))
+            process.start()
+            self.helpers.append((process, conn))
+
+    def get_alpha_beta_move(self, board):
+        if self.workers > 1 and not self.helpers:
+            self.start_helpers()
+        if self.helpers:
+            self.helper_stop.clear()
+        for process, conn in self.helpers:
+            conn.send((board, self.max_time))
+        move = super().get_alpha_beta_move(board)
+        self.helper_nodes = 0
+        if self.helpers:
+            self.helper_stop.set()
+            for process, conn in self.helpers:
+                depth, nodes = conn.recv()
+                self.helper_nodes += nodes
+        return move
+
+    def close(self):
+        for process, conn in self.helpers:
+            conn.send(None)
+            process.join(1)
+        self.helpers = []
+
+
+def benchmark(max_workers, depth, modes=('root', 'smp')):
+    """
+    Measures time-to-depth and nodes/sec from 1 to max_workers processes
+
+    INPUTS:
+    max_workers - the largest number of processes to try
+    depth       - the depth every position is searched to
+    modes       - which of 'root' (RootSplitPlayer) and 'smp' (LazySMPPlayer)
+                  to run
+
+    RETURNS:
+    A list of dicts, one per (mode, workers), with the total time to reach
+    depth over BENCHMARK_POSITIONS (searched in turn by one player, so
+    starting its processes is not counted), the nodes searched, nodes/sec and the
+    speedup over one process
+    """
+    classes = {'root': RootSplitPlayer, 'smp': LazySMPPlayer}
+    rows = []
+    for mode in modes:
+        baseline = None
+        for workers in range(1, max_workers + 1):
+            player = classes[mode](1, max_time=1e9, workers=workers)
+            # an untimed shallow search starts the worker processes, so
+            # only the searches are timed
+            player.max_depth = 1
+            player.get_alpha_beta_move(Bitboard.from_moves(BENCHMARK_POSITIONS['late']).to_array())
+            player.max_depth = depth
+            elapsed = 0.0
+            nodes = 0
+            for moves in BENCHMARK_POSITIONS.values():
+                board = Bitboard.from_moves(moves).to_array()
+                started = time.time()
+                random.seed(0)
+                player.get_alpha_beta_move(board)
+                elapsed += time.time() - started
+                nodes += player.nodes + getattr(player, 'helper_nodes', 0)
+            player.close()
+            if baseline is None:
+                baseline = elapsed
+            rows.append({'mode': mode,
+                         'workers': workers,
+                         'depth': depth,
+                         'time_to_depth': elapsed,
+                         'nodes': nodes,
+                         'nodes_per_sec': nodes / elapsed if elapsed else 0.0,
+                         'speedup': baseline / elapsed if elapsed else 0.0})
+    return rows
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description='Parallel search scaling benchmark')
+    parser.add_argument('--workers', type=int, default=mp.cpu_count(),
+                        help='Largest number of processes to measure')
+    parser.add_argument('--depth', type=int, default=7,
+                        help='Depth to search every position to')
+    parser.add_argument('--mode', choices=['root', 'smp', 'both'], default='both')
+    parser.add_argument('--json', help='Also write the results to this file')
+    args = parser.parse_args()
+
+    modes = ('root', 'smp') if args.mode == 'both' else (args.mode,)
+    rows = benchmark(args.workers, args.depth, modes)
+    print('{:>5} {:>8} {:>14} {:>12} {:>8}'.format('mode', 'workers', 'time-to-depth',
+                                                  'nodes/sec', 'speedup'))
+    for row in rows:
+        print('{mode:>5} {workers:>8} {time_to_depth:>13.3f}s {nodes_per_sec:>12.0f} '
+              '{speedup:>7.2f}x'.format(**row))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(rows, f, indent=2)
@@ -1,49 +1,142 @@
-import numpy as np
 import random
 import time
 
+from Bitboard import Bitboard
+from Evaluator import DEFAULT_WEIGHTS, batch_evaluate, make_evaluator
+import SpeedProfile
+from Rules import STANDARD
+from TranspositionTable import TranspositionTable, EXACT, LOWER, UPPER
+from MoveOrdering import MoveOrderer
+from OpeningBook import OpeningBook, DEFAULT_BOOK
+from Solver import Solver, DEFAULT_CACHE, describe
+from Threats import ThreatSearch, analyze, columns
+from Telemetry import instrumented
+
+# Share of max_time the search may use, leaving the rest as a margin for the
+# process that runs the turn to start up and hand back the move
+TIME_FRACTION = 0.8
+# Share of the time left the endgame solver may use before the normal search
+# takes over for the rest of the move
+SOLVE_SHARE = 0.5
+# Bound on every search score, the alpha-beta window starts at -SCORE_LIMIT,
+# SCORE_LIMIT so no evaluation may reach it (see Weights.bound and
+# Rules.eval_bound for the largest evaluation)
+SCORE_LIMIT = 1000
+# Margin kept by the chance node cutoffs so a pruned value is below (or
+# above) the window even after floating point rounding of the averages
+CHANCE_SLACK = 1e-9
+
+
+class SearchTimeout(Exception):
+    """Raised inside a search when the deadline for the current move passes"""
+
+
 class AIPlayer:
-    def __init__(self, player_number, max_time = 5):
+    # the standard board unless the constructor is given other rules
+    rules = STANDARD
+    weights = DEFAULT_WEIGHTS
+
+    def __init__(self, player_number, max_time = 5, table_bytes = 16 * 1024 * 1024,
+                 ordering = None, table = None, book_path = DEFAULT_BOOK,
+                 solver_path = DEFAULT_CACHE, rules = STANDARD, weights = DEFAULT_WEIGHTS):
         self.player_number = player_number
         self.type = 'ai'
         self.player_string = 'Player {}:ai'.format(player_number)
-        self.target_depth = self.get_target_depth(max_time)
-
-
-    def get_target_depth(self, max_time):
-        dummy_board = np.zeros([6,7]).astype(np.uint8)
-        total_time = 0
-        for i in range(10):
-            for i in range(6):
-                for j in range(7):
-                    dummy_board[i, j] = random.randint(0,2)
-            start_time = time.time()
-            self.evaluation_function(dummy_board)
-            self.game_completed(1, dummy_board)
-            self.game_completed(2, dummy_board)
-            print(time.time() - start_time)
-            total_time += time.time() - start_time
-        average_time = total_time / 10.0
-        possible_evals = int(float(max_time) / average_time)
-        depth = 0
-        while pow(7, depth) < possible_evals:
-            depth += 1
-        print('PerE: ', average_time)
-        print('PosE: ', possible_evals)
-        print('D:', depth - 1)
-        return depth - 1
-
-
+        self.max_time = max_time
+        # board size and connect length the player searches for
+        self.rules = rules
+        # the Weights of the evaluation and the score of a win, see Tuning
+        if weights.bound(rules) >= SCORE_LIMIT:
+            raise ValueError('Scores with {} can reach {}'.format(weights, SCORE_LIMIT))
+        self.weights = weights
+        self.max_depth = rules.cells
+        self.depth_reached = 0
+        self.nodes = 0
+        self.cutoffs = 0
+        self.iteration_nodes = []
+        self.root_moves = 0
+        self.deadline = None
+        # set from another process to stop the search early
+        self.stop_event = None
+        # called with (depth, move, nodes) after every completed iteration,
+        # the move being the one the search would play at that depth
+        self.progress = None
+        # kept for the whole game so later turns reuse earlier searches
+        self.table = table if table is not None else TranspositionTable(table_bytes)
+        self.ordering = ordering if ordering is not None else MoveOrderer(rules=rules)
+        # memory-mapped, None when there is no book file. The book only
+        # covers the standard board.
+        self.book = OpeningBook.open(book_path) if rules is STANDARD else None
+        # exact endgame search, set to None to switch it off; solver_path
+        # None only skips the solved cache on disk
+        self.solver = Solver(solver_path, rules=rules)
+        # forced wins by threats, tried before every full-width search; set
+        # to None to switch it off
+        self.threat_search = ThreatSearch(rules)
+        # read the machine's solver speed now rather than during a move (it
+        # is measured, once per machine, if it has never been)
+        SpeedProfile.load()
+        # (result, plies) proven by the solver for the last move, or None
+        self.solved = None
+        # score of the last move from the mover's point of view (a search
+        # score, the win score or the book's), None when the solver chose it
+        # or no search depth completed
+        self.score = None
+        # score the last plies with one batch_evaluate call instead of the
+        # incremental evaluator. It pays off in expectimax, which visits every
+        # leaf, but not in alpha-beta, where most leaves are cut off.
+        # Boards too big for int64 masks always use the incremental one.
+        self.batch_expectimax = rules.batchable
+        self.batch_minimax = False
+        # scores the leaves of both batch paths, Telemetry swaps in a wrapper
+        # that counts and times them
+        self.evaluate_batch = batch_evaluate
+        # cut off chance nodes with the bounds on the evaluation (Star1) and
+        # reuse chance node averages of positions seen before in the move
+        self.star_pruning = True
+        self.chance_cache = {}
+        # treat a position and its mirror image as one: the table and the
+        # chance cache are keyed by Bitboard.canonical_hash() and the mirror
+        # images of root moves of a symmetric position are not searched
+        self.symmetry = True
+        # a Telemetry to record every move with, None records nothing
+        self.telemetry = None
+
+    def start_search(self):
+        """Resets the node counters and sets the deadline for this move"""
+        self.nodes = 0
+        self.cutoffs = 0
+        self.iteration_nodes = []
+        self.depth_reached = 0
+        self.deadline = time.time() + self.max_time * TIME_FRACTION
+
+    def effective_branching_factor(self):
+        """Returns nodes(d) / nodes(d-1) for the deepest two completed iterations"""
+        if len(self.iteration_nodes) < 2 or not self.iteration_nodes[-2]:
+            return 0.0
+        return self.iteration_nodes[-1] / self.iteration_nodes[-2]
+
+    def check_deadline(self):
+        """Counts a node and raises SearchTimeout once the deadline is past"""
+        self.nodes += 1
+        if self.nodes & 1023 == 0:
+            if time.time() > self.deadline or (self.stop_event is not None and
+                                               self.stop_event.is_set()):
+                raise SearchTimeout()
+
+    @instrumented
     def get_alpha_beta_move(self, board):
         """
         Given the current state of the board, return the next move based on
         the alpha-beta pruning algorithm
 
-        This will play against either itself or a human player
+        This will play against either itself or a human player. The search is
+        iteratively deepened until the time for the move runs out and the
+        best move of the deepest completed iteration is played.
 
         INPUTS:
-        board - a numpy array containing the state of the board using the
-                following encoding:
+        board - the Bitboard position, or a numpy array containing the state
+                of the board using the following encoding:
                 - the board maintains its same two dimensions
                     - row 0 is the top of the board and so is
                       the last row filled
@@ -54,94 +147,292 @@ class AIPlayer:
         RETURNS:
         The 0 based index of the column that represents the next move
         """
-        moves = 0
-        player = 0
-        maxEval = -1000
-        maxCol = []
-        minCol = []
-        minEval = 1000
-        nPlayer = 0
-        alpha = -1000
-        beta = 1000
+        position = Bitboard.from_board(board, self.rules)
+        position.attach(make_evaluator(position.masks, position.rules, self.weights))
 
         #Find out whose turn it is
-        for col in range(0, 7):
-            for row in range(5, -1, -1):
-                if (board[row][col] != 0):
-                    moves += 1
-        if (moves % 2 == 0):
-            player = 1
-            nPlayer = 2
-        else:
-            player = 2
-            nPlayer = 1
-
-        #print("Player" + str(player))
-        for col in range(0, 7):
-            for row in range(5, -1, -1):
-                if (board[row][col] == 0):
-                    board[row][col] = player
-                    if (self.game_completed(player, board)):
-                        return col
-                    eval = self.minimax(board, self.target_depth, alpha, beta, nPlayer)
-                    board[row][col] = 0
-                    #print ("Col : " + str(col) + " Row : " + str(row) + " Eval : " + str(eval))
-                    if (eval >= maxEval):
-                        if (eval > maxEval):
-                            maxCol.clear()
-                        maxEval = eval
-                        maxCol.append(col)
-                    if (eval <= minEval):
-                        if (eval < minEval):
-                            minCol.clear()
-                        minEval = eval
-                        minCol.append(col)
-                    break
-        #print ("\n")
+        player = position.next_player()
+        sign = 1 if player == 1 else -1
+        self.score = None
+        self.solved = None
+        # before any early return, so a move that is not searched does not
+        # report the counters of the last one
+        self.start_search()
+        move, threats = self.move_before_search(position)
+        if move is not None:
+            return move
+
+        empty = self.rules.cells - position.moves
+        self.ordering.new_search()
+        self.root_moves = position.moves
+        # moves that let the opponent win at once are not searched
+        safe = columns(threats.safe, self.rules)
+        order = self.unique_root_moves(position, [col for col in self.ordering.order(
+            position, 0, player) if col in safe])
+        bestCols = order[:1]
+        for depth in range(1, max(1, min(self.max_depth, empty - 1)) + 1):
+            started = time.time()
+            searched = self.nodes
+            try:
+                scores = self.search_root(position, order, depth, player)
+            except SearchTimeout:
+                break
+            self.depth_reached = depth
+            self.iteration_nodes.append(self.nodes - searched)
+            self.add_mirrored_moves(position, safe, scores)
+
+            # best move of this iteration goes first in the next one
+            best = max(scores.values()) if player == 1 else min(scores.values())
+            bestCols = [col for col in safe if scores[col] == best]
+            self.score = sign * best
+            order = sorted(order, key=lambda col: scores[col], reverse=(player == 1))
+            if self.progress is not None:
+                self.progress(depth, bestCols[0], self.nodes)
+
+            # the next iteration takes longer than this one, skip it if it
+            # can not finish in the time that is left
+            if time.time() + (time.time() - started) > self.deadline:
+                break
+
+        return bestCols[random.randint(0, len(bestCols) - 1)]
+
+    def move_before_search(self, position):
+        """
+        Takes the steps that come before the search, in order: a win in
+        one, the opening book, the moves the threats decide (see
+        threat_move) and the endgame solver. start_search() must have been
+        called for the move.
 
-        if (player == 1):
-            return maxCol[random.randint(0, len(maxCol) - 1)]
-        if (player == 2):
-            return minCol[random.randint(0, len(minCol) - 1)]
+        RETURNS:
+        (column, threats): the 0 based column to play, or None if the
+        position has to be searched, and the ThreatAnalysis of the position
+        """
+        threats = analyze(position)
+        if threats.wins:
+            self.score = self.weights.win
+            return columns(threats.wins, self.rules)[0], threats
+
+        if self.book is not None:
+            entry = self.book.lookup(position)
+            if entry is not None:
+                self.depth_reached = self.book.depth
+                self.score = entry[1] if position.next_player() == 1 else -entry[1]
+                return entry[0], threats
+
+        move = self.threat_move(position, threats)
+        if move is None and self.solver is not None:
+            move = self.solve(position, self.rules.cells - position.moves)
+        if move is not None and self.progress is not None:
+            self.progress(self.depth_reached, move, self.nodes)
+        return move, threats
+
+    def threat_move(self, position, threats):
+        """
+        Decides the move from the threats of the position when they leave
+        no choice: every move but one loses at once, every move loses, or
+        the threat search proves a forced win
+
+        INPUTS:
+        position - the Bitboard to move in
+        threats  - its ThreatAnalysis
 
-    #Recursive alpha beta minimax algorithm
+        RETURNS:
+        The 0 based column to play, or None if the position needs a search
+        """
+        if threats.lost():
+            # the opponent wins next whatever is played, block one of their wins
+            self.score = -self.weights.win
+            self.solved = ('loss', 2)
+            cols = columns(threats.blocks, self.rules) if threats.blocks else position.valid_moves()
+            return [col for col in self.rules.center_order if col in cols][0]
+        if threats.forced():
+            return columns(threats.safe, self.rules)[0]
+        if self.threat_search is None:
+            return None
+        try:
+            line = self.threat_search.find_win(position, self.check_deadline)
+        except SearchTimeout:
+            return None
+        if line is None:
+            return None
+        self.score = self.weights.win
+        self.solved = ('win', line[1])
+        self.depth_reached = line[1]
+        return line[0]
+
+    def unique_root_moves(self, position, moves):
+        """
+        Returns moves without the mirror images of other moves when the
+        position is symmetric, in the same order
+        """
+        if not self.symmetry or not position.is_symmetric():
+            return moves
+        last = position.rules.width - 1
+        return [col for col in moves if col <= last - col]
+
+    def add_mirrored_moves(self, position, moves, scores):
+        """Gives every move in moves left out by unique_root_moves the score of its mirror image"""
+        last = position.rules.width - 1
+        for col in moves:
+            if col not in scores:
+                scores[col] = scores[last - col]
+
+    def solve(self, position, empty):
+        """
+        Runs the exact endgame solver when the position is expected to be
+        solved in SOLVE_SHARE of the time left
+
+        RETURNS:
+        The 0 based column to play, or None if the solver was not run or ran
+        out of time
+        """
+        deadline = self.deadline
+        seconds = (deadline - time.time()) * SOLVE_SHARE
+        if not Solver.solvable(empty, seconds):
+            return None
+        self.deadline = time.time() + seconds
+        try:
+            score, move = self.solver.solve_position(position, self.check_deadline)
+        except SearchTimeout:
+            return None
+        finally:
+            self.deadline = deadline
+        self.solved = describe(score, position.moves, self.rules.cells)
+        self.depth_reached = empty
+        return move
+
+    def search_root(self, position, order, depth, player):
+        """
+        Searches every move in order to the given depth
+
+        Each move after the first is searched with a window just below the
+        best score so far. Scores are integers, so moves that tie the best
+        still get exact values while worse moves can be cut off early.
+
+        RETURNS:
+        A dict mapping each column to its score (an upper bound for player 1
+        or a lower bound for player 2 when the move is worse than the best)
+        """
+        scores = {}
+        best = None
+        for col in order:
+            position.play(col, player)
+            if player == 1:
+                alpha = -SCORE_LIMIT if best is None else best - 1
+                eval = self.minimax(position, depth, alpha, SCORE_LIMIT, 2)
+                if best is None or eval > best:
+                    best = eval
+            else:
+                beta = SCORE_LIMIT if best is None else best + 1
+                eval = self.minimax(position, depth, -SCORE_LIMIT, beta, 1)
+                if best is None or eval < best:
+                    best = eval
+            position.undo()
+            scores[col] = eval
+        return scores
+
+    #Recursive alpha beta minimax algorithm on a Bitboard position
     def minimax(self, board, depth, alpha, beta, player):
+        self.check_deadline()
         if (depth == 0):
-            return self.evaluation_function(board)
+            return board.evaluator.evaluate(1)
+        if (board.is_win(3 - player)):
+            return -self.weights.win if player == 1 else self.weights.win
+
+        # Only entries searched to exactly this depth are used for cutoffs:
+        # the evaluation is not monotone in depth, so reusing a deeper
+        # result would change what a fixed depth search returns
+        # a position and its mirror image share one entry, stored the way
+        # round with the smaller key, so its best move is mirrored to match
+        alphaOrig, betaOrig = alpha, beta
+        ttMove = None
+        key = board.key
+        mirrored = self.symmetry and board.mirror_key < key
+        if mirrored:
+            key = board.mirror_key
+            last = board.rules.width - 1
+        entry = self.table.probe(key)
+        if entry is not None:
+            ttMove = entry[3]
+            if mirrored and ttMove is not None:
+                ttMove = last - ttMove
+            if entry[1] == depth:
+                value, bound = entry[0], entry[2]
+                if bound == EXACT:
+                    return value
+                if bound == LOWER:
+                    alpha = max(alpha, value)
+                else:
+                    beta = min(beta, value)
+                if (beta <= alpha):
+                    return value
+
+        ply = board.moves - self.root_moves
+        bestCol = None
+        moves = self.ordering.order(board, ply, player, ttMove)
+        leaves = None
+        if depth == 1 and self.batch_minimax:
+            leaves = self.leaf_values(board, moves, player)
         if (player == 1):
-            if (self.game_completed(2, board)):
-                return -50
-            maxEval = -1000
-            for col in range(0, 7):
-                for row in range(5, -1, -1):
-                    if (board[row][col] == 0):
-                        board[row][col] = player
-                        eval = self.minimax(board, depth - 1, alpha, beta, 2)
-                        maxEval = max(maxEval, eval)
-                        alpha = max(alpha, eval)
-                        board[row][col] = 0
-                        break
+            maxEval = -SCORE_LIMIT
+            for i, col in enumerate(moves):
+                if leaves is not None:
+                    eval = leaves[i]
+                else:
+                    board.play(col, player)
+                    eval = self.minimax(board, depth - 1, alpha, beta, 2)
+                    board.undo()
+                if eval > maxEval:
+                    maxEval, bestCol = eval, col
+                alpha = max(alpha, eval)
                 if (beta <= alpha):
+                    self.cutoffs += 1
+                    self.ordering.cutoff(col, ply, player, depth)
                     break
-            return maxEval
-        if (player == 2):
-            if (self.game_completed(1, board)):
-                return 50
-            minEval = 1000
-            for col in range(0, 7):
-                for row in range(5, -1, -1):
-                    if (board[row][col] == 0):
-                        board[row][col] = player
-                        eval = self.minimax(board, depth - 1, alpha, beta, 1)
-                        minEval = min(minEval, eval)
-                        beta = min(beta, eval)
-                        board[row][col] = 0
-                        break
+            value = maxEval
+        else:
+            minEval = SCORE_LIMIT
+            for i, col in enumerate(moves):
+                if leaves is not None:
+                    eval = leaves[i]
+                else:
+                    board.play(col, player)
+                    eval = self.minimax(board, depth - 1, alpha, beta, 1)
+                    board.undo()
+                if eval < minEval:
+                    minEval, bestCol = eval, col
+                beta = min(beta, eval)
                 if (beta <= alpha):
+                    self.cutoffs += 1
+                    self.ordering.cutoff(col, ply, player, depth)
                     break
-            return minEval
+            value = minEval
+
+        if value <= alphaOrig:
+            bound = UPPER
+        elif value >= betaOrig:
+            bound = LOWER
+        else:
+            bound = EXACT
+        if mirrored and bestCol is not None:
+            bestCol = last - bestCol
+        self.table.store(key, value, depth, bound, bestCol)
+        return value
+
+    def leaf_values(self, board, moves, player):
+        """Returns the evaluation for player 1 after each of moves, scored in one batch"""
+        masks = []
+        for col in moves:
+            self.check_deadline()
+            bit = 1 << board.heights[col]
+            if player == 1:
+                masks.append((board.masks[1] | bit, board.masks[2]))
+            else:
+                masks.append((board.masks[1], board.masks[2] | bit))
+        return self.evaluate_batch(masks, 1, board.rules, self.weights).tolist()
 
 
+    @instrumented
     def get_expectimax_move(self, board):
         """
         Given the current state of the board, return the next move based on
@@ -151,8 +442,8 @@ class AIPlayer:
         with equal probability
 
         INPUTS:
-        board - a numpy array containing the state of the board using the
-                following encoding:
+        board - the Bitboard position, or a numpy array containing the state
+                of the board using the following encoding:
                 - the board maintains its same two dimensions
                     - row 0 is the top of the board and so is
                       the last row filled
@@ -163,91 +454,205 @@ class AIPlayer:
         RETURNS:
         The 0 based index of the column that represents the next move
         """
-        startTime = time.time()
+        position = Bitboard.from_board(board, self.rules)
+        position.attach(make_evaluator(position.masks, position.rules, self.weights))
+
+        self.start_search()
+        self.chance_cache.clear()
+        self.score = None
+        nextMoves = position.valid_moves()
+        order = self.unique_root_moves(position, nextMoves)
+        col = nextMoves[0]
+        empty = self.rules.cells - position.moves
+        for depth in range(1, min(self.max_depth, empty) + 1):
+            started = time.time()
+            values = {}
+            # only a move scoring above the best so far (and above 0) is
+            # played, so the rest are searched with that as the lower bound.
+            # A move that fails low gets a value strictly below it.
+            alpha = 0
+            try:
+                for move in order:
+                    position.play(move, self.player_number)
+                    values[move] = self.expectimax(False, 0, position, depth, alpha)
+                    position.undo()
+                    if self.star_pruning:
+                        alpha = max(alpha, values[move])
+            except SearchTimeout:
+                break
+            self.depth_reached = depth
+            self.add_mirrored_moves(position, nextMoves, values)
+
+            # ties go to the leftmost column, whatever order was searched
+            col = nextMoves[0]
+            currentBest = 0
+            for move in nextMoves:
+                if values[move] > currentBest:
+                    currentBest = values[move]
+                    col = move
+            self.score = currentBest
+            order = sorted(order, key=lambda move: values[move], reverse=True)
+            if self.progress is not None:
+                self.progress(depth, col, self.nodes)
+
+            if time.time() + (time.time() - started) > self.deadline:
+                break
 
-        def expectimax(is_max, currDepth, board):
-            if currDepth == self.target_depth - 1:
-                total = self.expEval_function(board, self.player_number)
-                return total
-            if is_max:
+        return col
+
+    #Recursive expectimax on a Bitboard position, the opponent moves at random
+    def expectimax(self, is_max, currDepth, board, depth,
+                   alpha = float('-inf'), beta = float('inf')):
+        """
+        Returns the expectimax value of board, exact when it lies between
+        alpha and beta. With star_pruning a value at or below alpha (above
+        beta) may be an upper (lower) bound that is strictly below alpha
+        (above beta), which is all the callers need to know.
+        """
+        self.check_deadline()
+        if currDepth == depth - 1:
+            total = board.evaluator.evaluate(self.player_number)
+            return total
+        if self.batch_expectimax and currDepth >= depth - 3:
+            return self.expectimax_batch(is_max, board, depth - 1 - currDepth)
+        if is_max:
+            maxEval = 0
+            if board.is_win(self.player_number):
+                return self.weights.win
+            for col in board.valid_moves():
+                board.play(col, self.player_number)
+                val = self.expectimax(False, currDepth + 1, board, depth,
+                                      max(alpha, maxEval), beta)
+                if val > maxEval:
+                    maxEval = val
+                board.undo()
+                if self.star_pruning and maxEval > beta:
+                    break
+            return maxEval
+        else:
+            count = 0
+            total = 0
+            enemyPlayer = (1 if self.player_number == 2 else 2)
+            if board.is_win(enemyPlayer):
+                return -self.weights.win
+            if self.star_pruning:
+                return self.chance_star1(currDepth, board, depth, alpha, beta)
+            for col in board.valid_moves():
+                count += 1
+                board.play(col, enemyPlayer)
+                total += self.expectimax(True, currDepth + 1, board, depth)
+                board.undo()
+            return total / count
+
+    def chance_star1(self, currDepth, board, depth, alpha, beta):
+        """
+        Star1 search of a chance node: every child value lies between low
+        and the evaluation bound, so once the children searched so far put the average
+        out of the (alpha, beta) window the rest are skipped. Each child is
+        searched with the narrowest window that can still change that.
+        Exact averages are cached by position and depth left.
+        """
+        hashKey = board.key
+        if self.symmetry and board.mirror_key < hashKey:
+            hashKey = board.mirror_key
+        key = (hashKey, depth - currDepth)
+        cached = self.chance_cache.get(key)
+        if cached is not None:
+            return cached
+        enemyPlayer = 3 - self.player_number
+        bound = self.weights.bound(board.rules)
+        # max nodes never score below 0, leaves can
+        low = 0 if currDepth + 2 < depth else -bound
+        moves = board.valid_moves()
+        count = len(moves)
+        total = 0
+        for i, col in enumerate(moves):
+            rest = count - i - 1
+            childAlpha = alpha * count - total - rest * bound - CHANCE_SLACK
+            childBeta = beta * count - total - rest * low + CHANCE_SLACK
+            if childAlpha >= bound:
+                return (total + (rest + 1) * bound) / count
+            if childBeta <= low:
+                return (total + (rest + 1) * low) / count
+            board.play(col, enemyPlayer)
+            val = self.expectimax(True, currDepth + 1, board, depth, childAlpha, childBeta)
+            board.undo()
+            if val <= childAlpha:
+                return (total + val + rest * bound) / count
+            if val >= childBeta:
+                return (total + val + rest * low) / count
+            total += val
+        self.chance_cache[key] = total / count
+        return total / count
+
+    def expectimax_batch(self, is_max, board, plies):
+        """
+        Returns the same value as expectimax for a node plies (1 or 2) above
+        the leaves, but expands the nodes below it on the masks and scores
+        all of its leaves with a single batch_evaluate call
+        """
+        me = self.player_number
+        enemy = 3 - me
+        rules = board.rules
+        top = rules.top
+        win = self.weights.win
+        connected = board.connected
+        leaves = []
+
+        # a node is a leaf index, a fixed value or (is_max, children)
+        def expand(masks, heights, is_max, plies):
+            mover = me if is_max else enemy
+            children = []
+            for col in range(rules.width):
+                if heights[col] < top[col]:
+                    self.check_deadline()
+                    child = list(masks)
+                    child[mover] |= 1 << heights[col]
+                    if plies == 1:
+                        leaves.append((child[1], child[2]))
+                        children.append(('leaf', len(leaves) - 1))
+                    elif connected(child[enemy if is_max else me]):
+                        children.append(('value', -win if is_max else win))
+                    else:
+                        childHeights = list(heights)
+                        childHeights[col] += 1
+                        children.append(expand(child, childHeights, not is_max, plies - 1))
+            return (is_max, children)
+
+        def resolve(node, values):
+            if node[0] == 'leaf':
+                return values[node[1]]
+            if node[0] == 'value':
+                return node[1]
+            if node[0]:
                 maxEval = 0
-                if self.game_completed(self.player_number, board):
-                    return 50
-                for loc in self.get_next_possible_moves(board):
-                    board[loc[0], loc[1]] = self.player_number
-                    val = expectimax(False, currDepth + 1, board)
+                for child in node[1]:
+                    val = resolve(child, values)
                     if val > maxEval:
                         maxEval = val
-                    board[loc[0], loc[1]] = 0
                 return maxEval
-            else:
-                count = 0
-                total = 0
-                enemyPlayer = (1 if self.player_number == 2 else 2)
-                if self.game_completed(enemyPlayer, board):
-                    return -50
-                for loc in self.get_next_possible_moves(board):
-                    count += 1
-                    board[loc[0], loc[1]] = enemyPlayer
-                    total += expectimax(True, currDepth + 1, board)
-                    board[loc[0], loc[1]] = 0
-                return total / count
-        
-        nextMoves = self.get_next_possible_moves(board)
-        col = nextMoves[0][1]
-        currentBest = 0
-        for move in nextMoves:
-            board[move[0], move[1]] = self.player_number
-            val = expectimax(False, 0, board)
-            if val > currentBest:
-                currentBest = val
-                col = move[1]
-            board[move[0], move[1]] = 0
+            total = 0
+            for child in node[1]:
+                total += resolve(child, values)
+            return total / len(node[1])
 
-        return col
+        if board.is_win(me if is_max else enemy):
+            return win if is_max else -win
+        tree = expand(board.masks, board.heights, is_max, plies)
+        return resolve(tree, self.evaluate_batch(leaves, me, rules, self.weights).tolist())
 
     def game_completed(self, player_num, board):
         """Returns True if player_num is in a winning position on the gameboard"""
-        player_win_str = '{0}{0}{0}{0}'.format(player_num)
-        to_str = lambda a: ''.join(a.astype(str))
-
-        def check_horizontal(b):
-            for row in b:
-                if player_win_str in to_str(row):
-                    return True
-            return False
-
-        def check_verticle(b):
-            return check_horizontal(b.T)
-
-        def check_diagonal(b):
-            for op in [None, np.fliplr]:
-                op_board = op(b) if op else b
-
-                root_diag = np.diagonal(op_board, offset=0).astype(np.int)
-                if player_win_str in to_str(root_diag):
-                    return True
-
-                for i in range(1, b.shape[1]-3):
-                    for offset in [i, -i]:
-                        diag = np.diagonal(op_board, offset=offset)
-                        diag = to_str(diag.astype(np.int))
-                        if player_win_str in diag:
-                            return True
-
-            return False
-
-        return (check_horizontal(board) or
-                check_verticle(board) or
-                check_diagonal(board))
+        return Bitboard.from_board(board, self.rules).is_win(player_num)
 
 
     def check_three(self, player_num, board):
         """Returns the number of potential connect 4s possible for a given player"""
-        threeStrings = ['0{0}{0}{0}'.format(player_num),
-        '{0}0{0}{0}'.format(player_num),
-        '{0}{0}0{0}'.format(player_num),
-        '{0}{0}{0}0'.format(player_num)]
+        import numpy as np
+
+        connect = self.rules.connect
+        threeStrings = [str(player_num) * empty + '0' + str(player_num) * (connect - 1 - empty)
+                        for empty in range(connect)]
         to_str = lambda a: ''.join(a.astype(str))
 
         def check_horizontal(b):
@@ -266,18 +671,13 @@ class AIPlayer:
             for op in [None, np.fliplr]:
                 op_board = op(b) if op else b
 
-                root_diag = np.diagonal(op_board, offset=0).astype(np.int)
-                for threeStr in threeStrings:
-                    if threeStr in to_str(root_diag):
-                        threeCount += 1
-
-                for i in range(1, b.shape[1]-3):
-                    for offset in [i, -i]:
-                        diag = np.diagonal(op_board, offset=offset)
-                        diag = to_str(diag.astype(np.int))
-                        for threeStr in threeStrings:
-                            if threeStr in diag:
-                                threeCount += 1
+                # every diagonal at least connect cells long
+                for offset in range(connect - b.shape[0], b.shape[1] - connect + 1):
+                    diag = np.diagonal(op_board, offset=offset)
+                    diag = to_str(diag.astype(int))
+                    for threeStr in threeStrings:
+                        if threeStr in diag:
+                            threeCount += 1
 
             return threeCount
 
@@ -320,18 +720,16 @@ class AIPlayer:
 
 
     def get_next_possible_moves(self, board):
-        possiblePlaces = []
-        for i in range(len(board[0])):
-            for j in range(len(board) - 1, -1, -1):
-                if board[j, i] == 0:
-                    possiblePlaces.append((j, i))
-                    break
-        return possiblePlaces
+        """Returns the (numpy row, column) of the lowest empty cell of every open column"""
+        position = Bitboard.from_board(board, self.rules)
+        rules = position.rules
+        return [(rules.height - 1 - (position.heights[col] - rules.bottom[col]), col)
+                for col in position.valid_moves()]
 
     def valid_location(self, x, y):
-        if x > 5 or x < 0:
+        if x >= self.rules.height or x < 0:
             return False
-        if y > 6 or y < 0:
+        if y >= self.rules.width or y < 0:
             return False
         return True
 
@@ -340,10 +738,12 @@ class AIPlayer:
 
 
 class RandomPlayer:
-    def __init__(self, player_number):
+    def __init__(self, player_number, rules = STANDARD):
         self.player_number = player_number
         self.type = 'random'
         self.player_string = 'Player {}:random'.format(player_number)
+        # board size the numpy boards it is given are read as
+        self.rules = rules
 
     def get_move(self, board):
         """
@@ -351,8 +751,8 @@ class RandomPlayer:
         valid moves.
 
         INPUTS:
-        board - a numpy array containing the state of the board using the
-                following encoding:
+        board - the Bitboard position, or a numpy array containing the state
+                of the board using the following encoding:
                 - the board maintains its same two dimensions
                     - row 0 is the top of the board and so is
                       the last row filled
@@ -363,27 +763,28 @@ class RandomPlayer:
         RETURNS:
         The 0 based index of the column that represents the next move
         """
-        valid_cols = []
-        for col in range(board.shape[1]):
-            if 0 in board[:,col]:
-                valid_cols.append(col)
+        import numpy as np
+
+        valid_cols = Bitboard.from_board(board, self.rules).valid_moves()
 
         return np.random.choice(valid_cols)
 
 
 class HumanPlayer:
-    def __init__(self, player_number):
+    def __init__(self, player_number, rules = STANDARD):
         self.player_number = player_number
         self.type = 'human'
         self.player_string = 'Player {}:human'.format(player_number)
+        # board size the numpy boards it is given are read as
+        self.rules = rules
 
     def get_move(self, board):
         """
         Given the current board state returns the human input for next move
 
         INPUTS:
-        board - a numpy array containing the state of the board using the
-                following encoding:
+        board - the Bitboard position, or a numpy array containing the state
+                of the board using the following encoding:
                 - the board maintains its same two dimensions
                     - row 0 is the top of the board and so is
                       the last row filled
@@ -395,10 +796,7 @@ class HumanPlayer:
         The 0 based index of the column that represents the next move
         """
 
-        valid_cols = []
-        for i, col in enumerate(board.T):
-            if 0 in col:
-                valid_cols.append(i)
+        valid_cols = Bitboard.from_board(board, self.rules).valid_moves()
 
         move = int(input('Enter your move: '))
 
@@ -0,0 +1,243 @@
+import random
+from functools import cached_property
+
+
+def _make_connected(shifts, connect):
+    """Returns a function telling whether a mask holds connect bits in a row"""
+    if connect == 4:
+        def connected(mask):
+            for shift in shifts:
+                pairs = mask & (mask >> shift)
+                if pairs & (pairs >> (2 * shift)):
+                    return True
+            return False
+    else:
+        def connected(mask):
+            for shift in shifts:
+                run = mask
+                for step in range(1, connect):
+                    run &= mask >> (step * shift)
+                if run:
+                    return True
+            return False
+    return connected
+
+
+def _make_winning_cells(shifts, connect, board_mask):
+    """Returns a function giving the empty cells that would complete a line for a mask"""
+    if connect == 4:
+        vertical, lines = shifts[0], shifts[1:]
+
+        def winning_cells(current, mask):
+            cells = (current << vertical) & (current << 2 * vertical) & (current << 3 * vertical)
+            # horizontal and diagonals with the gap at any of the 4 places
+            for shift in lines:
+                pair = (current << shift) & (current << 2 * shift)
+                cells |= pair & (current << 3 * shift)
+                cells |= pair & (current >> shift)
+                pair = (current >> shift) & (current >> 2 * shift)
+                cells |= pair & (current << shift)
+                cells |= pair & (current >> 3 * shift)
+            return cells & (board_mask ^ mask)
+        return winning_cells
+
+    def winning_cells(current, mask):
+        cells = 0
+        for shift in shifts:
+            # the gap can be at any of the connect places of the line
+            for gap in range(connect):
+                line = -1
+                for place in range(connect):
+                    if place != gap:
+                        offset = (place - gap) * shift
+                        line &= current >> offset if offset > 0 else current << -offset
+                cells |= line
+        return cells & (board_mask ^ mask)
+    return winning_cells
+
+
+class Rules:
+    """The board size and the number in a row needed to win, with every table
+        that depends on them built once.
+
+        Bitboards lay the board out column by column, height + 1 bits per
+        column (the extra bit is an always empty sentinel that stops the
+        shift-and-AND line checks from wrapping into the next column).
+        The tables are shared by the win checks, the evaluator, the move
+        ordering and the solver, so use Rules.get() to get the one instance
+        for a size rather than building new ones.
+    """
+    _instances = {}
+
+    @classmethod
+    def get(cls, width=7, height=6, connect=4):
+        """Returns the shared Rules for a width x height board and connect in a row"""
+        key = (width, height, connect)
+        if key not in cls._instances:
+            cls._instances[key] = cls(width, height, connect)
+        return cls._instances[key]
+
+    def __init__(self, width, height, connect):
+        if connect < 2 or connect > max(width, height):
+            raise ValueError('Can not connect {} on a {}x{} board'.format(connect, width, height))
+        if width > 15:
+            # transposition table entries store the best move in 4 bits
+            raise ValueError('Boards wider than 15 columns are not supported')
+        self.width = width
+        self.height = height
+        self.connect = connect
+        self.h1 = height + 1
+        self.cells = width * height
+        self.bits = width * self.h1
+
+        self.bottom = [col * self.h1 for col in range(width)]
+        self.top = [col * self.h1 + height for col in range(width)]
+        self.bottom_mask = sum(1 << bit for bit in self.bottom)
+        self.column_mask = (1 << height) - 1
+        self.board_mask = self.bottom_mask * self.column_mask
+        # the bit each bit moves to when the columns are put in reverse order
+        self.mirror_bits = [self.bottom[width - 1 - bit // self.h1] + bit % self.h1
+                            for bit in range(self.bits)]
+
+        # Zobrist keys, one random 64-bit number per (player, bit). The
+        # generator is seeded so keys are the same in every process and run.
+        rng = random.Random(0xC4)
+        self.zobrist = [None] + [[rng.getrandbits(64) for bit in range(self.bits)]
+                                 for player in (1, 2)]
+
+        # vertical, horizontal, diagonal /, diagonal \
+        self.shifts = (1, self.h1, self.h1 + 1, self.h1 - 1)
+        self.connected = _make_connected(self.shifts, connect)
+        self.winning_cells = _make_winning_cells(self.shifts, connect, self.board_mask)
+
+        # Columns from the center outwards: 3, 2, 4, 1, 5, 0, 6 on 7 columns
+        self.center_order = sorted(range(width), key=lambda col: abs(col - (width - 1) / 2))
+        # the middle column, or the middle two on an even width
+        self.center_mask = 0
+        for col in {(width - 1) // 2, width // 2}:
+            self.center_mask |= self.column_mask << self.bottom[col]
+        # the 1st, 3rd, 5th... rows from the bottom, where player 1's threats
+        # count in the endgame, and the rows in between for player 2
+        self.odd_rows = self.bottom_mask * sum(1 << row for row in range(0, height, 2))
+        self.even_rows = self.board_mask ^ self.odd_rows
+
+        self.lines = self._build_lines()
+        self._build_windows()
+
+        # Every evaluation lies in [-eval_bound, eval_bound]: at most one
+        # player can hold a threat in any window, and a win scores 50
+        self.eval_bound = max(50, len(self.windows))
+
+    def __reduce__(self):
+        # unpickle to the shared instance of this process
+        return (Rules.get, (self.width, self.height, self.connect))
+
+    def __repr__(self):
+        return 'Rules({}, {}, {})'.format(self.width, self.height, self.connect)
+
+    def cell(self, col, row):
+        """Returns the bit of col, row counted from the bottom"""
+        return self.bottom[col] + row
+
+    def _build_lines(self):
+        """Returns every row, column and diagonal long enough to win on as a list of bits"""
+        width, height = self.width, self.height
+        lines = []
+        for row in range(height):
+            lines.append([self.cell(col, row) for col in range(width)])
+        for col in range(width):
+            lines.append([self.cell(col, row) for row in range(height)])
+        for start in range(-height + 1, width):
+            up = [self.cell(start + i, i) for i in range(height) if 0 <= start + i < width]
+            down = [self.cell(start + i, height - 1 - i) for i in range(height)
+                    if 0 <= start + i < width]
+            lines.extend([up, down])
+        return [line for line in lines if len(line) >= self.connect]
+
+    def _build_windows(self):
+        """
+        Builds every window of connect cells on the board. A window is
+        (mask, threats) where threats maps each way of filling all but one of
+        its cells to the counter slot line * connect + empty_index, the
+        patterns AIPlayer.check_three searches each line for.
+        """
+        connect = self.connect
+        self.windows = []
+        for line_num, line in enumerate(self.lines):
+            for start in range(len(line) - connect + 1):
+                cells = line[start:start + connect]
+                mask = 0
+                for bit in cells:
+                    mask |= 1 << bit
+                threats = {}
+                for empty, bit in enumerate(cells):
+                    threats[mask & ~(1 << bit)] = line_num * connect + empty
+                self.windows.append((mask, threats))
+
+        self.windows_at = {}
+        for window in self.windows:
+            for bit in range(self.bits):
+                if window[0] >> bit & 1:
+                    self.windows_at.setdefault(bit, []).append(window)
+
+        # the masks must fit in int64 for the numpy tables below
+        self.batchable = self.bits <= 63
+
+    # The same tables as arrays for batch evaluation: the mask of every
+    # window, its threat patterns in slot order, and the index of the first
+    # window of each line (windows are stored line by line). They are built,
+    # and numpy imported, the first time a batch is evaluated.
+
+    def _numpy(self):
+        """Returns numpy, raising AttributeError on boards too big for int64 masks"""
+        if not self.batchable:
+            raise AttributeError('{} boards do not fit in int64 masks'.format(self))
+        import numpy as np
+        return np
+
+    @cached_property
+    def window_masks(self):
+        np = self._numpy()
+        return np.array([mask for mask, threats in self.windows], dtype=np.int64)
+
+    @cached_property
+    def window_threats(self):
+        np = self._numpy()
+        threats = np.zeros((len(self.windows), self.connect), dtype=np.int64)
+        for index, (mask, patterns) in enumerate(self.windows):
+            for threat, slot in patterns.items():
+                threats[index, slot % self.connect] = threat
+        return threats
+
+    @cached_property
+    def line_starts(self):
+        np = self._numpy()
+        return np.array([sum(len(line) - self.connect + 1 for line in self.lines[:num])
+                         for num in range(len(self.lines))])
+
+    @cached_property
+    def cell_bits(self):
+        """The bit of every cell of the numpy board, row 0 being the top row"""
+        np = self._numpy()
+        return np.array([[1 << self.cell(col, self.height - 1 - row)
+                          for col in range(self.width)]
+                         for row in range(self.height)], dtype=np.int64)
+
+    def mirror_mask(self, mask):
+        """Returns mask with the columns in reverse order"""
+        mirrored = 0
+        for col in range(self.width):
+            mirrored |= (mask >> self.bottom[col] & self.column_mask) << self.bottom[self.width - 1 - col]
+        return mirrored
+
+    def unique_key(self, mask1, mask2):
+        """
+        Returns a key that identifies the position exactly (unlike the
+        Zobrist key it can not collide): player 1's discs plus the filled
+        cells plus the bottom row, which sets the bit just above every
+        column's top disc.
+        """
+        return mask1 + (mask1 | mask2) + self.bottom_mask
+
+
+STANDARD = Rules.get(7, 6, 4)
@@ -0,0 +1,231 @@
+import itertools
+import multiprocessing as mp
+import time
+from collections import namedtuple
+
+SearchResult = namedtuple('SearchResult', ['move', 'timed_out', 'depth', 'nodes', 'elapsed',
+                                           'score', 'solved'])
+
+
+def worker_loop(conn, stop_event):
+    """
+    Runs in each worker process. Keeps the registered players alive between
+    requests so their transposition tables and other per-game state are warm
+    for the next turn.
+
+    Requests are tuples sent over conn:
+    ('register', key, player) - store player under key
+    ('forget', key)           - drop the player stored under key
+    ('search', request_id, key, method, board, time_limit)
+                              - call player.method(board) with max_time set
+                                to time_limit and send back
+                                ('result', request_id, move, depth, nodes,
+                                score, solved) or ('error', request_id,
+                                message).
+                                Each completed iteration of the search is
+                                sent as ('progress', request_id, depth,
+                                move, nodes) before the result.
+    None                      - exit the loop
+
+    Setting stop_event makes the running search return the best move it has
+    found so far.
+    """
+    players = {}
+    while True:
+        try:
+            request = conn.recv()
+        except EOFError:
+            break
+        if request is None:
+            break
+        command = request[0]
+        if command == 'register':
+            players[request[1]] = request[2]
+        elif command == 'forget':
+            players.pop(request[1], None)
+        elif command == 'search':
+            request_id, key, method, board, time_limit = request[1:]
+            stop_event.clear()
+            try:
+                player = players[key]
+                player.max_time = time_limit
+                # players without a stop_event (RandomPlayer) can only be
+                # cancelled
+                if getattr(player, 'stop_event', False) is None:
+                    player.stop_event = stop_event
+                player.progress = (lambda depth, move, nodes, request_id=request_id:
+                                   conn.send(('progress', request_id, depth, move, nodes)))
+                try:
+                    move = getattr(player, method)(board)
+                finally:
+                    player.progress = None
+                conn.send(('result', request_id, move,
+                           getattr(player, 'depth_reached', 0), getattr(player, 'nodes', 0),
+                           getattr(player, 'score', None), getattr(player, 'solved', None)))
+            except Exception as e:
+                conn.send(('error', request_id, repr(e)))
+
+
+class SearchWorker:
+    """One worker process and the players that have been registered with it"""
+    def __init__(self):
+        self.players = {}
+        self.replies = {}
+        self.start()
+
+    def start(self):
+        self.conn, child_conn = mp.Pipe()
+        self.stop_event = mp.Event()
+        # not a daemon so parallel players can start their own helper processes
+        self.process = mp.Process(target=worker_loop, args=(child_conn, self.stop_event))
+        self.process.start()
+        child_conn.close()
+        for key, player in self.players.items():
+            self.conn.send(('register', key, player))
+
+    def restart(self):
+        """Kills the process and starts a fresh one with the players as registered"""
+        self.process.terminate()
+        self.process.join()
+        self.conn.close()
+        self.replies = {}
+        self.start()
+
+    def poll(self, request_id, timeout, progress=None):
+        """
+        Reads replies for up to timeout seconds, returns True once the reply
+        to request_id has arrived. Progress messages for request_id are
+        passed to progress(depth, move, nodes) as they arrive, others are
+        dropped.
+        """
+        deadline = time.time() + timeout
+        while request_id not in self.replies:
+            if not self.conn.poll(max(0, deadline - time.time())):
+                return False
+            reply = self.conn.recv()
+            if reply[0] == 'progress':
+                if reply[1] == request_id and progress is not None:
+                    progress(*reply[2:])
+            else:
+                self.replies[reply[1]] = reply
+        return True
+
+    def wait_for(self, request_id, timeout, progress=None):
+        """Returns the reply to request_id or None if it does not arrive in time"""
+        if not self.poll(request_id, timeout, progress):
+            return None
+        return self.replies.pop(request_id)
+
+
+class PendingSearch:
+    """Handle for a search that has been sent to a worker"""
+    def __init__(self, worker, request_id, time_limit):
+        self.worker = worker
+        self.request_id = request_id
+        self.time_limit = time_limit
+        self.started = time.time()
+
+    def done(self, progress=None):
+        """
+        Returns True once the worker has replied or the time limit is up,
+        without waiting. Progress read meanwhile goes to progress as in result().
+        """
+        if self.worker.poll(self.request_id, 0, progress):
+            return True
+        return time.time() - self.started >= self.time_limit
+
+    def result(self, progress=None):
+        """
+        Waits for the search to finish, calling progress(depth, move, nodes)
+        for every search iteration the worker reports meanwhile
+
+        RETURNS:
+        A SearchResult. If the worker has not answered by the time limit it
+        is killed and restarted and the result has move None and timed_out
+        True; the players it held fall back to their registered state.
+        """
+        remaining = self.time_limit - (time.time() - self.started)
+        reply = self.worker.wait_for(self.request_id, max(0, remaining), progress)
+        elapsed = time.time() - self.started
+        if reply is None:
+            self.cancel()
+            return SearchResult(None, True, 0, 0, elapsed, None, None)
+        if reply[0] == 'error':
+            raise Exception(reply[2])
+        return SearchResult(reply[2], False, reply[3], reply[4], elapsed, reply[5], reply[6])
+
+    def stop(self):
+        """
+        Asks the search to finish now. result() then returns the best move
+        of the deepest completed iteration, and the worker and the player's
+        state are kept. Safe to call from any thread.
+        """
+        self.worker.stop_event.set()
+
+    def cancel(self):
+        """Abandons the search by restarting the worker running it"""
+        self.worker.restart()
+
+
+class SearchService:
+    """A pool of long-lived search processes.
+
+        Replaces starting one mp.Process per move: players are registered
+        once under a key, always searched in the same worker and keep their
+        state there between turns. A search that runs past its time limit is
+        cancelled by restarting only the worker that ran it.
+    """
+    def __init__(self, workers=1):
+        self.workers = [SearchWorker() for i in range(max(1, workers))]
+        self.assignments = {}
+        self.request_ids = itertools.count()
+
+    def register(self, key, player, worker=None):
+        """
+        Sends player to a worker and stores it under key, to the least
+        loaded worker unless worker gives the index of one
+        """
+        if worker is None:
+            worker = min(self.workers, key=lambda w: len(w.players))
+        else:
+            worker = self.workers[worker]
+        self.assignments[key] = worker
+        worker.players[key] = player
+        worker.conn.send(('register', key, player))
+
+    def forget(self, key):
+        worker = self.assignments.pop(key)
+        del worker.players[key]
+        worker.conn.send(('forget', key))
+
+    def submit(self, key, board, method, time_limit):
+        """
+        Starts a search for the player registered under key
+
+        INPUTS:
+        key        - the key the player was registered with
+        board      - the position to search, in the format the method expects
+        method     - name of the player method to call, e.g. 'get_alpha_beta_move'
+        time_limit - seconds the player may take before it is cancelled
+
+        RETURNS:
+        A PendingSearch
+        """
+        worker = self.assignments[key]
+        request_id = next(self.request_ids)
+        worker.conn.send(('search', request_id, key, method, board, time_limit))
+        return PendingSearch(worker, request_id, time_limit)
+
+    def search(self, key, board, method, time_limit):
+        """Submits a search and waits for its SearchResult"""
+        return self.submit(key, board, method, time_limit).result()
+
+    def close(self):
+        for worker in self.workers:
+            try:
+                worker.conn.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+            worker.process.join(1)
+            if worker.process.is_alive():
+                worker.process.terminate()
@@ -0,0 +1,359 @@
+import os
+import struct
+
+import SpeedProfile
+from Rules import STANDARD
+from TranspositionTable import TranspositionTable, LOWER, UPPER
+
+DEFAULT_CACHE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'solved_positions.bin')
+
+CELLS = STANDARD.cells
+
+# Table keys of boards wider than 64 bits are folded modulo this prime
+KEY_PRIME = (1 << 64) - 59
+
+# Measured cost of the solver, used to decide whether a position can be
+# solved in the time that is left: roughly SOLVE_BRANCHING ** empty cells
+# nodes at the solve rate of this machine's SpeedProfile
+SOLVE_BRANCHING = 1.65
+# Never try to solve with more empty cells than this, however long the move
+MAX_SOLVE_EMPTY = 28
+
+# Solved cache file: a header, then records appended as positions are
+# solved, each the canonical unique key, the exact score and the best move
+MAGIC = b'C4SV'
+VERSION = 1
+HEADER = struct.Struct('<4sHxx')
+RECORD = struct.Struct('<QbB')
+
+
+def popcount(mask):
+    return bin(mask).count('1')
+
+
+def describe(score, moves, cells=CELLS):
+    """
+    Turns a solver score into a game result
+
+    INPUTS:
+    score - exact score from solve(), from the side to move's point of view
+    moves - number of discs on the board the score was found for
+    cells - number of cells of the board, rules.cells
+
+    RETURNS:
+    ('win', plies), ('loss', plies) or ('draw', plies left) where plies is
+    how many moves, counting both players, until the game is decided
+    """
+    # the winning disc is number cells + 1 - 2 * |score| or the one after
+    # it, whichever the winner plays: the side to move plays the odd plies
+    # from here, the opponent the even ones
+    if score > 0:
+        last = cells + 1 - 2 * score
+        return 'win', last + ((last - moves - 1) & 1) - moves
+    if score < 0:
+        last = cells + 1 + 2 * score
+        return 'loss', last + ((last - moves) & 1) - moves
+    return 'draw', cells - moves
+
+
+class SolvedCache:
+    """Exact results of solved positions kept on disk across games.
+
+        The file is an append-only log, read into a dict when it is opened.
+        Positions are stored under their canonical unique key, so a
+        position and its mirror image share one record. A record cut short
+        by a crash at the end of the file is ignored.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                data = f.read()
+            if len(data) >= HEADER.size:
+                magic, version = HEADER.unpack_from(data, 0)
+                if magic != MAGIC or version != VERSION:
+                    raise ValueError('{} is not a version {} solved cache'.format(path, VERSION))
+                end = HEADER.size + (len(data) - HEADER.size) // RECORD.size * RECORD.size
+                for key, score, move in RECORD.iter_unpack(data[HEADER.size:end]):
+                    self.entries[key] = (score, move)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def add(self, key, score, move):
+        if key in self.entries:
+            return
+        self.entries[key] = (score, move)
+        # several processes may share the file, only the one that creates
+        # it writes the header and every record is a single small append
+        try:
+            with open(self.path, 'xb') as f:
+                f.write(HEADER.pack(MAGIC, VERSION))
+        except FileExistsError:
+            pass
+        with open(self.path, 'ab') as f:
+            f.write(RECORD.pack(key, score, move))
+
+
+class Solver:
+    """Exact endgame solver: a negamax alpha-beta search to the end of the
+        game, driven by null-window searches that narrow the score down
+        (the MTD(f) idea on the solver's small integer scores).
+
+        Scores are from the side to move's point of view: 0 is a draw and a
+        win scores more the sooner it comes, so the score also gives the
+        distance to the end of the game (see describe()).
+        Results for root positions are saved to the solved cache, which
+        only holds standard 6x7 connect 4 positions.
+    """
+    def __init__(self, cache_path=DEFAULT_CACHE, table_bytes=4 * 1024 * 1024, rules=STANDARD):
+        self.rules = rules
+        self.cache_path = cache_path if rules is STANDARD else None
+        self.cache = None
+        self.table = TranspositionTable(table_bytes)
+        self.tick = None
+        self.bind_rules()
+
+    def bind_rules(self):
+        """
+        Keeps the tables of rules the search uses on the solver, so the
+        inner loops look each one up as a single attribute
+        """
+        rules = self.rules
+        self.cells = rules.cells
+        self.bottom_mask = rules.bottom_mask
+        self.board_mask = rules.board_mask
+        self.column_bits = [rules.column_mask << rules.bottom[col] for col in rules.center_order]
+        self.winning_cells = rules.winning_cells
+        self.fold = rules.bits > 64
+        self.mirror_mask = rules.mirror_mask
+
+    def __getstate__(self):
+        # the rules functions are rebuilt by Rules.get when unpickled
+        state = dict(self.__dict__)
+        state['cache'] = None
+        state['tick'] = None
+        del state['winning_cells']
+        del state['mirror_mask']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.bind_rules()
+
+    def open_cache(self):
+        """Reads the solved cache on first use, returns None without a cache path"""
+        if self.cache is None and self.cache_path:
+            self.cache = SolvedCache(self.cache_path)
+        return self.cache
+
+    @staticmethod
+    def solvable(empty, seconds):
+        """Returns True if a position with empty free cells is expected to solve in seconds"""
+        if empty > MAX_SOLVE_EMPTY:
+            return False
+        return SOLVE_BRANCHING ** empty <= SpeedProfile.solve_rate() * seconds
+
+    def solve_position(self, position, tick):
+        """
+        Solves a Bitboard position to the end of the game
+
+        INPUTS:
+        position - the Bitboard to solve, it is not changed
+        tick     - called once per node, it may raise to stop the search
+
+        RETURNS:
+        (score, move): the exact score for the side to move and a 0 based
+        column that reaches it
+        """
+        key, mirrored = position.canonical_key()
+        cache = self.open_cache()
+        if cache is not None:
+            entry = cache.get(key)
+            if entry is not None:
+                score, move = entry
+                return score, (self.rules.width - 1 - move if mirrored else move)
+
+        player = position.next_player()
+        current = position.masks[player]
+        mask = position.masks[1] | position.masks[2]
+        score, move = self.solve(current, mask, position.moves, tick)
+        if cache is not None:
+            cache.add(key, score, self.rules.width - 1 - move if mirrored else move)
+        return score, move
+
+    def solve(self, current, mask, moves, tick):
+        """Returns (score, move) for the side owning current, mask holds all discs"""
+        self.tick = tick
+        cells = self.cells
+        possible = (mask + self.bottom_mask) & self.board_mask
+        wins = self.winning_cells(current, mask) & possible
+        if wins:
+            return (cells + 1 - moves) // 2, self.column_of(wins & -wins)
+
+        low = -((cells - moves) // 2)
+        high = (cells + 1 - moves) // 2
+        while low < high:
+            # probe near 0 first, most endgames are close to a draw
+            middle = low + (high - low) // 2
+            if middle <= 0 and -(-low // 2) < middle:
+                middle = -(-low // 2)
+            elif middle >= 0 and high // 2 > middle:
+                middle = high // 2
+            value = self.negamax(current, mask, moves, middle, middle + 1)
+            if value <= middle:
+                high = value
+            else:
+                low = value
+        score = low
+
+        # a move reaches the score if the opponent can not do better than -score
+        candidates = self.non_losing_moves(current, mask)
+        if not candidates:
+            return score, self.column_of(self.ordered(current, mask, possible)[0])
+        for move in self.ordered(current, mask, candidates):
+            child = mask | move
+            if moves + 1 == cells:
+                value = 0
+            else:
+                value = -self.negamax(current ^ mask, child, moves + 1, -score, -score + 1)
+            if value >= score:
+                return score, self.column_of(move)
+        return score, self.column_of(candidates & -candidates)
+
+    def non_losing_moves(self, current, mask):
+        """Returns the cells the side to move can play without letting the opponent win next"""
+        possible = (mask + self.bottom_mask) & self.board_mask
+        threats = self.winning_cells(current ^ mask, mask)
+        forced = possible & threats
+        if forced:
+            if forced & (forced - 1):
+                return 0
+            possible = forced
+        return possible & ~(threats >> 1)
+
+    def ordered(self, current, mask, moves):
+        """Returns the cells in moves, the ones that make the most new threats first"""
+        scored = []
+        winning_cells = self.winning_cells
+        for index, column in enumerate(self.column_bits):
+            move = moves & column
+            if move:
+                threats = popcount(winning_cells(current | move, mask | move))
+                scored.append((-threats, index, move))
+        scored.sort()
+        return [move for threats, index, move in scored]
+
+    def column_of(self, move):
+        return (move.bit_length() - 1) // self.rules.h1
+
+    def negamax(self, current, mask, moves, alpha, beta):
+        """
+        Null or narrow window negamax to the end of the game. The side to
+        move must not have a winning move.
+        """
+        self.tick()
+        cells = self.cells
+        nonlosing = self.non_losing_moves(current, mask)
+        if not nonlosing:
+            return -((cells - moves) // 2)
+        if moves >= cells - 2:
+            return 0
+
+        low = -((cells - 2 - moves) // 2)
+        if alpha < low:
+            alpha = low
+            if alpha >= beta:
+                return alpha
+        high = (cells - 1 - moves) // 2
+        # a position and its mirror image share one entry; scores do not
+        # depend on the side of the board and no move is stored
+        key = current + mask
+        mirror = self.mirror_mask(current) + self.mirror_mask(mask)
+        if mirror < key:
+            key = mirror
+        if self.fold:
+            key %= KEY_PRIME
+        entry = self.table.probe(key)
+        if entry is not None:
+            if entry[2] == UPPER:
+                high = min(high, entry[0])
+            else:
+                low = max(low, entry[0])
+                if alpha < low:
+                    alpha = low
+                    if alpha >= beta:
+                        return alpha
+        if beta > high:
+            beta = high
+            if alpha >= beta:
+                return beta
+
+        opponent = current ^ mask
+        for move in self.ordered(current, mask, nonlosing):
+            value = -self.negamax(opponent, mask | move, moves + 1, -beta, -alpha)
+            if value >= beta:
+                self.table.store(key, value, 0, LOWER)
+                return value
+            if value > alpha:
+                alpha = value
+        self.table.store(key, alpha, 0, UPPER)
+        return alpha
+
+
+if __name__=='__main__':
+    import random
+
+    from Bitboard import Bitboard
+    from Rules import Rules
+
+    def exhaustive(position):
+        """Returns (result, plies) by plain minimax: the quickest win, else a draw, else the slowest loss"""
+        player = position.next_player()
+        moves = position.valid_moves()
+        if any(position.wins_after(col, player) for col in moves):
+            return 'win', 1
+        if not moves:
+            return 'draw', 0
+        best = None
+        for col in moves:
+            position.play(col, player)
+            result, plies = exhaustive(position)
+            position.undo()
+            # the opponent's result, seen from the side to move
+            rank = {'win': -1000 + plies, 'draw': 0, 'loss': 1000 - plies}[result]
+            if best is None or rank > best[0]:
+                best = (rank, {'win': 'loss', 'draw': 'draw', 'loss': 'win'}[result], plies + 1)
+        return best[1], best[2]
+
+    rng = random.Random(0)
+    # boards with an even and an odd number of cells
+    for rules in (Rules.get(5, 4, 3), Rules.get(4, 4, 3), Rules.get(5, 3, 3), Rules.get(7, 5, 4),
+                  Rules.get(9, 7, 4)):
+        solver = Solver(None, rules=rules)
+        for trial in range(40):
+            while True:
+                position = Bitboard(rules)
+                for ply in range(rules.cells - rng.randint(1, 9)):
+                    position.play(rng.choice(position.valid_moves()), position.next_player())
+                    if position.is_win(1) or position.is_win(2):
+                        break
+                else:
+                    break
+            score, move = solver.solve_position(position, lambda: None)
+            expected = exhaustive(position)
+            assert describe(score, position.moves, rules.cells) == expected, (rules, position.history)
+            position.play(move, position.next_player())
+            if expected[0] == 'win' and expected[1] == 1:
+                assert position.is_win(3 - position.next_player()), (rules, position.history)
+            else:
+                result = exhaustive(position)
+                assert (result[0], result[1] + 1) == {'win': ('loss', expected[1]),
+                                                      'draw': ('draw', expected[1]),
+                                                      'loss': ('win', expected[1])}[expected[0]], (
+                    rules, position.history)
+    print('Solver scores and describe() match exhaustive minimax on even and odd boards')
@@ -0,0 +1,115 @@
+import json
+import os
+import platform
+import time
+
+DEFAULT_PROFILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'speed_profile.json')
+VERSION = 1
+
+# Solver nodes per second assumed when no profile can be measured or read,
+# what the solver ran at in pure Python when it was written
+DEFAULT_SOLVE_RATE = 60000
+# The solver is timed on this middlegame position for PROFILE_NODES nodes,
+# about a fifth of a second
+PROFILE_POSITION = '3512101621534234'
+PROFILE_NODES = 10000
+
+_profile = None
+
+
+class _Stop(Exception):
+    """Ends the timed solve once PROFILE_NODES nodes are counted"""
+
+
+def fingerprint():
+    """Returns what a profile is only valid for: this machine and this Python"""
+    return {'machine': platform.machine(),
+            'node': platform.node(),
+            'python': platform.python_implementation() + ' ' + platform.python_version()}
+
+
+def measure():
+    """
+    Times the exact solver on PROFILE_POSITION
+
+    RETURNS:
+    A profile dict with the solve_rate in nodes per second
+    """
+    from Bitboard import Bitboard
+    from Solver import Solver
+
+    solver = Solver(None)
+    position = Bitboard.from_moves([int(col) for col in PROFILE_POSITION])
+    counter = [0]
+
+    def tick():
+        counter[0] += 1
+        if counter[0] >= PROFILE_NODES:
+            raise _Stop()
+
+    started = time.perf_counter()
+    try:
+        solver.solve_position(position, tick)
+    except _Stop:
+        pass
+    elapsed = time.perf_counter() - started
+    return dict(fingerprint(), version=VERSION,
+                solve_rate=counter[0] / elapsed if elapsed else DEFAULT_SOLVE_RATE,
+                measured=time.strftime('%Y-%m-%dT%H:%M:%S'))
+
+
+def save(profile, path=DEFAULT_PROFILE):
+    """Writes profile to path, replacing the file in one step so readers never see half of it"""
+    temp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(temp, 'w') as f:
+        json.dump(profile, f, indent=2)
+    os.replace(temp, path)
+
+
+def load(path=DEFAULT_PROFILE):
+    """
+    Returns the speed profile of this machine. It is read from path, or
+    measured and saved there when the file is missing or was made on
+    another machine or Python, so the measuring happens once. The profile
+    is kept for the rest of the process.
+    """
+    global _profile
+    if _profile is not None:
+        return _profile
+    profile = None
+    if path and os.path.exists(path):
+        try:
+            with open(path) as f:
+                profile = json.load(f)
+        except (OSError, ValueError):
+            profile = None
+    expected = dict(fingerprint(), version=VERSION)
+    if profile is None or any(profile.get(key) != value for key, value in expected.items()):
+        profile = measure()
+        if path:
+            try:
+                save(profile, path)
+            except OSError:
+                pass
+    _profile = profile
+    return profile
+
+
+def solve_rate():
+    """Returns the solver nodes per second of this machine"""
+    return load().get('solve_rate', DEFAULT_SOLVE_RATE)
+
+
+if __name__=='__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Shows the speed profile of this machine, '
+                                                 'measuring it if there is none')
+    parser.add_argument('--path', default=DEFAULT_PROFILE)
+    parser.add_argument('--force', action='store_true',
+                        help='Measure again and replace the saved profile')
+    args = parser.parse_args()
+
+    if args.force:
+        save(measure(), args.path)
+    print(json.dumps(load(args.path), indent=2))
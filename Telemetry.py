@@ -0,0 +1,325 @@
+import functools
+import json
+import os
+import sys
+import threading
+import time
+
+from Bitboard import Bitboard
+
+
+def instrumented(method):
+    """
+    Decorates an AIPlayer move method so that each call is recorded by the
+    player's telemetry. With player.telemetry set to None the only cost is
+    this wrapper, once per move.
+    """
+    @functools.wraps(method)
+    def wrapper(self, board):
+        telemetry = getattr(self, 'telemetry', None)
+        if telemetry is None:
+            return method(self, board)
+        return telemetry.observe(self, method, board)
+    return wrapper
+
+
+class SearchStats:
+    """Counters filled in by the instrumented board, evaluator and orderer during one move"""
+    def __init__(self):
+        self.win_checks = 0
+        self.win_check_time = 0.0
+        self.eval_calls = 0
+        self.eval_updates = 0
+        self.eval_time = 0.0
+        self.batch_calls = 0
+        self.cutoffs_by_ply = {}
+
+
+class TimedEvaluator:
+    """Wraps a ThreatEvaluator, counting and timing every update and lookup"""
+    def __init__(self, evaluator, stats):
+        self.evaluator = evaluator
+        self.stats = stats
+
+    def retract(self, bit, masks):
+        started = time.perf_counter()
+        self.evaluator.retract(bit, masks)
+        self.stats.eval_time += time.perf_counter() - started
+        self.stats.eval_updates += 1
+
+    def apply(self, bit, masks):
+        started = time.perf_counter()
+        self.evaluator.apply(bit, masks)
+        self.stats.eval_time += time.perf_counter() - started
+        self.stats.eval_updates += 1
+
+    def check_three(self, player_num):
+        return self.evaluator.check_three(player_num)
+
+    def evaluate(self, player_num):
+        started = time.perf_counter()
+        value = self.evaluator.evaluate(player_num)
+        self.stats.eval_time += time.perf_counter() - started
+        self.stats.eval_calls += 1
+        return value
+
+
+class TimedBatch:
+    """Wraps a player's evaluate_batch, counting every position it scores as an evaluation"""
+    def __init__(self, evaluate_batch, stats):
+        self.evaluate_batch = evaluate_batch
+        self.stats = stats
+
+    def __call__(self, masks, player_num, rules, weights):
+        started = time.perf_counter()
+        values = self.evaluate_batch(masks, player_num, rules, weights)
+        self.stats.eval_time += time.perf_counter() - started
+        self.stats.eval_calls += len(masks)
+        self.stats.batch_calls += 1
+        return values
+
+
+class InstrumentedBitboard(Bitboard):
+    """Bitboard that counts and times its win checks and times its evaluator"""
+    __slots__ = ('stats',)
+
+    @classmethod
+    def wrap(cls, position, stats):
+        """Returns an instrumented board sharing position's state"""
+        instrumented = cls()
+        for name in Bitboard.__slots__:
+            setattr(instrumented, name, getattr(position, name))
+        instrumented.stats = stats
+        return instrumented
+
+    def copy(self):
+        position = Bitboard.copy(self)
+        position.stats = self.stats
+        return position
+
+    def attach(self, evaluator):
+        self.evaluator = TimedEvaluator(evaluator, self.stats)
+
+    def is_win(self, player):
+        started = time.perf_counter()
+        result = Bitboard.is_win(self, player)
+        self.stats.win_check_time += time.perf_counter() - started
+        self.stats.win_checks += 1
+        return result
+
+    def wins_after(self, col, player):
+        started = time.perf_counter()
+        result = Bitboard.wins_after(self, col, player)
+        self.stats.win_check_time += time.perf_counter() - started
+        self.stats.win_checks += 1
+        return result
+
+    @property
+    def connected(self):
+        connected = self.rules.connected
+        stats = self.stats
+
+        def timed(mask):
+            started = time.perf_counter()
+            result = connected(mask)
+            stats.win_check_time += time.perf_counter() - started
+            stats.win_checks += 1
+            return result
+        return timed
+
+
+class CountingOrderer:
+    """Wraps a MoveOrderer and counts the cutoffs it is told about by ply"""
+    def __init__(self, ordering, stats):
+        self.ordering = ordering
+        self.stats = stats
+
+    def new_search(self):
+        self.ordering.new_search()
+
+    def order(self, board, ply, player, tt_move=None):
+        return self.ordering.order(board, ply, player, tt_move)
+
+    def cutoff(self, col, ply, player, depth):
+        self.stats.cutoffs_by_ply[ply] = self.stats.cutoffs_by_ply.get(ply, 0) + 1
+        self.ordering.cutoff(col, ply, player, depth)
+
+
+def principal_variation(player, position, move):
+    """Returns move followed by the best moves stored in player's table, up to depth_reached plies"""
+    line = [move]
+    position = position.copy()
+    mover = position.next_player()
+    position.play(move, mover)
+    seen = set()
+    while len(line) < max(1, player.depth_reached) and not position.is_win(mover):
+        key, mirrored = position.canonical_hash() if player.symmetry else (position.key, False)
+        entry = player.table.probe(key)
+        if entry is None or entry[3] is None or position.key in seen:
+            break
+        seen.add(position.key)
+        move = position.rules.width - 1 - entry[3] if mirrored else entry[3]
+        if not position.can_play(move):
+            break
+        mover = position.next_player()
+        position.play(move, mover)
+        line.append(move)
+    return line
+
+
+class SamplingProfiler:
+    """Samples the stack of one thread from a background thread.
+
+        Stacks are kept folded (outermost frame first, frames joined by ';')
+        with a count each, the input format of flamegraph.pl and speedscope.
+        The thread only samples between start() and stop(), so it can be
+        left paused between moves.
+    """
+    def __init__(self, interval=0.001):
+        self.interval = interval
+        self.stacks = {}
+        self.target = None
+        self.running = threading.Event()
+        self.thread = None
+
+    def start(self, thread_id=None):
+        self.target = thread_id if thread_id is not None else threading.get_ident()
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.sample, daemon=True)
+            self.thread.start()
+        self.running.set()
+
+    def stop(self):
+        self.running.clear()
+
+    def sample(self):
+        while True:
+            self.running.wait()
+            time.sleep(self.interval)
+            frame = sys._current_frames().get(self.target)
+            if frame is None or not self.running.is_set():
+                continue
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append('{}:{}'.format(os.path.basename(code.co_filename), code.co_name))
+                frame = frame.f_back
+            stack = ';'.join(reversed(names))
+            self.stacks[stack] = self.stacks.get(stack, 0) + 1
+
+    def write(self, path):
+        """Writes the folded stacks collected so far to path"""
+        with open(path, 'w') as f:
+            for stack, count in sorted(self.stacks.items()):
+                f.write('{} {}\n'.format(stack, count))
+
+
+class Telemetry:
+    """Per-move search telemetry for an AIPlayer.
+
+        Every move searched while player.telemetry is set adds a dict to
+        records, and a JSON line to path if one is given: the nodes, depth,
+        time, transposition table hits, cutoffs by ply, evaluation (batched
+        leaves included) and win check counts and time, the batch
+        evaluation calls, and the principal variation.
+        With profile_path set a SamplingProfiler runs during each move and
+        the folded stacks of all moves so far are rewritten to profile_path
+        after each one.
+        The player (and this object) can be sent to a SearchService worker,
+        the file is appended to from there.
+    """
+    def __init__(self, path=None, profile_path=None, interval=0.001):
+        self.path = path
+        self.profile_path = profile_path
+        self.interval = interval
+        self.records = []
+        self.profiler = None
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['profiler'] = None
+        return state
+
+    def observe(self, player, method, board):
+        """Calls method(player, board) with the search instrumented and records the move"""
+        stats = SearchStats()
+        position = InstrumentedBitboard.wrap(Bitboard.from_board(board, player.rules), stats)
+        ordering = player.ordering
+        player.ordering = CountingOrderer(ordering, stats)
+        evaluate_batch = player.evaluate_batch
+        player.evaluate_batch = TimedBatch(evaluate_batch, stats)
+        hits, misses = player.table.hits, player.table.misses
+        if self.profile_path:
+            if self.profiler is None:
+                self.profiler = SamplingProfiler(self.interval)
+            self.profiler.start()
+        started = time.time()
+        try:
+            move = method(player, position)
+        finally:
+            elapsed = time.time() - started
+            if self.profiler is not None:
+                self.profiler.stop()
+            player.ordering = ordering
+            player.evaluate_batch = evaluate_batch
+
+        record = {'method': method.__name__,
+                  'player': player.player_number,
+                  'ply': position.moves,
+                  'move': int(move),
+                  'elapsed': elapsed,
+                  'nodes': player.nodes,
+                  'depth': player.depth_reached,
+                  'iteration_nodes': list(player.iteration_nodes),
+                  'cutoffs': player.cutoffs,
+                  'cutoffs_by_ply': {str(ply): count for ply, count
+                                     in sorted(stats.cutoffs_by_ply.items())},
+                  'tt_hits': player.table.hits - hits,
+                  'tt_misses': player.table.misses - misses,
+                  'eval_calls': stats.eval_calls,
+                  'eval_updates': stats.eval_updates,
+                  'eval_time': stats.eval_time,
+                  'batch_calls': stats.batch_calls,
+                  'win_checks': stats.win_checks,
+                  'win_check_time': stats.win_check_time}
+        if method.__name__ == 'get_alpha_beta_move':
+            record['solved'] = player.solved
+            record['pv'] = principal_variation(player, position, int(move))
+        else:
+            record['pv'] = [int(move)]
+        self.records.append(record)
+        if self.path:
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+        if self.profiler is not None:
+            self.profiler.write(self.profile_path)
+        return move
+
+
+# Checks that an expectimax move, which scores its last plies in batches,
+# still counts every leaf it scores in eval_calls and its win checks in
+# win_checks
+if __name__ == '__main__':
+    from Evaluator import batch_evaluate
+    from Player import AIPlayer
+
+    leaves = []
+
+    def counting(masks, player_num, rules, weights):
+        leaves.append(len(masks))
+        return batch_evaluate(masks, player_num, rules, weights)
+
+    player = AIPlayer(1, max_time=60, book_path=None, solver_path=None)
+    player.max_depth = 5
+    player.evaluate_batch = counting
+    player.telemetry = Telemetry()
+    player.get_expectimax_move(Bitboard.from_moves([3, 3, 2]))
+    record = player.telemetry.records[-1]
+    assert player.evaluate_batch is counting
+    assert record['batch_calls'] == len(leaves), record
+    # only the first iterations are too shallow for the batch path
+    assert sum(leaves) <= record['eval_calls'] <= sum(leaves) * 1.01, record
+    assert record['win_checks'] > 0 and record['win_check_time'] > 0, record
+
+    print('expectimax telemetry counted {} evaluations for {} batched leaves'.format(
+        record['eval_calls'], sum(leaves)))
@@ -0,0 +1,142 @@
+from collections import namedtuple
+
+from Rules import STANDARD
+
+# Longest forced line the threat search follows, in plies counting both
+# sides and the winning move
+FORCED_WIN_PLIES = 21
+# Positions the threat search may visit per move. The search is tried
+# before every full-width search, so it is kept to a small share of a move.
+FORCED_WIN_NODES = 3000
+
+
+class ThreatAnalysis(namedtuple('ThreatAnalysis', ['wins', 'blocks', 'safe'])):
+    """The threats of a position, each a mask of playable cells.
+
+        wins    - cells that win at once for the side to move
+        blocks  - cells where the opponent would win next, which have to be
+                  taken (two or more of them can not all be)
+        safe    - the moves that do not lose on the opponent's next move,
+                  empty when every move does. A move directly below an
+                  opponent threat lets them win on top of it, so it is
+                  never safe.
+    """
+    __slots__ = ()
+
+    def lost(self):
+        """Returns True if the opponent wins on their next move whatever is played"""
+        return not self.wins and not self.safe
+
+    def forced(self):
+        """Returns True if the side to move has at most one move that does not lose at once"""
+        return not self.wins and not self.safe & (self.safe - 1)
+
+
+def columns(cells, rules=STANDARD):
+    """Returns the columns of the cells in a mask, from left to right"""
+    return [col for col in range(rules.width) if cells >> rules.bottom[col] & rules.column_mask]
+
+
+def analyze(position):
+    """Returns the ThreatAnalysis of a Bitboard for the player to move"""
+    rules = position.rules
+    current = position.masks[position.next_player()]
+    mask = position.masks[1] | position.masks[2]
+    possible = (mask + rules.bottom_mask) & rules.board_mask
+    threats = rules.winning_cells(current ^ mask, mask)
+    blocks = possible & threats
+    losing = possible & (threats >> 1)
+    if blocks & (blocks - 1):
+        safe = 0
+    else:
+        safe = (blocks or possible) & ~losing
+    return ThreatAnalysis(possible & rules.winning_cells(current, mask), blocks, safe)
+
+
+class ThreatSearch:
+    """Finds forced wins by threats alone.
+
+        The side to move only plays moves that leave it a win on the next
+        move, so the opponent's reply is forced: they have to block it (if
+        they had a win of their own the line is not followed). The line is
+        won once a move leaves two wins the opponent can not both block.
+        Any line found is a proven win, but a win that needs a quiet move
+        somewhere is not found; then the normal search takes over.
+
+        The lines are deepened two plies at a time, so the shortest line
+        of threats is found first. Positions that failed are remembered for
+        the rest of the move, with the plies they failed for.
+    """
+    def __init__(self, rules=STANDARD, max_plies=FORCED_WIN_PLIES, max_nodes=FORCED_WIN_NODES):
+        self.rules = rules
+        self.max_plies = max_plies
+        self.max_nodes = max_nodes
+        self.nodes = 0
+
+    def find_win(self, position, tick=None):
+        """
+        Searches for a forced win of the player to move
+
+        INPUTS:
+        position - the Bitboard to search, it is not changed
+        tick     - optional, called once per node, it may raise to stop the search
+
+        RETURNS:
+        (column, plies) with the 0 based column to play and the plies
+        (counting both players) until the win, or None if no win by threats
+        was found
+        """
+        rules = self.rules
+        winning_cells = rules.winning_cells
+        bottom_mask = rules.bottom_mask
+        board_mask = rules.board_mask
+        column_bits = [rules.column_mask << rules.bottom[col] for col in rules.center_order]
+        max_nodes = self.max_nodes
+        failed = {}
+        self.nodes = 0
+
+        def attack(current, mask, plies):
+            """Returns (cell, plies to the win) or None, current is the side to move"""
+            possible = (mask + bottom_mask) & board_mask
+            wins = winning_cells(current, mask) & possible
+            if wins:
+                return wins & -wins, 1
+            if plies < 3 or self.nodes >= max_nodes:
+                return None
+            key = current + mask
+            if failed.get(key, 0) >= plies:
+                return None
+            self.nodes += 1
+            if tick is not None:
+                tick()
+            threats = winning_cells(current ^ mask, mask)
+            blocks = threats & possible
+            if blocks & (blocks - 1):
+                return None
+            moves = (blocks or possible) & ~(threats >> 1)
+            for column in column_bits:
+                move = moves & column
+                if not move:
+                    continue
+                child, child_mask = current | move, mask | move
+                wins = winning_cells(child, child_mask)
+                playable = wins & (child_mask + bottom_mask) & board_mask
+                if not playable:
+                    continue
+                if playable & (playable - 1) or playable & (wins >> 1):
+                    return move, 3
+                line = attack(child, child_mask | playable, plies - 2)
+                if line is not None:
+                    return move, line[1] + 2
+            failed[key] = plies
+            return None
+
+        current = position.masks[position.next_player()]
+        mask = position.masks[1] | position.masks[2]
+        for plies in range(3, self.max_plies + 1, 2):
+            line = attack(current, mask, plies)
+            if line is not None:
+                return (line[0].bit_length() - 1) // rules.h1, line[1]
+            if self.nodes >= max_nodes:
+                break
+        return None
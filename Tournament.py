@@ -0,0 +1,237 @@
+import argparse
+import json
+import math
+import multiprocessing as mp
+import random
+import time
+
+from Bitboard import Bitboard
+from Evaluator import DEFAULT_WEIGHTS, Weights
+from GameRecord import GameRecord, write_game
+from Player import AIPlayer, RandomPlayer
+from Rules import Rules, STANDARD
+from Telemetry import Telemetry
+
+
+def make_player(name, num, move_time, depth, telemetry=None, rules=STANDARD,
+                weights=DEFAULT_WEIGHTS):
+    """Creates a headless player from its name ['ai', 'random']"""
+    if name == 'ai':
+        player = AIPlayer(num, move_time, rules=rules, weights=weights)
+        if depth:
+            player.max_depth = depth
+        if telemetry:
+            player.telemetry = Telemetry(telemetry)
+        return player
+    elif name == 'random':
+        return RandomPlayer(num, rules)
+    raise ValueError('Unknown headless player type {}'.format(name))
+
+
+def play_game(names, move_time=1, depth=None, seed=0, telemetry=None, rules=STANDARD,
+              weights=DEFAULT_WEIGHTS):
+    """
+    Plays one game without the GUI
+
+    INPUTS:
+    names     - player types for player 1 and player 2, e.g. ['ai', 'random']
+    move_time - seconds each ai player may use per move
+    depth     - optional cap on the ai search depth
+    seed      - seed for the random and numpy generators so games replay
+    telemetry - optional JSONL file the ai players append their search
+                stats for every move to
+    rules     - the board size and connect length to play
+    weights   - the evaluation Weights of the ai players
+
+    RETURNS:
+    A dict with the players, the winner (1, 2 or 0 for a draw), the list of
+    columns played and the time and nodes searched for every move
+    """
+    import numpy as np
+
+    random.seed(seed)
+    np.random.seed(seed % (1 << 32))
+    players = [make_player(name, num + 1, move_time, depth, telemetry, rules, weights)
+               for num, name in enumerate(names)]
+    position = Bitboard(rules)
+    moves, move_times, nodes = [], [], []
+    winner = 0
+    turn = 0
+    while position.valid_moves():
+        player = players[turn]
+        started = time.time()
+        if player.type == 'ai':
+            if players[1 - turn].type == 'random':
+                move = player.get_expectimax_move(position)
+            else:
+                move = player.get_alpha_beta_move(position)
+        else:
+            move = player.get_move(position)
+        move_times.append(time.time() - started)
+        nodes.append(getattr(player, 'nodes', 0))
+        move = int(move)
+        moves.append(move)
+        position.play(move, player.player_number)
+        if position.is_win(player.player_number):
+            winner = player.player_number
+            break
+        turn = 1 - turn
+    return {'players': list(names),
+            'seed': seed,
+            'winner': winner,
+            'moves': moves,
+            'move_times': move_times,
+            'nodes': nodes}
+
+
+def _play(args):
+    game, names, move_time, depth, seed, telemetry, rules, weights = args
+    result = play_game(names, move_time, depth, seed, telemetry, rules, weights)
+    result['game'] = game
+    return result
+
+
+def run(player1, player2, games, out, workers=None, move_time=1, depth=None,
+        swap=True, seed=0, telemetry=None, rules=STANDARD, record=None,
+        weights=DEFAULT_WEIGHTS):
+    """
+    Plays games in a process pool and appends each result to out as a JSON
+    line as soon as it finishes
+
+    INPUTS:
+    player1, player2 - player types ['ai', 'random']
+    games            - number of games to play
+    out              - path of the JSONL file to append to
+    workers          - processes to use, defaults to one per cpu
+    swap             - alternate which player moves first every game
+    telemetry        - optional JSONL file for the ai search stats of every move
+    rules            - the board size and connect length to play
+    record           - optional game record file every game is appended to
+    weights          - the evaluation Weights of the ai players
+
+    RETURNS:
+    The list of result dicts
+    """
+    tasks = []
+    for game in range(games):
+        names = [player1, player2]
+        if swap and game % 2:
+            names.reverse()
+        tasks.append((game, names, move_time, depth, seed + game, telemetry, rules, weights))
+    results = []
+    with mp.Pool(workers) as pool, open(out, 'a') as f:
+        for result in pool.imap_unordered(_play, tasks):
+            f.write(json.dumps(result) + '\n')
+            f.flush()
+            results.append(result)
+            if record:
+                limits = tuple(move_time if name == 'ai' else 0 for name in result['players'])
+                write_game(record, GameRecord(tuple(result['players']), limits, rules,
+                                              result['winner'], result['moves']))
+    return results
+
+
+def read_results(path):
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def elo_difference(score):
+    """Returns the Elo difference that gives an expected score of score"""
+    score = min(max(score, 1e-3), 1 - 1e-3)
+    return -400 * math.log10(1 / score - 1)
+
+
+def summarize(results):
+    """
+    Summarizes a set of game results
+
+    RETURNS:
+    A dict with the first player win rate, draw rate, average time and
+    nodes per move, and for every player type its score and the Elo
+    difference to the rest of the field
+    """
+    games = 0
+    first_wins = draws = 0
+    points = {}
+    played = {}
+    move_time = nodes = move_count = 0
+    for result in results:
+        games += 1
+        names = result['players']
+        winner = result['winner']
+        if winner == 1:
+            first_wins += 1
+        elif winner == 0:
+            draws += 1
+        for num, name in enumerate(names):
+            played[name] = played.get(name, 0) + 1
+            if winner == num + 1:
+                points[name] = points.get(name, 0) + 1
+            elif winner == 0:
+                points[name] = points.get(name, 0) + 0.5
+        move_time += sum(result['move_times'])
+        nodes += sum(result['nodes'])
+        move_count += len(result['moves'])
+
+    summary = {'games': games,
+               'first_player_win_rate': first_wins / games if games else 0.0,
+               'second_player_win_rate': (games - first_wins - draws) / games if games else 0.0,
+               'draw_rate': draws / games if games else 0.0,
+               'first_player_elo_advantage': elo_difference(
+                   (first_wins + draws / 2) / games) if games else 0.0,
+               'avg_move_time': move_time / move_count if move_count else 0.0,
+               'avg_nodes_per_move': nodes / move_count if move_count else 0.0,
+               'players': {}}
+    for name, count in played.items():
+        score = points.get(name, 0) / count
+        summary['players'][name] = {'games': count,
+                                    'score': score,
+                                    'elo': elo_difference(score)}
+    return summary
+
+
+if __name__=='__main__':
+    player_types = ['ai', 'random']
+    parser = argparse.ArgumentParser(description='Plays headless Connect 4 matches')
+    parser.add_argument('player1', choices=player_types, nargs='?')
+    parser.add_argument('player2', choices=player_types, nargs='?')
+    parser.add_argument('--games', type=int, default=100)
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Processes to play games in, one per cpu by default')
+    parser.add_argument('--time', type=float, default=1,
+                        help='Seconds per ai move')
+    parser.add_argument('--depth', type=int, default=None,
+                        help='Cap on the ai search depth')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-swap', action='store_true',
+                        help='Always let player1 move first')
+    parser.add_argument('--out', default='results.jsonl',
+                        help='JSONL file the results are appended to')
+    parser.add_argument('--telemetry', metavar='JSONL',
+                        help='Append the search stats of every ai move to this file')
+    parser.add_argument('--width', type=int, default=7)
+    parser.add_argument('--height', type=int, default=6)
+    parser.add_argument('--connect', type=int, default=4,
+                        help='Discs in a row needed to win')
+    parser.add_argument('--record', metavar='PATH',
+                        help='Append every game to this game record file')
+    parser.add_argument('--weights', metavar='JSON',
+                        help='Evaluation weights of the ai players, as written by Tuning')
+    parser.add_argument('--summarize', metavar='JSONL',
+                        help='Only summarize an existing results file')
+    args = parser.parse_args()
+
+    if args.summarize:
+        results = read_results(args.summarize)
+    else:
+        if not (args.player1 and args.player2):
+            parser.error('player1 and player2 are required unless --summarize is given')
+        rules = Rules.get(args.width, args.height, args.connect)
+        weights = Weights.load(args.weights) if args.weights else DEFAULT_WEIGHTS
+        results = run(args.player1, args.player2, args.games, args.out, args.workers,
+                      args.time, args.depth, not args.no_swap, args.seed, args.telemetry,
+                      rules, args.record, weights)
+    print(json.dumps(summarize(results), indent=2))
@@ -0,0 +1,111 @@
+from array import array
+
+# Bound types stored with each value
+EXACT = 0
+LOWER = 1
+UPPER = 2
+
+NO_MOVE = 15
+
+# An entry is a 64-bit key plus one 64-bit word packing
+#   bits  0-15  value + VALUE_OFFSET
+#   bits 16-23  search depth
+#   bits 24-25  bound type
+#   bits 26-29  best move (NO_MOVE if unknown)
+#   bit  30     occupied flag
+# The key slot holds key ^ data, so an entry torn by two processes writing
+# to a shared table at once fails the key check instead of being misread.
+ENTRY_BYTES = 16
+VALUE_OFFSET = 1 << 15
+OCCUPIED = 1 << 30
+
+
+class TranspositionTable:
+    """Fixed size Zobrist-keyed cache of alpha-beta results.
+
+        The table is split into buckets of two slots. The first slot keeps
+        the deepest search seen for its bucket (depth-preferred) and the
+        second is overwritten by every store that does not win the first
+        (always-replace), so fresh results from the current search are kept
+        without throwing away expensive deep ones.
+
+        Passing the buffers made by shared_buffers lets several processes
+        use one table in shared memory without locking.
+    """
+    def __init__(self, size_bytes=16 * 1024 * 1024, buffers=None):
+        self.buckets = max(1, size_bytes // (2 * ENTRY_BYTES))
+        if buffers is not None:
+            self.keys, self.data = [memoryview(b).cast('B').cast('Q') for b in buffers]
+        self.hits = 0
+        self.misses = 0
+        self.collisions = 0
+        self.stores = 0
+
+    def __getattr__(self, name):
+        # the arrays are allocated on first use, so creating a player (or
+        # sending one to a worker process) does not pay for zeroing them
+        if name in ('keys', 'data') and 'buckets' in self.__dict__:
+            self.keys = array('Q', bytes(16 * self.buckets))
+            self.data = array('Q', bytes(16 * self.buckets))
+            return self.__dict__[name]
+        raise AttributeError(name)
+
+    def probe(self, key):
+        """
+        Looks up the entry stored for key
+
+        RETURNS:
+        (value, depth, bound, move) for the position or None if it is not in
+        the table. move is None when no best move was recorded.
+        """
+        slot = (key % self.buckets) * 2
+        for index in (slot, slot + 1):
+            data = self.data[index]
+            if data and self.keys[index] ^ data == key:
+                self.hits += 1
+                move = data >> 26 & 15
+                return ((data & 0xFFFF) - VALUE_OFFSET, data >> 16 & 0xFF,
+                        data >> 24 & 3, None if move == NO_MOVE else move)
+        if self.data[slot] or self.data[slot + 1]:
+            self.collisions += 1
+        self.misses += 1
+        return None
+
+    def store(self, key, value, depth, bound, move=None):
+        """Saves a search result for key, replacing per the two-tier policy"""
+        self.stores += 1
+        slot = (key % self.buckets) * 2
+        data = ((int(value) + VALUE_OFFSET) | depth << 16 | bound << 24 |
+                (NO_MOVE if move is None else move) << 26 | OCCUPIED)
+        deep = self.data[slot]
+        same = self.keys[slot] ^ deep == key
+        if not deep or same or depth >= (deep >> 16 & 0xFF):
+            if deep and not same:
+                self.keys[slot + 1] = self.keys[slot]
+                self.data[slot + 1] = deep
+            self.keys[slot] = key ^ data
+            self.data[slot] = data
+        else:
+            self.keys[slot + 1] = key ^ data
+            self.data[slot + 1] = data
+
+    @staticmethod
+    def shared_buffers(size_bytes):
+        """Allocates shared memory for a table of size_bytes to pass to child processes"""
+        import multiprocessing as mp
+
+        buckets = max(1, size_bytes // (2 * ENTRY_BYTES))
+        return mp.RawArray('Q', 2 * buckets), mp.RawArray('Q', 2 * buckets)
+
+    def clear(self):
+        memoryview(self.keys).cast('B')[:] = bytes(16 * self.buckets)
+        memoryview(self.data).cast('B')[:] = bytes(16 * self.buckets)
+
+    def stats(self):
+        """Returns the hit/miss/collision counters as a dict"""
+        probes = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'collisions': self.collisions,
+                'stores': self.stores,
+                'hit_rate': self.hits / probes if probes else 0.0}
@@ -0,0 +1,230 @@
+import argparse
+import json
+import multiprocessing as mp
+import random
+import time
+
+import numpy as np
+
+from Bitboard import Bitboard
+from Evaluator import DEFAULT_WEIGHTS, Weights
+from Player import AIPlayer
+from Tournament import elo_difference
+
+# Weights the tuning starts from: DEFAULT_WEIGHTS times 4, which searches
+# exactly the same (only the ratios of the weights matter) but leaves room
+# for steps smaller than one open three in the other terms
+START_WEIGHTS = Weights(three=4, win=200, center=0, parity=0)
+# (low, high) each weight is kept in. With every weight at its limit a score
+# stays below Player.SCORE_LIMIT on the standard board.
+LIMITS = Weights(three=(1, 8), win=(100, 900), center=(-8, 8), parity=(-8, 8))
+# SPSA perturbation of each weight in the first iteration
+PERTURBATION = Weights(three=1, win=40, center=1, parity=1)
+# SPSA gain schedules, as recommended by Spall: the step is
+# STEP / (k + 1 + STABILITY) ** 0.602 and the perturbation shrinks by
+# (k + 1) ** 0.101 in iteration k
+STEP = 2.0
+STABILITY = 10
+# Random moves played at the start of every game so that games between the
+# same weights differ
+OPENING_PLIES = 4
+
+
+def random_opening(rng, plies=OPENING_PLIES):
+    """Returns a list of random columns that does not end the game"""
+    position = Bitboard()
+    moves = []
+    while len(moves) < plies:
+        player = position.next_player()
+        col = rng.choice([col for col in position.valid_moves()
+                          if not position.wins_after(col, player)])
+        position.play(col, player)
+        moves.append(col)
+    return moves
+
+
+def make_searcher(num, weights, depth):
+    """Creates an AIPlayer that searches to exactly depth, so its games replay"""
+    player = AIPlayer(num, 1e9, table_bytes=1 << 20, book_path=None, solver_path=None,
+                      weights=weights)
+    player.solver = None
+    player.max_depth = depth
+    return player
+
+
+def play_game(weights, depths, opening, seed):
+    """
+    Plays one alpha-beta game between two sets of weights
+
+    INPUTS:
+    weights - Weights of player 1 and player 2
+    depths  - search depth of player 1 and player 2
+    opening - columns played before the players take over
+    seed    - seed for the random tie breaks of the searches
+
+    RETURNS:
+    (winner (1, 2 or 0 for a draw), moves, seconds each player spent)
+    """
+    random.seed(seed)
+    players = [make_searcher(num + 1, weights[num], depths[num]) for num in range(2)]
+    position = Bitboard()
+    for col in opening:
+        position.play(col, position.next_player())
+    spent = [0.0, 0.0]
+    while position.valid_moves():
+        player = players[position.next_player() - 1]
+        started = time.time()
+        col = int(player.get_alpha_beta_move(position))
+        spent[player.player_number - 1] += time.time() - started
+        position.play(col, player.player_number)
+        if position.is_win(player.player_number):
+            return player.player_number, position.moves, spent
+    return 0, position.moves, spent
+
+
+def _play_pair(args):
+    """Plays an opening twice with colors swapped, returns the points and time of the first weights"""
+    weights, other, depth, other_depth, seed = args
+    opening = random_opening(random.Random(seed))
+    points = 0.0
+    spent = [0.0, 0.0]
+    moves = 0
+    for first in (True, False):
+        if first:
+            winner, plies, times = play_game((weights, other), (depth, other_depth), opening, seed)
+        else:
+            winner, plies, times = play_game((other, weights), (other_depth, depth), opening, seed)
+            times.reverse()
+        mine = 1 if first else 2
+        points += 1.0 if winner == mine else 0.5 if winner == 0 else 0.0
+        spent = [spent[i] + times[i] for i in range(2)]
+        moves += plies - len(opening)
+    return points, spent, moves
+
+
+def match(pool, weights, other, pairs, depth, other_depth=None, seed=0):
+    """
+    Plays pairs of games between weights and other, each opening once with
+    either side moving first
+
+    RETURNS:
+    A dict with the score of weights (1 for winning every game), its Elo
+    difference to other and the average seconds per move of each side
+    """
+    other_depth = depth if other_depth is None else other_depth
+    tasks = [(weights, other, depth, other_depth, seed * 100003 + pair) for pair in range(pairs)]
+    points = 0.0
+    spent = [0.0, 0.0]
+    moves = 0
+    for pair_points, pair_spent, pair_moves in pool.map(_play_pair, tasks):
+        points += pair_points
+        spent = [spent[i] + pair_spent[i] for i in range(2)]
+        moves += pair_moves
+    score = points / (2 * pairs)
+    return {'score': score,
+            'elo': elo_difference(score),
+            'move_time': spent[0] / max(1, moves / 2),
+            'other_move_time': spent[1] / max(1, moves / 2)}
+
+
+def to_weights(theta):
+    """Rounds a point of the tuning space to Weights within LIMITS"""
+    return Weights(*[int(min(max(round(value), low), high))
+                     for value, (low, high) in zip(theta, LIMITS)])
+
+
+def tune(iterations=100, pairs=4, depth=4, workers=None, seed=0, start=START_WEIGHTS,
+         tuned=('three', 'win', 'center', 'parity'), report=None):
+    """
+    Tunes the evaluation weights with SPSA over self-play.
+
+    Every iteration perturbs all the tuned weights at once by a random sign
+    times their perturbation, plays pairs of games between the two
+    perturbed sets and moves the weights towards the set that scored
+    better. All the games are seeded, so a run with the same arguments
+    gives the same weights.
+
+    INPUTS:
+    iterations - number of SPSA iterations
+    pairs      - game pairs per iteration, played in the process pool
+    depth      - search depth of both sides
+    workers    - processes to play games in, defaults to one per cpu
+    seed       - seed of the perturbations and the games
+    start      - the Weights to start from
+    tuned      - names of the weights to tune, the others keep their start value
+    report     - optional function called with the dict of every iteration
+
+    RETURNS:
+    (the tuned Weights, a list with a dict for every iteration)
+    """
+    theta = np.array(start, dtype=float)
+    scale = np.array([PERTURBATION[i] if name in tuned else 0
+                      for i, name in enumerate(Weights._fields)], dtype=float)
+    rng = np.random.RandomState(seed)
+    history = []
+    with mp.Pool(workers) as pool:
+        for k in range(iterations):
+            step = STEP / (k + 1 + STABILITY) ** 0.602
+            perturbation = scale / (k + 1) ** 0.101
+            delta = rng.choice([-1, 1], size=len(theta))
+            plus = to_weights(theta + perturbation * delta)
+            minus = to_weights(theta - perturbation * delta)
+            if plus == minus:
+                result = {'score': 0.5}
+            else:
+                result = match(pool, plus, minus, pairs, depth, seed=seed * 1000 + k)
+            # the score difference of plus over minus is 2 * score - 1
+            theta += step * (2 * result['score'] - 1) * perturbation * delta
+            theta = np.clip(theta, [low for low, high in LIMITS], [high for low, high in LIMITS])
+            entry = {'iteration': k,
+                     'plus': plus._asdict(),
+                     'minus': minus._asdict(),
+                     'score': result['score'],
+                     'theta': theta.tolist()}
+            history.append(entry)
+            if report is not None:
+                report(entry)
+    return to_weights(theta), history
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description='Tunes the evaluation weights by '
+                                                 'SPSA over seeded self-play games')
+    parser.add_argument('--iterations', type=int, default=100)
+    parser.add_argument('--pairs', type=int, default=4,
+                        help='Game pairs played per iteration')
+    parser.add_argument('--depth', type=int, default=4,
+                        help='Search depth of the tuning games')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Processes to play games in, one per cpu by default')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--start', metavar='JSON',
+                        help='Start from the weights in this file instead of the defaults')
+    parser.add_argument('--tune', nargs='+', choices=Weights._fields, default=list(Weights._fields),
+                        help='Weights to tune, the others are kept')
+    parser.add_argument('--out', default='weights.json',
+                        help='File the tuned weights and the tuning history are written to')
+    parser.add_argument('--verify', type=int, default=0, metavar='PAIRS',
+                        help='Afterwards play this many game pairs of the tuned weights at '
+                             'depth - 1 against the default weights at depth')
+    args = parser.parse_args()
+
+    start = Weights.load(args.start) if args.start else START_WEIGHTS
+    started = time.time()
+    weights, history = tune(args.iterations, args.pairs, args.depth, args.workers, args.seed,
+                            start, tuple(args.tune),
+                            lambda entry: print(json.dumps(entry)))
+    output = {'weights': weights._asdict(),
+              'depth': args.depth,
+              'iterations': args.iterations,
+              'pairs': args.pairs,
+              'seed': args.seed,
+              'elapsed': time.time() - started,
+              'history': history}
+    if args.verify:
+        with mp.Pool(args.workers) as pool:
+            output['verify'] = match(pool, weights, DEFAULT_WEIGHTS, args.verify,
+                                     args.depth - 1, args.depth, args.seed)
+    with open(args.out, 'w') as f:
+        json.dump(output, f, indent=2)
+    print(json.dumps({key: output[key] for key in output if key != 'history'}, indent=2))